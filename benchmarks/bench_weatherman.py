@@ -0,0 +1,254 @@
+"""Benchmarks for weatherman's orchestration paths.
+
+Run from the repository root:
+
+    python benchmarks/bench_weatherman.py --output bench.json
+    python benchmarks/bench_weatherman.py --compare bench.json
+
+With --compare, the run fails if any benchmark is slower than the saved
+result by more than --threshold (a fraction, default 0.25).
+"""
+from subprocess import list2cmdline
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import weatherman  # noqa
+
+
+CONFIG_SHAPES = {
+    'empty': ({}, []),
+    'vpc': ({
+        'iam_profile': 'profile',
+        'ec2_keyname': 'key',
+        'instance_type': 'm3.medium',
+        'vpc_id': 'vpc-1',
+        'elb_subnets': 'subnet-1,subnet-2',
+        'private_subnets': 'subnet-3,subnet-4',
+    }, []),
+    'public_elb': ({
+        'vpc_id': 'vpc-1',
+        'assign_elb_public_ip': True,
+        'public_subnets': 'subnet-1,subnet-2',
+        'private_subnets': 'subnet-3,subnet-4',
+    }, []),
+    'database': ({
+        'vpc_id': 'vpc-1',
+        'private_subnets': 'subnet-3,subnet-4',
+        'db_instance_class': 'db.t2.micro',
+        'db_engine': 'postgres',
+        'db_version': '9.4',
+        'db_size': '5',
+    }, ['--database']),
+}
+
+
+def measure(func, repeat=5, number=1):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            func()
+        elapsed = (time.time() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def write_rcfile(path, sections, keys):
+    with open(path, 'w') as rcfile:
+        rcfile.write('[DEFAULT]\ninstance_type = t2.small\n')
+        for section in range(sections):
+            rcfile.write('\n[env{}]\n'.format(section))
+            for key in range(keys):
+                rcfile.write('key{} = value{}\n'.format(key, key))
+        rcfile.write('\n[dev]\nprofile = bench\nassign_public_ip = true\n')
+
+
+# Keeps everything weatherman would write under ~/.weatherman in directory.
+def get_path_args(directory):
+    return [
+        '--registry-path', os.path.join(directory, 'registry.json'),
+        '--state-path', os.path.join(directory, 'state.json'),
+        '--platform-cache-path', os.path.join(directory, 'platforms.json'),
+        '--journal-path', os.path.join(directory, 'journal.jsonl'),
+        '--log-dir', os.path.join(directory, 'logs'),
+        '--project-dir', os.path.join(directory, 'projects'),
+        '--bundle-dir', os.path.join(directory, 'bundles'),
+        '--pool-path', os.path.join(directory, 'pool.json'),
+    ]
+
+
+# Answers the calls main makes through the api engine without AWS.
+class StubEBClient(object):
+
+    def describe_applications(self, ApplicationNames):
+        return {'Applications': [{'ApplicationName': ApplicationNames[0]}]}
+
+    def list_available_solution_stacks(self):
+        return {'SolutionStacks': sorted(weatherman.STACK_TYPE_MAP.values())}
+
+    def create_environment(self, **kwargs):
+        return {'EnvironmentName': kwargs['EnvironmentName']}
+
+    def describe_environments(self, EnvironmentNames, **kwargs):
+        return {'Environments': [{
+            'EnvironmentName': EnvironmentNames[0],
+            'Status': 'Ready',
+            'Health': 'Green',
+        }]}
+
+
+def use_fake_eb(directory, latency):
+    profile = os.path.join(directory, 'fake-eb.ini')
+    with open(profile, 'w') as fake_eb_profile:
+        fake_eb_profile.write('[DEFAULT]\nlatency = {}\n'.format(latency))
+    os.environ['WEATHERMAN_FAKE_EB_STATE'] = os.path.join(directory, 'state')
+    os.environ['WEATHERMAN_FAKE_EB_PROFILE'] = profile
+    return list2cmdline([sys.executable, weatherman.__file__, 'fake-eb'])
+
+
+def run_benchmarks(args):
+    results = {}
+    app = weatherman.App('benchapp', 'prod', '2', 'Python')
+    for shape, (config, passthrough_args) in sorted(CONFIG_SHAPES.items()):
+        results['build_eb_cli_command.{}'.format(shape)] = measure(
+            lambda: weatherman.build_eb_cli_command(
+                app, config, passthrough_args), number=2000)
+
+    pairs = [
+        (weatherman.App('app{}'.format(i % 50), env, str(i), 'Python'),
+         CONFIG_SHAPES['vpc'][0])
+        for i, env in enumerate(['dev', 'qa', 'prod'] * 1000)]
+    results['build_eb_cli_commands.3000'] = measure(
+        lambda: weatherman.build_eb_cli_commands(pairs), number=5)
+
+    results['app.10000'] = measure(
+        lambda: [weatherman.App('app', 'dev', str(i), 'Python')
+                 for i in range(10000)], number=5)
+
+    tmpdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        rcpath = os.path.join(tmpdir, 'weathermanrc')
+        write_rcfile(rcpath, args.rc_sections, args.rc_keys)
+        argv = ['benchapp', '--config-path', rcpath, '--dry-run']
+
+        def cold_load():
+            weatherman._config_files.clear()
+            weatherman.load_config(argv)
+
+        results['load_config.cold'] = measure(cold_load, number=3)
+        results['load_config.warm'] = measure(
+            lambda: weatherman.load_config(argv), number=500)
+
+        eb_path = use_fake_eb(tmpdir, args.eb_latency)
+        os.chdir(tmpdir)
+        versions = iter(range(1000000))
+        # eb create gets a copy of the source, which must not include the
+        # state weatherman keeps in tmpdir.
+        source_dir = os.path.join(tmpdir, 'src')
+        os.mkdir(source_dir)
+        with open(os.path.join(source_dir, 'application.py'), 'w') as source:
+            source.write('application = None\n')
+
+        def load_stack():
+            return weatherman.load_config([
+                'benchapp', '--config-path', rcpath, '--eb-path', eb_path,
+                '--eb-rate', '0', '--stack-version', str(next(versions)),
+                '--source-dir', source_dir] + get_path_args(tmpdir))
+
+        def run_main():
+            config, passthrough_args = load_stack()
+            weatherman.main(config, passthrough_args)
+
+        results['main.fake_eb'] = measure(run_main, repeat=3)
+        results['fleet.fake_eb.{}'.format(args.fleet_size)] = measure(
+            lambda: weatherman.run_fleet(
+                [load_stack() for _ in range(args.fleet_size)],
+                max_parallel=args.max_parallel),
+            repeat=1)
+
+        # Per-call latency of the engines: eb status through the fake eb,
+        # and the api engine against a stub client, both alone and for a
+        # whole create.
+        app = weatherman.App('benchapp', 'dev', '', 'Python')
+        config = load_stack()[0]
+        cli_engine = weatherman.CliEngine(
+            eb_path, log_dir=os.path.join(tmpdir, 'logs'))
+        api_engine = weatherman.ApiEngine(
+            client_factory=lambda app, config: StubEBClient(),
+            poll_interval=0)
+        results['engine.status.cli'] = measure(
+            lambda: cli_engine.status(app, config), number=3)
+        results['engine.status.api_stub'] = measure(
+            lambda: api_engine.status(app, config), number=200)
+        results['engine.main.api_stub'] = measure(
+            lambda: weatherman.main(load_stack()[0], [], api_engine),
+            number=20)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous and seconds > previous * (1 + threshold):
+            regressions.append((name, previous, seconds))
+    return regressions
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='Baseline JSON file to compare to')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed slowdown as a fraction (default 0.25)')
+    parser.add_argument('--rc-sections', type=int, default=500,
+                        help='Sections in the generated rc file')
+    parser.add_argument('--rc-keys', type=int, default=20,
+                        help='Keys per section in the generated rc file')
+    parser.add_argument('--eb-latency', type=float, default=0.0,
+                        help='Seconds the fake eb sleeps per call')
+    parser.add_argument('--fleet-size', type=int, default=50,
+                        help='Stacks created in the fleet benchmark')
+    parser.add_argument('--max-parallel', type=int, default=16,
+                        help='Concurrency of the fleet benchmark')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    results = run_benchmarks(args)
+    for name, seconds in sorted(results.items()):
+        print('{:<40} {:>12.3f} ms'.format(name, seconds * 1000))
+    report = {
+        'python': platform.python_version(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(
+                results, json.load(baseline)['results'], args.threshold)
+        for name, previous, seconds in regressions:
+            print('REGRESSION {}: {:.3f} ms -> {:.3f} ms'.format(
+                name, previous * 1000, seconds * 1000))
+        return int(bool(regressions))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
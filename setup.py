@@ -19,6 +19,7 @@ setup(
     entry_points={
         'console_scripts': [
             'weatherman = weatherman:dispatch',
+            'weatherman-fake-eb = weatherman:fake_eb',
         ],
     },
 )
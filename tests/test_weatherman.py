@@ -1,4 +1,21 @@
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+from multiprocessing.pool import ThreadPool
+from subprocess import check_call, list2cmdline
 from unittest import TestCase
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
 
 import weatherman
 
@@ -106,3 +123,2091 @@ class DefaultArgumentTestCase(TestCase):
 
     def test_default_stack_version(self):
         self.assertEqual(self.args['stack_version'], '')
+
+
+class FleetManifestTestCase(TestCase):
+    manifest = (
+        '[api]\n'
+        'envs = dev,qa\n'
+        'stack_versions = 1,2\n'
+        'instance_type = m3.medium\n'
+        'passthrough = --database\n'
+        '\n'
+        '[worker]\n'
+        'env = qa\n'
+    )
+
+    @classmethod
+    def setUpClass(cls):
+        handle, cls.path = tempfile.mkstemp()
+        with os.fdopen(handle, 'w') as manifest:
+            manifest.write(cls.manifest)
+        cls.stacks = list(weatherman.expand_manifest(cls.path))
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.path)
+
+    def test_expands_envs_and_versions(self):
+        self.assertEqual(
+            [(name, o['env'], o['stack_version'])
+             for name, o, _ in self.stacks],
+            [('api', 'dev', '1'), ('api', 'dev', '2'), ('api', 'qa', '1'),
+             ('api', 'qa', '2'), ('worker', 'qa', '')])
+
+    def test_keeps_overrides(self):
+        self.assertEqual(self.stacks[0][1]['instance_type'], 'm3.medium')
+
+    def test_passthrough_args(self):
+        self.assertEqual(self.stacks[0][2], ['--database'])
+        self.assertEqual(self.stacks[-1][2], [])
+
+    def test_dry_run_fleet(self):
+        self.assertEqual(weatherman.dispatch_fleet(
+            [self.path, '--config-path', '/nonexistent', '--dry-run',
+             '--max-parallel', '2']), 0)
+
+
+class StubEBClient(object):
+
+    def __init__(self):
+        self.applications = set()
+        self.environments = {}
+        self.calls = []
+
+    def describe_applications(self, ApplicationNames):
+        return {'Applications': [
+            {'ApplicationName': name} for name in ApplicationNames
+            if name in self.applications]}
+
+    def create_application(self, ApplicationName):
+        self.calls.append(('create_application', ApplicationName))
+        self.applications.add(ApplicationName)
+
+    def create_environment(self, **kwargs):
+        self.calls.append(('create_environment', kwargs))
+        self.environments[kwargs['EnvironmentName']] = {
+            'ApplicationName': kwargs['ApplicationName'],
+            'EnvironmentName': kwargs['EnvironmentName'],
+            'DateCreated': datetime.datetime.utcnow(),
+            'Status': 'Ready',
+            'Health': 'Green',
+        }
+
+    def terminate_environment(self, EnvironmentName):
+        self.calls.append(('terminate_environment', EnvironmentName))
+        self.environments[EnvironmentName]['Status'] = 'Terminating'
+
+    def update_environment(self, **kwargs):
+        self.calls.append(('update_environment', kwargs))
+
+    def swap_environment_cnames(self, **kwargs):
+        self.calls.append(('swap_environment_cnames', kwargs))
+
+    def list_available_solution_stacks(self):
+        return {'SolutionStacks': sorted(weatherman.STACK_TYPE_MAP.values())}
+
+    def describe_application_versions(self, ApplicationName, VersionLabels):
+        return {'ApplicationVersions': [
+            {'VersionLabel': label} for label in VersionLabels
+            if ('create_application_version', ApplicationName, label)
+            in self.calls]}
+
+    def create_storage_location(self):
+        return {'S3Bucket': 'elasticbeanstalk-test'}
+
+    def create_application_version(self, ApplicationName, VersionLabel,
+                                   SourceBundle):
+        self.calls.append(
+            ('create_application_version', ApplicationName, VersionLabel))
+
+    # Lists without EnvironmentNames come back a page of two at a time.
+    def describe_environments(self, ApplicationName=None,
+                              EnvironmentNames=None, IncludeDeleted=False,
+                              NextToken=None):
+        if EnvironmentNames is not None:
+            return {'Environments': [
+                self.environments[name] for name in EnvironmentNames
+                if name in self.environments]}
+        names = sorted(self.environments)
+        start = int(NextToken or 0)
+        page = {'Environments': [
+            self.environments[name] for name in names[start:start + 2]]}
+        if start + 2 < len(names):
+            page['NextToken'] = str(start + 2)
+        return page
+
+
+class StubS3Client(object):
+
+    def __init__(self):
+        self.objects = {}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise KeyError(Key)
+        return {}
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, 'rb') as bundle:
+            self.objects[(Bucket, Key)] = bundle.read()
+
+
+class ApiEngineTestCase(TestCase):
+    config = {
+        'appname': 'testapp',
+        'env': 'dev',
+        'stack_version': '2',
+        'stack_type': 'python34',
+        'dry_run': False,
+        'instance_type': 't2.small',
+        'vpc_id': 'vpcid',
+        'private_subnets': 'private1',
+        'notification_email': 'ops@example.com',
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = dict(
+            self.config,
+            registry_path=os.path.join(self.tmpdir, 'registry.json'),
+            state_path=os.path.join(self.tmpdir, 'state.json'),
+            platform_cache_path=os.path.join(self.tmpdir, 'platforms.json'))
+        self.client = StubEBClient()
+        self.engine = weatherman.ApiEngine(
+            client_factory=lambda app, config: self.client, poll_interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_main_creates_application_and_environment(self):
+        self.assertEqual(
+            weatherman.main(self.config, passthrough_args=[],
+                            engine=self.engine), 0)
+        self.assertEqual(self.client.calls[0],
+                         ('create_application', 'testapp'))
+        self.assertEqual(self.client.calls[1][1]['EnvironmentName'],
+                         'testapp-dev2')
+
+    def test_existing_application_is_not_created(self):
+        self.client.applications.add('testapp')
+        weatherman.main(self.config, passthrough_args=[], engine=self.engine)
+        self.assertNotIn(('create_application', 'testapp'), self.client.calls)
+
+    def test_option_settings(self):
+        weatherman.main(self.config, passthrough_args=[], engine=self.engine)
+        settings = dict(
+            ((s['Namespace'], s['OptionName']), s['Value'])
+            for s in self.client.calls[1][1]['OptionSettings'])
+        self.assertEqual(settings[
+            ('aws:autoscaling:launchconfiguration', 'InstanceType')],
+            't2.small')
+        self.assertEqual(settings[('aws:ec2:vpc', 'Subnets')], 'private1')
+        self.assertEqual(settings[('aws:ec2:vpc', 'ELBScheme')], 'internal')
+        self.assertEqual(settings[
+            ('aws:elasticbeanstalk:sns:topics', 'Notification Endpoint')],
+            'ops@example.com')
+
+    def test_no_update_after_create(self):
+        weatherman.main(self.config, passthrough_args=[], engine=self.engine)
+        self.assertEqual(
+            [call[0] for call in self.client.calls],
+            ['create_application', 'create_environment'])
+
+
+class CreateTimeOptionSettingsTestCase(BaseTestCase):
+    config = {
+        'notification_email': 'ops@example.com',
+        'option_settings': (
+            '\naws:autoscaling:asg/MinSize=2\n'
+            'aws:elasticbeanstalk:command/Timeout = 900'),
+    }
+
+    def test_includes_saved_config(self):
+        self.assertIn('--cfg=testapp-dev-weatherman', self.command)
+
+    def test_option_settings(self):
+        self.assertEqual(
+            [(s['Namespace'], s['OptionName'], s['Value'])
+             for s in weatherman.get_option_settings(self.config)],
+            [('aws:elasticbeanstalk:sns:topics', 'Notification Endpoint',
+              'ops@example.com'),
+             ('aws:autoscaling:asg', 'MinSize', '2'),
+             ('aws:elasticbeanstalk:command', 'Timeout', '900')])
+
+    def test_render_saved_config(self):
+        app = weatherman.App('testapp', 'dev', '', 'Python')
+        rendered = weatherman.render_saved_config(
+            app, weatherman.get_option_settings(self.config))
+        self.assertIn(
+            'OptionSettings:\n'
+            '  aws:elasticbeanstalk:sns:topics:\n'
+            '    Notification Endpoint: "ops@example.com"\n', rendered)
+
+    def test_invalid_option_setting(self):
+        self.assertRaises(ValueError, weatherman.get_option_settings,
+                          {'option_settings': 'MinSize=2'})
+
+
+class CountingEngine(object):
+
+    def __init__(self, project_initialized=True):
+        self.inits = 0
+        self.initialized = project_initialized
+
+    def project_initialized(self, app, config):
+        return self.initialized
+
+    def init(self, app, config):
+        self.inits += 1
+        return 0
+
+
+class AppRegistryTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'registry.json')
+        self.app = weatherman.App('testapp', 'dev', '', 'Python')
+        self.engine = CountingEngine()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_init_runs_once(self):
+        registry = weatherman.AppRegistry(self.path, 60)
+        for _ in range(3):
+            registry.ensure_initialized(self.app, {}, self.engine)
+        self.assertEqual(self.engine.inits, 1)
+
+    def test_registry_persists(self):
+        weatherman.AppRegistry(self.path, 60).ensure_initialized(
+            self.app, {}, self.engine)
+        weatherman.AppRegistry(self.path, 60).ensure_initialized(
+            self.app, {}, self.engine)
+        self.assertEqual(self.engine.inits, 1)
+
+    def test_expired_entries(self):
+        weatherman.AppRegistry(self.path, 0).ensure_initialized(
+            self.app, {}, self.engine)
+        weatherman.AppRegistry(self.path, 0).ensure_initialized(
+            self.app, {}, self.engine)
+        self.assertEqual(self.engine.inits, 2)
+
+    def test_refresh(self):
+        weatherman.AppRegistry(self.path, 60).ensure_initialized(
+            self.app, {}, self.engine)
+        registry = weatherman.AppRegistry(self.path, 60)
+        registry.ensure_initialized(self.app, {'refresh': True}, self.engine)
+        registry.ensure_initialized(self.app, {'refresh': True}, self.engine)
+        self.assertEqual(self.engine.inits, 2)
+
+    def test_uninitialized_project(self):
+        engine = CountingEngine(project_initialized=False)
+        registry = weatherman.AppRegistry(self.path, 60)
+        registry.ensure_initialized(self.app, {}, engine)
+        weatherman.AppRegistry(self.path, 60).ensure_initialized(
+            self.app, {}, engine)
+        self.assertEqual(engine.inits, 2)
+
+
+class GetEngineTestCase(TestCase):
+
+    def test_default_is_cli(self):
+        engine = weatherman.get_engine({'eb_path': '/opt/eb'})
+        self.assertIsInstance(engine, weatherman.CliEngine)
+        self.assertEqual(engine.eb, ['/opt/eb'])
+
+    def test_inprocess_falls_back_to_cli(self):
+        try:
+            import ebcli  # noqa
+        except ImportError:
+            self.assertIs(
+                type(weatherman.get_engine({'engine': 'inprocess'})),
+                weatherman.CliEngine)
+
+    def test_inprocess_serializes_eb(self):
+        configs = [{'engine': 'cli'}, {'engine': 'inprocess'}]
+        self.assertTrue(weatherman.serializes_eb(configs, 4))
+        self.assertFalse(weatherman.serializes_eb(configs, 1))
+        self.assertFalse(weatherman.serializes_eb(configs[:1], 4))
+
+
+class NowaitTestCase(BaseTestCase):
+    config = {'nowait': True}
+
+    def test_includes_nowait(self):
+        self.assertEqual(self.command[-1], '--nowait')
+
+
+class FakeStatuses(object):
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.polls = dict((name, 0) for name in statuses)
+
+    def __call__(self, stackname):
+        sequence = self.statuses[stackname]
+        status = sequence[min(self.polls[stackname], len(sequence) - 1)]
+        self.polls[stackname] += 1
+        if isinstance(status, Exception):
+            raise status
+        return status
+
+
+class EnvironmentWatcherTestCase(TestCase):
+    launching = {'Status': 'Launching', 'Health': 'Grey'}
+    ready = {'Status': 'Ready', 'Health': 'Green'}
+
+    def watch(self, statuses, deadline=None):
+        fake = FakeStatuses(statuses)
+        watcher = weatherman.EnvironmentWatcher(
+            fake, min_interval=0.001, max_interval=0.01, deadline=deadline)
+        return watcher.watch(list(statuses)), fake
+
+    def test_watches_until_ready(self):
+        results, fake = self.watch({
+            'api-dev': [self.launching, self.launching, self.ready],
+            'web-dev': [self.ready],
+        })
+        self.assertEqual(results['api-dev'], self.ready)
+        self.assertEqual(results['web-dev'], self.ready)
+        self.assertEqual(fake.polls, {'api-dev': 3, 'web-dev': 1})
+
+    def test_errors_keep_polling(self):
+        results, _ = self.watch({
+            'api-dev': [RuntimeError('throttled'), self.ready],
+        })
+        self.assertTrue(weatherman.is_healthy(results['api-dev']))
+
+    def test_repeated_errors_give_up(self):
+        stdout = sys.stdout
+        sys.stdout = weatherman.StringIO()
+        try:
+            results, fake = self.watch({
+                'api-dev': [RuntimeError('eb init failed for api-dev')],
+            })
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(results['api-dev']['Status'], 'Error')
+        self.assertFalse(weatherman.is_healthy(results['api-dev']))
+        self.assertEqual(fake.polls['api-dev'], weatherman.WATCH_MAX_ERRORS)
+        self.assertEqual(output.count('eb init failed for api-dev'), 1)
+
+    def test_deadline(self):
+        results, _ = self.watch({
+            'api-dev': [self.launching],
+            'web-dev': [self.ready],
+        }, deadline=0.05)
+        self.assertEqual(results['api-dev']['Status'], 'Timeout')
+        self.assertTrue(weatherman.is_healthy(results['web-dev']))
+
+    def test_red_is_unhealthy(self):
+        self.assertFalse(weatherman.is_healthy(
+            {'Status': 'Ready', 'Health': 'Red'}))
+
+    def test_parse_eb_status(self):
+        self.assertEqual(weatherman.parse_eb_status(
+            'Environment details for: api-dev\n'
+            '  Application name: api\n'
+            '  Status: Ready\n'
+            '  Health: Green\n'), self.ready)
+
+
+class LoadConfigTestCase(TestCase):
+    rcfile = (
+        '[DEFAULT]\n'
+        'instance_type = m3.medium\n'
+        'profile = shared\n'
+        '\n'
+        '[dev]\n'
+        'profile = devprofile\n'
+        'assign_public_ip = true\n'
+        'assign_elb_public_ip = no\n'
+        'registry_ttl = 60\n'
+    )
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        with os.fdopen(handle, 'w') as rcfile:
+            rcfile.write(self.rcfile)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def load(self, *argv):
+        return weatherman.load_config(
+            ['testapp', '--config-path', self.path] + list(argv))
+
+    def test_layers(self):
+        config, passthrough_args = self.load('--database')
+        self.assertEqual(config['appname'], 'testapp')
+        self.assertEqual(config['instance_type'], 'm3.medium')
+        self.assertEqual(config['profile'], 'devprofile')
+        self.assertEqual(config.stack_type, 'python34_2.0.6')
+        self.assertEqual(passthrough_args, ['--database'])
+
+    def test_typed_values(self):
+        config, _ = self.load()
+        self.assertIs(config['assign_public_ip'], True)
+        self.assertIs(config['assign_elb_public_ip'], False)
+        self.assertEqual(config['registry_ttl'], 60)
+
+    def test_cli_flags_win(self):
+        config, _ = self.load('--profile', 'cli', '--env', 'qa')
+        self.assertEqual(config['profile'], 'cli')
+        self.assertEqual(config['env'], 'qa')
+        self.assertIs(config['assign_public_ip'], False)
+
+    def test_compiled_file_is_cached(self):
+        first = weatherman.compile_config_file(self.path)
+        self.assertIs(weatherman.compile_config_file(self.path), first)
+        with open(self.path, 'a') as rcfile:
+            rcfile.write('ec2_keyname = key\n')
+        os.utime(self.path, (0, 0))
+        self.assertEqual(weatherman.compile_config_file(
+            self.path)['sections']['dev']['ec2_keyname'], 'key')
+
+    def test_invalid_value(self):
+        with open(self.path, 'a') as rcfile:
+            rcfile.write('nowait = sometimes\n')
+        os.utime(self.path, (1, 1))
+        self.assertRaises(ValueError, self.load)
+
+
+class CapacityProfileTestCase(TestCase):
+    rcfile = (
+        '[DEFAULT]\n'
+        'instance_type = m3.medium\n'
+        '\n'
+        '[prod]\n'
+        'capacity_profile = high-throughput\n'
+        '\n'
+        '[profile:high-throughput]\n'
+        'environment_type = LoadBalanced\n'
+        'load_balancer_type = application\n'
+        'min_instances = 4\n'
+        'max_instances = 12\n'
+        'scaling_metric = CPUUtilization\n'
+        'scaling_unit = Percent\n'
+        'upper_threshold = 60\n'
+        'breach_duration = 2\n'
+        'cross_zone = yes\n'
+    )
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        with os.fdopen(handle, 'w') as rcfile:
+            rcfile.write(self.rcfile)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def load(self, *argv):
+        return weatherman.load_config(
+            ['testapp', '--config-path', self.path] + list(argv))[0]
+
+    def test_selected_per_env(self):
+        self.assertNotIn('capacity', self.load())
+        config = self.load('--env', 'prod')
+        self.assertEqual(config['instance_type'], 'm3.medium')
+        settings = dict(
+            ((setting['Namespace'], setting['OptionName']), setting['Value'])
+            for setting in weatherman.get_option_settings(config))
+        self.assertEqual(settings, {
+            ('aws:elasticbeanstalk:environment', 'EnvironmentType'):
+                'LoadBalanced',
+            ('aws:elasticbeanstalk:environment', 'LoadBalancerType'):
+                'application',
+            ('aws:autoscaling:asg', 'MinSize'): '4',
+            ('aws:autoscaling:asg', 'MaxSize'): '12',
+            ('aws:elb:loadbalancer', 'CrossZone'): 'true',
+            ('aws:autoscaling:trigger', 'MeasureName'): 'CPUUtilization',
+            ('aws:autoscaling:trigger', 'Unit'): 'Percent',
+            ('aws:autoscaling:trigger', 'UpperThreshold'): '60',
+            ('aws:autoscaling:trigger', 'BreachDuration'): '2',
+        })
+
+    def test_rendered_into_create(self):
+        config = self.load('--env', 'prod', '--stack-type',
+                           weatherman.STACK_TYPE_MAP['python34'])
+        app = weatherman.App('testapp', 'prod', '', 'Python')
+        command = weatherman.build_eb_cli_command(app, config, [])
+        self.assertIn('--cfg=testapp-weatherman', command)
+        rendered = weatherman.render_saved_config(
+            app, weatherman.get_option_settings(config))
+        self.assertIn('  aws:autoscaling:asg:\n    MinSize: "4"\n', rendered)
+
+    def test_cli_selects_profile(self):
+        config = self.load('--capacity-profile', 'high-throughput')
+        self.assertEqual(config['capacity']['max_instances'], '12')
+        self.assertRaises(ValueError, self.load,
+                          '--capacity-profile', 'missing')
+
+    def test_unknown_key(self):
+        with open(self.path, 'a') as rcfile:
+            rcfile.write('max_size = 3\n')
+        os.utime(self.path, (1, 1))
+        self.assertRaises(ValueError, self.load)
+
+
+class BatchCommandTestCase(TestCase):
+    config = {
+        'vpc_id': 'vpcid',
+        'assign_elb_public_ip': True,
+        'public_subnets': 'public1',
+        'private_subnets': 'private1',
+        'db_engine': 'postgres',
+    }
+
+    def test_matches_single_builds(self):
+        apps = [weatherman.App('testapp', env, version, 'Python')
+                for env in ('dev', 'prod') for version in ('', '2')]
+        passthrough_args = ['--database']
+        self.assertEqual(
+            weatherman.build_eb_cli_commands(
+                [(app, self.config) for app in apps], passthrough_args),
+            [weatherman.build_eb_cli_command(
+                app, self.config, passthrough_args) for app in apps])
+
+    def test_prod_public_subnets(self):
+        app = weatherman.App('testapp', 'prod', '', 'Python')
+        command = weatherman.build_eb_cli_commands([(app, self.config)])[0]
+        self.assertEqual(command[5:], [
+            '--region=us-east-1',
+            '--vpc.id=vpcid',
+            '--vpc.elbpublic',
+            '--vpc.ec2subnets=public1',
+            '--vpc.publicip',
+        ])
+
+    def test_unset_options_are_not_resolved(self):
+        config, _ = weatherman.load_config(
+            ['testapp', '--config-path', '/nonexistent', '--dry-run'])
+        app = weatherman.get_app(config)
+        for argument in weatherman.build_eb_cli_command(app, config, []):
+            self.assertFalse(argument.endswith('=None'))
+
+
+class FakeEBTestCase(TestCase):
+    profile = (
+        '[create]\n'
+        'ready_after = 0\n'
+    )
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        with open('profile.ini', 'w') as profile:
+            profile.write(self.profile)
+        self.environ = os.environ.copy()
+        os.environ['WEATHERMAN_FAKE_EB_STATE'] = os.path.join(
+            self.tmpdir, 'state')
+        os.environ['WEATHERMAN_FAKE_EB_PROFILE'] = os.path.join(
+            self.tmpdir, 'profile.ini')
+        os.environ['WEATHERMAN_FAKE_EB_SEED'] = '1'
+        os.mkdir('src')
+        with open(os.path.join('src', 'application.py'), 'w') as source:
+            source.write('application = None\n')
+        self.config = {
+            'appname': 'testapp',
+            'env': 'dev',
+            'stack_type': 'python34',
+            'dry_run': False,
+            'source_dir': os.path.join(self.tmpdir, 'src'),
+            'bundle_dir': os.path.join(self.tmpdir, 'bundles'),
+            'registry_path': os.path.join(self.tmpdir, 'registry.json'),
+            'project_dir': os.path.join(self.tmpdir, 'projects'),
+            'state_path': os.path.join(self.tmpdir, 'state.json'),
+            'platform_cache_path': os.path.join(self.tmpdir, 'platforms.json'),
+            'eb_path': list2cmdline([
+                sys.executable, weatherman.__file__, 'fake-eb']),
+        }
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def test_main_against_fake_eb(self):
+        self.assertEqual(weatherman.main(self.config, []), 0)
+        app = weatherman.get_app(self.config)
+        engine = weatherman.get_engine(self.config)
+        self.assertEqual(engine.status(app, self.config),
+                         {'CNAME': 'testapp-dev.elasticbeanstalk.com',
+                          'Status': 'Ready', 'Health': 'Green'})
+
+    def reap(self, *args):
+        self.stdout = sys.stdout
+        sys.stdout = weatherman.StringIO()
+        try:
+            returncode = weatherman.dispatch([
+                'reap', '--stack-version', '[0-9]*', '--older-than', '0',
+                '--config-path', os.path.join(self.tmpdir, 'rc'),
+                '--eb-path', self.config['eb_path'], '--eb-rate', '0',
+                '--state-path', self.config['state_path'],
+                '--registry-path', self.config['registry_path'],
+                '--project-dir', self.config['project_dir'],
+                '--log-dir', os.path.join(self.tmpdir, 'logs'),
+                '--journal-path', os.path.join(self.tmpdir, 'journal.jsonl'),
+            ] + list(args))
+            return returncode, sys.stdout.getvalue()
+        finally:
+            sys.stdout = self.stdout
+
+    def test_reap(self):
+        for version in ('', '2'):
+            weatherman.main(dict(self.config, stack_version=version), [])
+        returncode, output = self.reap()
+        self.assertEqual(returncode, 1)
+        self.assertIn('pass --yes', output)
+        returncode, output = self.reap('--yes')
+        self.assertEqual(returncode, 0)
+        self.assertIn('Reclaimed 1 of 1 environments: testapp-dev2', output)
+        app = weatherman.get_app(self.config)
+        engine = weatherman.get_engine(self.config)
+        self.assertEqual(engine.status(app, self.config)['Status'], 'Ready')
+        app = weatherman.get_app(dict(self.config, stack_version='2'))
+        self.assertEqual(engine.status(app, self.config)['Status'],
+                         'Terminated')
+
+    def test_fleet_of_applications(self):
+        with open('profile.ini', 'w') as profile:
+            profile.write('[create]\nready_after = 1\n')
+        stacks = [(dict(self.config, appname=appname, env=env), [])
+                  for appname in ('api', 'web', 'worker')
+                  for env in ('dev', 'qa')]
+        start = time.time()
+        results = weatherman.run_fleet(stacks, max_parallel=6)
+        self.assertLess(time.time() - start, 4)
+        self.assertEqual([returncode for _, returncode, _ in results],
+                         [0] * 6)
+        for config, _ in stacks:
+            path = os.path.join(self.tmpdir, 'state', 'environments',
+                                weatherman.get_stackname(config) + '.json')
+            with open(path) as env:
+                self.assertEqual(json.load(env)['application'],
+                                 config['appname'])
+        project = weatherman.CliEngine().project_dir(
+            weatherman.get_app(stacks[0][0]), stacks[0][0])
+        self.assertTrue(os.path.exists(os.path.join(project,
+                                                    'application.py')))
+
+    def test_regions_in_parallel(self):
+        with open('profile.ini', 'w') as profile:
+            profile.write('[create]\nready_after = 2\n')
+        regions = ['us-east-1', 'eu-west-1', 'us-west-2', 'ap-southeast-2']
+        stacks = [(dict(self.config, region=region), []) for region in regions]
+        start = time.time()
+        results = weatherman.run_fleet(stacks, max_parallel=4,
+                                       group=weatherman.get_region)
+        self.assertLess(time.time() - start, 6)
+        self.assertEqual([returncode for _, returncode, _ in results],
+                         [0] * 4)
+        fake_eb = weatherman.FakeEB(os.path.join(self.tmpdir, 'state'))
+        for region in regions:
+            self.assertEqual(fake_eb.load('testapp-dev', region)['status'],
+                             'Ready')
+
+    def test_watch(self):
+        with open('profile.ini', 'w') as profile:
+            profile.write('[create]\nready_after = 1\n')
+        config = dict(self.config, nowait=True)
+        self.assertEqual(weatherman.main(config, []), 0)
+        self.stdout = sys.stdout
+        sys.stdout = weatherman.StringIO()
+        try:
+            returncode = weatherman.dispatch_watch([
+                'testapp-dev', '--eb-path', self.config['eb_path'],
+                '--min-interval', '0.1', '--deadline', '30'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = self.stdout
+        self.assertEqual(returncode, 0)
+        self.assertIn('Ready', output)
+        self.assertNotIn('Creating application', output)
+
+    def test_project_follows_region(self):
+        self.assertEqual(weatherman.main(self.config, []), 0)
+        config = dict(self.config, region='eu-west-1')
+        self.assertEqual(weatherman.main(config, []), 0)
+        engine = weatherman.get_engine(config)
+        app = weatherman.get_app(config)
+        path = os.path.join(engine.project_dir(app, config),
+                            '.elasticbeanstalk', 'config.yml')
+        with open(path) as cfg:
+            self.assertIn('default_region: eu-west-1\n', cfg.read())
+        self.assertTrue(engine.project_initialized(
+            weatherman.get_app(self.config), self.config))
+        self.assertEqual(engine.status(app, config)['Status'], 'Ready')
+        self.assertTrue(engine.project_initialized(app, config))
+
+    def test_nowait_waits_for_prerequisites(self):
+        with open('profile.ini', 'w') as profile:
+            profile.write('[create]\nready_after = 1\n')
+        stacks = [(dict(self.config, appname=appname, manifest_section=appname,
+                        depends_on=depends_on, nowait=True, min_interval=0.1),
+                   [])
+                  for appname, depends_on in (('api', ''), ('worker', 'api'))]
+        dependencies = weatherman.get_fleet_dependencies(
+            [config for config, _ in stacks])
+        results = weatherman.run_fleet(
+            stacks, 2, dependencies, weatherman.wait_for_prerequisites(
+                weatherman.main, stacks, dependencies))
+        self.assertEqual([returncode for _, returncode, _ in results], [0, 0])
+        envs = {}
+        for name in ('api-dev', 'worker-dev'):
+            with open(os.path.join(self.tmpdir, 'state', 'environments',
+                                   name + '.json')) as env:
+                envs[name] = json.load(env)
+        self.assertEqual(envs['api-dev']['status'], 'Ready')
+        self.assertEqual(envs['worker-dev']['status'], 'Launching')
+        self.assertGreaterEqual(envs['worker-dev']['created'],
+                                envs['api-dev']['ready_at'])
+
+    def test_duplicate_create_fails(self):
+        weatherman.main(self.config, [])
+        self.assertEqual(weatherman.main(self.config, []), 4)
+
+    def test_throttling(self):
+        with open('profile.ini', 'w') as profile:
+            profile.write('[DEFAULT]\nthrottle_rate = 1\n')
+        self.assertEqual(
+            weatherman.fake_eb(['init', 'testapp', '--region', 'us-east-1']),
+            4)
+
+    def test_throttled_init_is_retried(self):
+        with open('profile.ini', 'w') as profile:
+            profile.write('[init]\nthrottle_rate = 0.5\n')
+        del os.environ['WEATHERMAN_FAKE_EB_SEED']
+        config = dict(self.config, max_retries=10, retry_base_delay=0.001)
+        self.assertEqual(weatherman.main(config, []), 0)
+
+    def test_swap(self):
+        weatherman.main(self.config, [])
+        weatherman.main(dict(self.config, stack_version='2'), [])
+        engine = weatherman.get_engine(self.config)
+        app = weatherman.get_app(self.config)
+        self.assertEqual(engine.swap(app, self.config, 'testapp-dev2'), 0)
+        self.assertEqual(engine.status(app, self.config)['CNAME'],
+                         'testapp-dev2.elasticbeanstalk.com')
+
+    def test_failure_report(self):
+        config = dict(self.config, log_dir=os.path.join(self.tmpdir, 'logs'))
+        weatherman.main(config, [])
+        self.assertEqual(weatherman.main(config, []), 4)
+        output = weatherman.get_stack_output(
+            'testapp-dev', config['log_dir'])
+        self.assertIn('already exists', output.tail[-1])
+        with open(output.log_path) as log:
+            self.assertEqual(log.read().count('$ '), 3)
+
+    def test_create_timeout(self):
+        with open('profile.ini', 'w') as profile:
+            profile.write('[create]\nlatency = 30\n')
+        config = dict(self.config, create_timeout=0.5)
+        start = time.time()
+        self.assertEqual(weatherman.main(config, []),
+                         weatherman.TIMEOUT_EXIT)
+        self.assertLess(time.time() - start, 10)
+        state = weatherman.get_state_store(config).get('testapp-dev')
+        self.assertEqual((state['incomplete'], state['reason']),
+                         ('create', 'timeout'))
+        self.assertEqual(weatherman.plan_apply(
+            {'hash': 'a'}, state, {'Status': 'Ready'}), 'update')
+
+    def test_terminate(self):
+        weatherman.main(self.config, [])
+        self.assertEqual(weatherman.fake_eb(['terminate', 'testapp-dev']), 0)
+        self.assertEqual(weatherman.fake_eb(['terminate', 'missing']), 4)
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'metrics.jsonl')
+        self.textfile = os.path.join(self.tmpdir, 'weatherman.prom')
+        self.metrics = weatherman.Metrics(self.path, self.textfile)
+        self.app = weatherman.App('testapp', 'qa', '3', 'Python')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_json_lines(self):
+        with self.metrics.phase('create', self.app) as phase:
+            phase['exit_code'] = 4
+        with open(self.path) as output:
+            record = json.loads(output.readline())
+        self.assertEqual(record['phase'], 'create')
+        self.assertEqual(record['stackname'], 'testapp-qa3')
+        self.assertEqual(record['stack_version'], '3')
+        self.assertEqual(record['region'], 'us-east-1')
+        self.assertEqual(record['exit_code'], 4)
+        self.assertGreaterEqual(record['seconds'], 0)
+
+    def test_errors_are_recorded(self):
+        def fail():
+            with self.metrics.phase('init', self.app):
+                raise RuntimeError('boom')
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(self.metrics.records[0]['error'], 'boom')
+
+    def test_prometheus_textfile(self):
+        with self.metrics.phase('init', self.app):
+            pass
+        self.metrics.flush()
+        with open(self.textfile) as textfile:
+            rendered = textfile.read()
+        self.assertIn(
+            'weatherman_phase_duration_seconds{app="testapp",env="qa",'
+            'exit_code="0",phase="init",region="us-east-1",'
+            'stack_version="3"} ', rendered)
+        self.assertIn(
+            'weatherman_phase_seconds_bucket{le="+Inf",phase="init"} 1',
+            rendered)
+        self.assertIn('weatherman_phase_seconds_count{phase="init"} 1',
+                      rendered)
+
+    def test_config_load_does_not_list_platforms(self):
+        marker = os.path.join(self.tmpdir, 'eb-ran')
+        script = os.path.join(self.tmpdir, 'eb.py')
+        with open(script, 'w') as eb:
+            eb.write('open({!r}, "w").close()\n'.format(marker))
+        config, _ = weatherman.load_config_timed([
+            'testapp', '--config-path', '/nonexistent',
+            '--metrics-path', self.path,
+            '--eb-path', list2cmdline([sys.executable, script]),
+            '--platform-cache-path',
+            os.path.join(self.tmpdir, 'platforms.json')])
+        records = weatherman.get_metrics(config).records
+        self.assertEqual([record['phase'] for record in records],
+                         ['config_load'])
+        self.assertEqual(records[0]['stackname'], 'testapp-dev')
+        self.assertFalse(os.path.exists(marker))
+
+    def test_main_records_phases(self):
+        config = {
+            'appname': 'testapp',
+            'stack_type': 'python34',
+            'dry_run': False,
+            'metrics_path': self.path,
+            'registry_path': os.path.join(self.tmpdir, 'registry.json'),
+            'state_path': os.path.join(self.tmpdir, 'state.json'),
+            'platform_cache_path': os.path.join(self.tmpdir, 'platforms.json'),
+        }
+        engine = weatherman.ApiEngine(
+            client_factory=lambda app, config: StubEBClient(),
+            poll_interval=0)
+        weatherman.main(config, [], engine=engine)
+        with open(self.path) as output:
+            phases = [json.loads(line)['phase'] for line in output]
+        self.assertEqual(phases, ['command_build', 'init', 'create'])
+
+
+class RetryTestCase(TestCase):
+
+    def test_classify_failure(self):
+        self.assertIsNone(weatherman.classify_failure(0, 'Throttling'))
+        self.assertEqual(weatherman.classify_failure(
+            4, 'ERROR: Throttling: Rate exceeded\n'), 'throttled')
+        self.assertEqual(weatherman.classify_failure(
+            1, 'ERROR: ServiceUnavailable'), 'transient')
+        self.assertEqual(weatherman.classify_failure(
+            4, 'ERROR: Environment testapp-dev already exists.'), 'failed')
+
+    def test_token_bucket_limits_rate(self):
+        bucket = weatherman.TokenBucket(100, burst=1)
+        start = time.time()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.045)
+
+    def test_token_bucket_adapts(self):
+        bucket = weatherman.TokenBucket(8)
+        bucket.throttled()
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 2)
+        bucket.succeeded()
+        self.assertEqual(bucket.rate, 2.8)
+        for _ in range(20):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 8)
+
+    def test_retries_throttling(self):
+        outcomes = [(4, 'Rate exceeded'), (1, 'timed out'), (0, '')]
+        retrier = weatherman.Retrier(max_retries=5, base_delay=0)
+        self.assertEqual(retrier.call(lambda: outcomes.pop(0), 'eb'), 0)
+        self.assertEqual(outcomes, [])
+
+    def test_gives_up(self):
+        calls = []
+
+        def throttled():
+            calls.append(1)
+            return 4, 'Throttling'
+
+        retrier = weatherman.Retrier(max_retries=2, base_delay=0)
+        self.assertEqual(retrier.call(throttled, 'eb'), 4)
+        self.assertEqual(len(calls), 3)
+
+    def test_does_not_retry_failures(self):
+        outcomes = [(4, 'already exists'), (0, '')]
+        retrier = weatherman.Retrier(max_retries=5, base_delay=0)
+        self.assertEqual(retrier.call(lambda: outcomes.pop(0), 'eb'), 4)
+
+
+class CreateRetryTestCase(TestCase):
+    # eb create always fails with a transient error after counting the
+    # attempt; eb status finds the environment unless there is a missing
+    # file in the state directory.
+    script = (
+        'import os, sys\n'
+        'state, command = sys.argv[1:3]\n'
+        'if command == "init":\n'
+        '    os.makedirs(".elasticbeanstalk")\n'
+        '    with open(".elasticbeanstalk/config.yml", "w") as cfg:\n'
+        '        cfg.write("application_name: {}\\ndefault_region: {}\\n"'
+        '.format(sys.argv[3], sys.argv[-1]))\n'
+        'elif command == "create":\n'
+        '    with open(os.path.join(state, "creates"), "a") as creates:\n'
+        '        creates.write("x")\n'
+        '    sys.exit("ERROR: ServiceUnavailable")\n'
+        'elif os.path.exists(os.path.join(state, "missing")):\n'
+        '    sys.exit("ERROR: NotFoundError")\n'
+        'else:\n'
+        '    print("  Status: Launching")\n'
+    )
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        script = os.path.join(self.tmpdir, 'eb.py')
+        with open(script, 'w') as eb:
+            eb.write(self.script)
+        self.engine = weatherman.CliEngine(
+            [sys.executable, script, self.tmpdir],
+            weatherman.Retrier(max_retries=2, base_delay=0))
+        self.app = weatherman.App('testapp', 'dev', '', 'Python')
+        source_dir = os.path.join(self.tmpdir, 'src')
+        os.mkdir(source_dir)
+        self.config = {
+            'source_dir': source_dir,
+            'bundle_dir': os.path.join(self.tmpdir, 'bundles'),
+            'project_dir': os.path.join(self.tmpdir, 'projects'),
+        }
+        self.stdout = sys.stdout
+        sys.stdout = weatherman.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmpdir)
+
+    def create(self):
+        returncode = self.engine.create(
+            self.app, self.config, ['eb', 'create', 'testapp-dev'])
+        with open(os.path.join(self.tmpdir, 'creates')) as creates:
+            return returncode, len(creates.read())
+
+    def test_existing_environment_is_not_created_again(self):
+        self.assertEqual(self.create(), (1, 1))
+        self.assertIn('Not retrying eb create, testapp-dev is Launching.',
+                      sys.stdout.getvalue())
+
+    def test_missing_environment_is_retried(self):
+        open(os.path.join(self.tmpdir, 'missing'), 'w').close()
+        self.assertEqual(self.create(), (1, 3))
+
+    def test_password_prompt_needs_terminal(self):
+        self.assertTrue(weatherman.prompts_for_password(
+            ['eb', 'create', 'testapp-prod', '--database']))
+        self.assertFalse(weatherman.prompts_for_password(
+            ['eb', 'create', 'testapp-dev', '--database',
+             '--database.password=testappdev']))
+        self.assertEqual(self.engine.create(
+            self.app, self.config, ['eb', 'create', 'testapp-dev', '-db']), 1)
+        self.assertIn('needs a terminal', sys.stdout.getvalue())
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'creates')))
+
+    def test_attached_create(self):
+        self.assertEqual(self.engine.execute_attached(
+            ['create', 'testapp-dev'], cwd=self.tmpdir), (1, ''))
+        with open(os.path.join(self.tmpdir, 'creates')) as creates:
+            self.assertEqual(creates.read(), 'x')
+
+
+class FleetDependenciesTestCase(TestCase):
+
+    def stacks(self, *sections):
+        stacks = []
+        for section, env, depends_on in sections:
+            stacks.append(({
+                'appname': section,
+                'manifest_section': section,
+                'env': env,
+                'stack_type': 'python34',
+                'dry_run': True,
+                'depends_on': depends_on,
+            }, []))
+        return stacks
+
+    def test_dependencies_match_env(self):
+        stacks = self.stacks(
+            ('api', 'dev', ''), ('api', 'qa', ''),
+            ('worker', 'dev', 'api'), ('web', 'qa', 'api, worker'))
+        self.assertRaises(
+            ValueError, weatherman.get_fleet_dependencies,
+            [config for config, _ in stacks])
+        dependencies = weatherman.get_fleet_dependencies(
+            [config for config, _ in stacks[:3]])
+        self.assertEqual(dependencies, {2: set([0])})
+
+    def test_waves_and_critical_path(self):
+        dependencies = {1: set([0]), 2: set([0]), 3: set([1, 2]), 4: set()}
+        waves = weatherman.get_fleet_waves(5, dependencies)
+        self.assertEqual(waves, [[0, 4], [1, 2], [3]])
+        self.assertEqual(
+            weatherman.get_critical_path(waves, dependencies)[-1], 3)
+        self.assertEqual(
+            len(weatherman.get_critical_path(waves, dependencies)), 3)
+
+    def test_cycle(self):
+        self.assertRaises(ValueError, weatherman.get_fleet_waves,
+                          2, {0: set([1]), 1: set([0])})
+
+    def test_failures_skip_dependents(self):
+        stacks = self.stacks(
+            ('api', 'dev', ''), ('worker', 'dev', 'api'),
+            ('web', 'dev', 'worker'), ('other', 'dev', ''))
+        stacks[0][0]['stack_type'] = 'unknown'
+        dependencies = weatherman.get_fleet_dependencies(
+            [config for config, _ in stacks])
+        results = weatherman.run_fleet(stacks, 2, dependencies)
+        self.assertEqual([returncode for _, returncode, _ in results],
+                         [1, weatherman.SKIPPED, weatherman.SKIPPED, 0])
+
+    def test_dependents_run_after_prerequisites(self):
+        stacks = self.stacks(
+            ('api', 'dev', ''), ('worker', 'dev', 'api'))
+        results = weatherman.run_fleet(
+            stacks, 4, weatherman.get_fleet_dependencies(
+                [config for config, _ in stacks]))
+        self.assertEqual([returncode for _, returncode, _ in results], [0, 0])
+
+
+class ApplyTestCase(TestCase):
+    config = {
+        'appname': 'testapp',
+        'env': 'dev',
+        'stack_type': 'python34',
+        'dry_run': False,
+        'instance_type': 't2.small',
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = dict(
+            self.config,
+            registry_path=os.path.join(self.tmpdir, 'registry.json'),
+            state_path=os.path.join(self.tmpdir, 'state.json'),
+            platform_cache_path=os.path.join(self.tmpdir, 'platforms.json'))
+        self.client = StubEBClient()
+        self.engine = weatherman.ApiEngine(
+            client_factory=lambda app, config: self.client, poll_interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def apply(self, **changes):
+        del self.client.calls[:]
+        weatherman.apply_stack(
+            dict(self.config, **changes), [], engine=self.engine)
+        return [call[0] for call in self.client.calls]
+
+    def test_plan_apply(self):
+        desired = {'hash': 'a'}
+        ready = {'Status': 'Ready'}
+        self.assertEqual(weatherman.plan_apply(desired, None, None), 'create')
+        self.assertEqual(weatherman.plan_apply(
+            desired, {'hash': 'a'}, {'Status': 'Terminated'}), 'create')
+        self.assertEqual(weatherman.plan_apply(
+            desired, {'hash': 'a'}, ready), 'unchanged')
+        self.assertEqual(weatherman.plan_apply(
+            desired, {'hash': 'a'}, None), 'unchanged')
+        self.assertEqual(weatherman.plan_apply(
+            desired, {'hash': 'b'}, ready), 'update')
+        self.assertEqual(weatherman.plan_apply(desired, None, ready), 'update')
+
+    def test_reapply_is_skipped(self):
+        self.assertIn('create_environment', self.apply())
+        self.assertEqual(self.apply(), [])
+
+    def test_nowait_does_not_change_state(self):
+        self.apply()
+        self.assertEqual(self.apply(nowait=True), [])
+
+    def test_changes_are_updated(self):
+        self.apply()
+        self.assertEqual(self.apply(instance_type='m3.large'),
+                         ['update_environment'])
+        self.assertEqual(self.apply(instance_type='m3.large'), [])
+
+    def test_option_settings_are_updated(self):
+        self.apply()
+        self.assertEqual(self.apply(capacity={'min_instances': '2'}),
+                         ['update_environment'])
+        self.assertEqual(self.apply(capacity={'min_instances': '2'}), [])
+        self.assertEqual(
+            self.apply(capacity={'min_instances': '2'},
+                       option_settings='aws:autoscaling:asg/MaxSize=4'),
+            ['update_environment'])
+
+    def test_missing_stacks_are_recreated(self):
+        self.apply()
+        self.client.environments.clear()
+        self.assertIn('create_environment', self.apply())
+
+    def test_dry_run(self):
+        self.assertEqual(self.apply(dry_run=True), [])
+        self.assertIsNone(weatherman.get_state_store(self.config).get(
+            'testapp-dev'))
+
+
+class PlatformCatalogTestCase(TestCase):
+    platforms = [
+        '64bit Amazon Linux 2015.03 v1.3.1 running Python 3.4',
+        '64bit Amazon Linux 2015.09 v2.0.6 running Python 3.4',
+        '64bit Amazon Linux 2015.09 v2.0.6 running Python 2.7',
+        '64bit Debian jessie v1.1.0 running Python 3.4 '
+        '(Preconfigured - Docker)',
+        '64bit Amazon Linux 2015.09 v2.0.4 running Node.js',
+    ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'platforms.json')
+        self.loads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def loader(self, region):
+        self.loads.append(region)
+        return self.platforms
+
+    def failing_loader(self, region):
+        self.loads.append(region)
+        raise RuntimeError('eb platform list exited with 1')
+
+    def resolve(self, stack_type, catalog=None, loader=None):
+        catalog = catalog or weatherman.PlatformCatalog(self.path, 60)
+        return catalog.resolve(
+            stack_type, 'us-east-1', loader or self.loader)
+
+    def test_short_keys(self):
+        self.assertEqual(self.resolve('python34'), self.platforms[1])
+        self.assertEqual(self.resolve('python34_latest'), self.platforms[1])
+        self.assertEqual(self.resolve('python34_1.3.1'), self.platforms[0])
+        self.assertEqual(self.resolve('python34docker'), self.platforms[3])
+        self.assertEqual(self.resolve('nodejs'), self.platforms[4])
+        self.assertEqual(self.resolve('python'), self.platforms[1])
+
+    def test_solution_stack_names(self):
+        self.assertEqual(self.resolve(self.platforms[2]), self.platforms[2])
+        self.assertEqual(self.loads, [])
+
+    def test_dry_run_does_not_list_platforms(self):
+        config = {'stack_type': 'python34', 'dry_run': True,
+                  'platform_cache_path': self.path}
+        self.assertEqual(weatherman.get_platform(config, 'us-east-1'),
+                         weatherman.STACK_TYPE_MAP['python34'])
+        self.assertFalse(os.path.exists(self.path))
+        weatherman.PlatformCatalog(self.path, 0).index(
+            'us-east-1', self.loader)
+        self.assertEqual(weatherman.get_platform(config, 'us-east-1'),
+                         self.platforms[1])
+        self.assertEqual(self.loads, ['us-east-1'])
+
+    def test_catalog_is_cached(self):
+        catalog = weatherman.PlatformCatalog(self.path, 60)
+        self.resolve('python34', catalog)
+        self.resolve('nodejs', catalog)
+        self.resolve('python27', weatherman.PlatformCatalog(self.path, 60))
+        self.assertEqual(self.loads, ['us-east-1'])
+
+    def test_expired_catalog(self):
+        self.resolve('python34', weatherman.PlatformCatalog(self.path, 0))
+        self.resolve('python34', weatherman.PlatformCatalog(self.path, 0))
+        self.assertEqual(self.loads, ['us-east-1', 'us-east-1'])
+
+    def test_unavailable_catalog(self):
+        catalog = weatherman.PlatformCatalog(self.path, 60)
+        self.assertEqual(
+            self.resolve('python34_2.0.1', catalog, self.failing_loader),
+            weatherman.STACK_TYPE_MAP['python34_2.0.1'])
+        self.resolve('nodejs', catalog, self.failing_loader)
+        self.assertEqual(self.loads, ['us-east-1'])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_unknown_stack_type(self):
+        self.assertRaises(KeyError, self.resolve, 'cobol')
+
+    def test_fake_eb_platform_list(self):
+        engine = weatherman.CliEngine(
+            [sys.executable, weatherman.__file__, 'fake-eb'])
+        self.assertEqual(
+            sorted(engine.list_platforms('us-east-1', {})),
+            sorted(weatherman.STACK_TYPE_MAP.values()))
+
+
+class PlanTestCase(TestCase):
+    platform = '64bit Amazon Linux 2015.09 v2.0.6 running Python 3.4'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.tmpdir, 'weathermanrc')
+        with open(self.config_path, 'w') as config:
+            config.write('[DEFAULT]\nplatform_cache_path = {}\n'.format(
+                os.path.join(self.tmpdir, 'platforms.json')))
+        with open(os.path.join(self.tmpdir, 'platforms.json'), 'w') as cache:
+            json.dump({'us-east-1': {
+                'fetched': time.time(), 'platforms': [self.platform]}}, cache)
+        self.output = os.path.join(self.tmpdir, 'plan')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def plan(self, manifest, name, *args):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as output:
+            output.write(manifest)
+        returncode = weatherman.dispatch([
+            'plan', path, '--config-path', self.config_path,
+            '--output', self.output] + list(args))
+        with open(self.output) as plan:
+            return returncode, plan.read()
+
+    def records(self, manifest, name):
+        returncode, plan = self.plan(manifest, name)
+        self.assertEqual(returncode, 0)
+        return [json.loads(line) for line in plan.splitlines()]
+
+    def test_ini_manifest(self):
+        records = self.records(
+            '[DEFAULT]\ninstance_type = m3.large\n\n'
+            '[api]\nenvs = dev,qa\nstack_type = python34\n\n'
+            '[worker]\nappname = jobs\ndepends_on = api\n', 'fleet.ini')
+        self.assertEqual(
+            [(r['stackname'], r['section'], r['depends_on'])
+             for r in records],
+            [('api-dev', 'api', []), ('api-qa', 'api', []),
+             ('jobs-dev', 'worker', ['api'])])
+        self.assertEqual(records[0]['platform'], self.platform)
+        self.assertIn('--instance_type=m3.large', records[2]['command'])
+
+    def test_plan_does_not_run_eb(self):
+        marker = os.path.join(self.tmpdir, 'eb-ran')
+        script = os.path.join(self.tmpdir, 'eb.py')
+        with open(script, 'w') as eb:
+            eb.write('open({!r}, "w").close()\n'.format(marker))
+        os.remove(os.path.join(self.tmpdir, 'platforms.json'))
+        with open(self.config_path, 'a') as config:
+            config.write('eb_path = {}\n'.format(
+                list2cmdline([sys.executable, script])))
+        records = self.records('[api]\nstack_type = python34\n', 'fleet.ini')
+        self.assertEqual(records[0]['platform'],
+                         weatherman.STACK_TYPE_MAP['python34'])
+        self.assertFalse(os.path.exists(marker))
+
+    def test_csv_manifest(self):
+        records = self.records(
+            'appname,envs,instance_type\napi,"dev,prod",\nweb,qa,m3.large\n',
+            'fleet.csv')
+        self.assertEqual([r['stackname'] for r in records],
+                         ['api-dev', 'api', 'web-qa'])
+        self.assertIn('--instance_type=m3.large', records[2]['command'])
+
+    def test_jsonl_manifest(self):
+        records = self.records(
+            '{"appname": "api", "envs": ["dev", "qa"], '
+            '"passthrough": ["--database"]}\n\n'
+            '{"appname": "web", "notification_email": "ops@example.com"}\n',
+            'fleet.jsonl')
+        self.assertEqual([r['stackname'] for r in records],
+                         ['api-dev', 'api-qa', 'web-dev'])
+        self.assertIn('--database', records[0]['command'])
+        self.assertEqual(records[2]['option_settings'][0]['Value'],
+                         'ops@example.com')
+
+    def test_shell_plan(self):
+        returncode, plan = self.plan(
+            '[api]\nenvs = dev,qa\n[web]\n', 'fleet.ini', '--format', 'sh')
+        lines = plan.splitlines()
+        self.assertEqual(lines[0], '#!/bin/sh')
+        self.assertEqual(
+            [line.split()[:3] for line in lines if line.startswith('eb ')],
+            [['eb', 'init', 'api'], ['eb', 'create', 'api-dev'],
+             ['eb', 'create', 'api-qa'], ['eb', 'init', 'web'],
+             ['eb', 'create', 'web-dev']])
+        self.assertTrue(os.access(self.output, os.X_OK))
+
+    def test_invalid_entries_are_skipped(self):
+        returncode, plan = self.plan(
+            'appname,stack_type\nbad,cobol\nweb,\n', 'fleet.csv')
+        self.assertEqual(returncode, 1)
+        self.assertEqual(len(plan.splitlines()), 1)
+
+    def test_manifest_is_read_lazily(self):
+        def lines():
+            index = 0
+            while True:
+                index += 1
+                yield '{{"appname": "app{}"}}\n'.format(index)
+
+        stacks = weatherman.stream_manifest(lines())
+        self.assertEqual([next(stacks)[0] for _ in range(3)],
+                         ['app1', 'app2', 'app3'])
+
+
+class StandbyPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = {
+            'appname': 'testapp',
+            'env': 'dev',
+            'stack_type': 'python34',
+            'dry_run': False,
+            'pool_size': 2,
+            'pool_concurrency': 2,
+            'pool_path': os.path.join(self.tmpdir, 'pool.json'),
+            'registry_path': os.path.join(self.tmpdir, 'registry.json'),
+            'state_path': os.path.join(self.tmpdir, 'state.json'),
+            'platform_cache_path': os.path.join(self.tmpdir, 'platforms.json'),
+        }
+        self.client = StubEBClient()
+        self.engine = weatherman.ApiEngine(
+            client_factory=lambda app, config: self.client, poll_interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def created(self):
+        return [kwargs['EnvironmentName'] for call, kwargs in self.client.calls
+                if call == 'create_environment']
+
+    def test_refill(self):
+        self.assertEqual(
+            weatherman.refill_pool(self.config, [], self.engine), 0)
+        self.assertEqual(sorted(self.created()),
+                         ['testapp-dev-standby1', 'testapp-dev-standby2'])
+        weatherman.refill_pool(self.config, [], self.engine)
+        self.assertEqual(len(self.created()), 2)
+
+    def test_claim_and_refill(self):
+        weatherman.refill_pool(self.config, [], self.engine)
+        self.assertEqual(
+            weatherman.claim_standby(self.config, engine=self.engine), 0)
+        self.assertEqual(
+            weatherman.claim_standby(self.config, engine=self.engine), 0)
+        self.assertEqual(
+            weatherman.claim_standby(self.config, engine=self.engine), 1)
+        weatherman.refill_pool(self.config, [], self.engine)
+        self.assertEqual(self.created()[2:], [
+            'testapp-dev-standby3', 'testapp-dev-standby4'])
+
+    def test_claim_skips_unready_environments(self):
+        weatherman.refill_pool(self.config, [], self.engine)
+        first, second = sorted(self.created())
+        del self.client.environments[first]
+        self.client.environments[second]['Status'] = 'Launching'
+        self.assertEqual(
+            weatherman.claim_standby(self.config, engine=self.engine), 1)
+        self.client.environments[second]['Status'] = 'Ready'
+        self.assertEqual(
+            weatherman.claim_standby(self.config, engine=self.engine), 0)
+        weatherman.refill_pool(self.config, [], self.engine)
+        self.assertEqual(self.created()[2:], [
+            'testapp-dev-standby1', 'testapp-dev-standby3'])
+
+    def test_claim_swaps_cnames(self):
+        weatherman.refill_pool(self.config, [], self.engine)
+        weatherman.claim_standby(self.config, 'testapp-dev', self.engine)
+        self.assertEqual(self.client.calls[-1], ('swap_environment_cnames', {
+            'SourceEnvironmentName': 'testapp-dev-standby1',
+            'DestinationEnvironmentName': 'testapp-dev',
+        }))
+
+    def test_failed_creates_are_not_pooled(self):
+        self.client.create_environment = None
+        self.assertEqual(
+            weatherman.refill_pool(self.config, [], self.engine), 1)
+        self.assertEqual(
+            weatherman.claim_standby(self.config, engine=self.engine), 1)
+
+    def test_dry_run(self):
+        config = dict(self.config, dry_run=True)
+        weatherman.refill_pool(config, [], self.engine)
+        self.assertEqual(self.created(), [])
+        self.assertFalse(os.path.exists(self.config['pool_path']))
+
+
+class StackOutputTestCase(TestCase):
+    script = (
+        'import sys\n'
+        'for i in range(2000):\n'
+        '    sys.stdout.write("out %d\\n" % i)\n'
+        '    sys.stderr.write("err %d\\n" % i)\n'
+        'sys.exit(3)\n'
+    )
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = weatherman.StringIO(), weatherman.StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        shutil.rmtree(self.tmpdir)
+
+    def capture(self, output):
+        args = [sys.executable, '-c', self.script]
+        process = weatherman.Popen(
+            args, stdout=weatherman.PIPE, stderr=weatherman.PIPE,
+            universal_newlines=True)
+        return output.capture(process, args)
+
+    def test_capture(self):
+        output = weatherman.StackOutput('api-dev', self.tmpdir, 10)
+        returncode, tail = self.capture(output)
+        self.assertEqual(returncode, 3)
+        self.assertEqual(len(tail.splitlines()), 10)
+        self.assertEqual(len(output.tail), 10)
+        lines = sys.stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 2000)
+        self.assertEqual(lines[0], 'api-dev | out 0')
+        self.assertEqual(sys.stderr.getvalue().splitlines()[-1],
+                         'api-dev | err 1999')
+        with open(os.path.join(self.tmpdir, 'api-dev.log')) as log:
+            lines = [line for line in log.read().splitlines()
+                     if line.startswith(('out ', 'err '))]
+        self.assertEqual(len(lines), 4000)
+
+    def test_tail_is_kept_across_runs(self):
+        output = weatherman.StackOutput('api-dev', tail_lines=5)
+        self.capture(output)
+        self.assertEqual(len(self.capture(output)[1].splitlines()), 5)
+        self.assertEqual(len(output.tail), 5)
+        self.assertIsNone(output.log_path)
+
+
+class CancellationTestCase(TestCase):
+    # Starts a grandchild that would keep the pipes open if only the child
+    # were stopped.
+    script = (
+        'import subprocess, sys, time\n'
+        'subprocess.Popen([sys.executable, "-c", "import time; '
+        'time.sleep(30)"])\n'
+        'print("started")\n'
+        'sys.stdout.flush()\n'
+        'time.sleep(30)\n'
+    )
+
+    def setUp(self):
+        self.engine = weatherman.CliEngine([sys.executable, '-c'])
+
+    def tearDown(self):
+        weatherman.reset_cancellation()
+
+    def test_deadline_stops_process_group(self):
+        start = time.time()
+        returncode = self.engine.run(
+            [self.script], label='slow', deadline=time.time() + 1)
+        self.assertEqual(returncode, weatherman.TIMEOUT_EXIT)
+        self.assertLess(time.time() - start, 10)
+        self.assertIn('deadline', weatherman.get_stack_output('slow').tail[-1])
+
+    def test_cancel_running(self):
+        timer = threading.Timer(1, weatherman.cancel_running)
+        timer.start()
+        start = time.time()
+        self.assertRaises(
+            weatherman.Cancelled, self.engine.run, [self.script])
+        self.assertLess(time.time() - start, 10)
+        self.assertRaises(
+            weatherman.Cancelled, self.engine.run, ['pass'])
+
+    def test_eb_leads_its_session(self):
+        pool = ThreadPool(4)
+        try:
+            returncodes = pool.map(
+                lambda _: self.engine.run(
+                    ['import os, sys; sys.exit(os.getsid(0) != os.getpid())'],
+                    label='session'), range(8))
+        finally:
+            pool.close()
+        self.assertEqual(returncodes, [0] * 8)
+
+    def test_phase_deadline(self):
+        self.assertIsNone(weatherman.get_phase_deadline({}, 'create'))
+        deadline = weatherman.get_phase_deadline(
+            {'create_timeout': 60, 'run_deadline': time.time() + 5}, 'create')
+        self.assertLess(deadline, time.time() + 6)
+        config, _ = weatherman.load_config(
+            ['testapp', '--config-path', '/nonexistent',
+             '--run-timeout', '60'])
+        self.assertGreater(config['run_deadline'], time.time() + 50)
+
+
+class JournalTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'journal.jsonl')
+        self.journal = weatherman.Journal(self.path)
+        self.run = self.journal.start_run('fleet.ini', 'fleet')
+        self.config = {
+            'stack_type': 'python34',
+            'dry_run': False,
+            'journal_path': self.path,
+            'journal_run': self.run,
+            'registry_path': os.path.join(self.tmpdir, 'registry.json'),
+            'state_path': os.path.join(self.tmpdir, 'state.json'),
+            'platform_cache_path': os.path.join(self.tmpdir, 'platforms.json'),
+        }
+        self.client = StubEBClient()
+        self.engine = weatherman.ApiEngine(
+            client_factory=lambda app, config: self.client, poll_interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def events(self):
+        return [(entry.get('stackname'), entry.get('phase'), entry['event'])
+                for entry in self.journal.entries()]
+
+    def test_phases_are_journaled(self):
+        weatherman.main(dict(self.config, appname='api'), [], self.engine)
+        self.assertEqual(self.events(), [
+            (None, None, 'run'),
+            ('api-dev', 'init', 'started'),
+            ('api-dev', 'init', 'succeeded'),
+            ('api-dev', 'create', 'started'),
+            ('api-dev', 'create', 'succeeded'),
+        ])
+
+    def test_truncated_entries_are_skipped(self):
+        self.journal.record(self.run, 'api-dev', 'create', 'started')
+        with open(self.path, 'a') as journal:
+            journal.write('{"run": "')
+        self.assertEqual(
+            self.journal.replay(self.run), {'api-dev': {'create': 'started'}})
+
+    def test_find_run(self):
+        self.assertEqual(self.journal.find_run('fleet.ini', 'fleet'), self.run)
+        self.assertIsNone(self.journal.find_run('fleet.ini', 'apply'))
+        self.assertIsNone(self.journal.find_run('other.ini', 'fleet'))
+
+    def test_resume(self):
+        self.journal.record(self.run, 'done-dev', 'create', 'succeeded')
+        self.journal.record(self.run, 'running-dev', 'create', 'started')
+        self.journal.record(self.run, 'failed-dev', 'create', 'started')
+        self.journal.record(self.run, 'failed-dev', 'create', 'failed')
+        self.client.environments['running-dev'] = {
+            'Status': 'Ready', 'Health': 'Green'}
+        for appname in ('done', 'running', 'failed', 'new'):
+            self.assertEqual(weatherman.resume_stack(
+                dict(self.config, appname=appname), [], self.engine), 0)
+        self.assertEqual(
+            [kwargs['EnvironmentName'] for call, kwargs in self.client.calls
+             if call == 'create_environment'],
+            ['failed-dev', 'new-dev'])
+        self.assertIn('hash', weatherman.get_state_store(self.config).get(
+            'running-dev'))
+        self.assertIn(('running-dev', 'create', 'succeeded'), self.events())
+
+
+class RegionTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = {
+            'appname': 'testapp',
+            'env': 'dev',
+            'stack_type': 'python34',
+            'dry_run': False,
+            'region': 'eu-west-1',
+            'registry_path': os.path.join(self.tmpdir, 'registry.json'),
+            'state_path': os.path.join(self.tmpdir, 'state.json'),
+            'platform_cache_path': os.path.join(self.tmpdir, 'platforms.json'),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_app_region(self):
+        self.assertEqual(weatherman.App('api', 'dev', '', None).key, 'api-dev')
+        app = weatherman.App('api', 'dev', '', None, 'eu-west-1')
+        self.assertEqual(app.stackname, 'api-dev')
+        self.assertEqual(app.key, 'eu-west-1/api-dev')
+        self.assertEqual(weatherman.build_eb_init_command(app)[-1],
+                         'eu-west-1')
+
+    def test_create_command_targets_region(self):
+        self.config['dry_run'] = True
+        app = weatherman.get_app(self.config)
+        self.assertEqual(app.region, 'eu-west-1')
+        command = weatherman.build_eb_cli_command(app, self.config, [])
+        self.assertIn('--region=eu-west-1', command)
+        config = dict(self.config)
+        del config['region']
+        app = weatherman.get_app(config)
+        self.assertIn('--region=us-east-1',
+                      weatherman.build_eb_cli_command(app, config, []))
+        self.assertEqual(weatherman.get_eb_target_args(config),
+                         ['--region', 'us-east-1'])
+
+    def test_state_is_kept_per_region(self):
+        clients = {}
+
+        def client_factory(app, config):
+            return clients.setdefault(app.region, StubEBClient())
+
+        engine = weatherman.ApiEngine(client_factory, poll_interval=0)
+        for region in ('eu-west-1', 'us-west-2'):
+            config = dict(self.config, region=region)
+            self.assertEqual(weatherman.main(config, [], engine), 0)
+        self.assertEqual(sorted(clients), ['eu-west-1', 'us-west-2'])
+        store = weatherman.get_state_store(self.config)
+        self.assertIsNotNone(store.get('eu-west-1/testapp-dev'))
+        self.assertIsNotNone(store.get('us-west-2/testapp-dev'))
+
+    def test_manifest_regions(self):
+        path = os.path.join(self.tmpdir, 'fleet.ini')
+        with open(path, 'w') as manifest:
+            manifest.write('[api]\nregions = eu-west-1,us-west-2\n'
+                           '[web]\nregion = ap-southeast-2\n'
+                           '[worker]\ndepends_on = api\n')
+        stacks = list(weatherman.expand_manifest(
+            path, ['us-east-1', 'eu-west-1']))
+        self.assertEqual(
+            [(appname, overrides['region'])
+             for appname, overrides, _ in stacks],
+            [('api', 'eu-west-1'), ('api', 'us-west-2'),
+             ('web', 'ap-southeast-2'),
+             ('worker', 'us-east-1'), ('worker', 'eu-west-1')])
+        configs = [overrides for _, overrides, _ in stacks]
+        self.assertRaises(ValueError,
+                          weatherman.get_fleet_dependencies, configs)
+        self.assertEqual(
+            weatherman.get_fleet_dependencies(configs[:2] + configs[4:]),
+            {2: set([0])})
+
+    def test_region_limit(self):
+        lock = threading.Lock()
+        running = {}
+        peaks = {}
+
+        def run(config, passthrough_args):
+            region = config['region']
+            with lock:
+                running[region] = running.get(region, 0) + 1
+                peaks[region] = max(peaks.get(region, 0), running[region])
+            time.sleep(0.05)
+            with lock:
+                running[region] -= 1
+            return 0
+
+        stacks = [({'appname': 'app{}'.format(i), 'region': region}, [])
+                  for i in range(6) for region in ('eu-west-1', 'us-west-2')]
+        results = weatherman.run_fleet(
+            stacks, 8, run=run, group=weatherman.get_region, group_limit=2)
+        self.assertEqual(len(results), 12)
+        self.assertEqual(peaks, {'eu-west-1': 2, 'us-west-2': 2})
+
+
+class SourceBundleTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmpdir, 'src')
+        for name, contents in (('application.py', 'app = None\n'),
+                               ('static/site.css', 'body {}\n'),
+                               ('notes/todo.txt', 'later\n'),
+                               ('.git/HEAD', 'ref\n'),
+                               ('.ebignore', 'notes\n*.pyc\n'),
+                               ('cache.pyc', 'x')):
+            path = os.path.join(self.source_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as source:
+                source.write(contents)
+        self.config = {
+            'appname': 'testapp',
+            'env': 'dev',
+            'stack_type': 'python34',
+            'dry_run': False,
+            'bundle': True,
+            'source_dir': self.source_dir,
+            'bundle_dir': os.path.join(self.tmpdir, 'bundles'),
+            'registry_path': os.path.join(self.tmpdir, 'registry.json'),
+            'state_path': os.path.join(self.tmpdir, 'state.json'),
+            'platform_cache_path': os.path.join(self.tmpdir, 'platforms.json'),
+        }
+
+        self.stdout = sys.stdout
+        sys.stdout = weatherman.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmpdir)
+
+    def test_bundle_files(self):
+        self.assertEqual(weatherman.get_bundle_files(self.source_dir),
+                         ['.ebignore', 'application.py', 'static/site.css'])
+
+    def test_git_bundle_leaves_out_untracked_files(self):
+        source_dir = os.path.join(self.tmpdir, 'repo')
+        os.makedirs(source_dir)
+        for name, contents in (('application.py', 'app = None\n'),
+                               ('.env', 'SECRET=1\n')):
+            with open(os.path.join(source_dir, name), 'w') as source:
+                source.write(contents)
+        git = ['git', '-c', 'user.name=test', '-c', 'user.email=test@test']
+        for args in (['init', '-q'], ['add', 'application.py'],
+                     ['commit', '-q', '-m', 'app']):
+            check_call(git + args, cwd=source_dir)
+        bundles = weatherman.SourceBundles(self.config['bundle_dir'])
+        label, path = bundles.build(source_dir)
+        with zipfile.ZipFile(path) as bundle:
+            self.assertEqual(bundle.namelist(), ['application.py'])
+        with open(os.path.join(source_dir, 'application.py'), 'a') as source:
+            source.write('# not committed\n')
+        self.assertEqual(
+            weatherman.SourceBundles(self.config['bundle_dir']).label(
+                source_dir), label)
+
+    def test_bundle_is_content_addressed(self):
+        first = weatherman.SourceBundles(os.path.join(self.tmpdir, 'a'))
+        label, path = first.build(self.source_dir)
+        os.utime(os.path.join(self.source_dir, 'application.py'), (0, 0))
+        second = weatherman.SourceBundles(os.path.join(self.tmpdir, 'b'))
+        self.assertEqual(second.build(self.source_dir)[0], label)
+        with open(path, 'rb') as bundle, \
+                open(second.build(self.source_dir)[1], 'rb') as other:
+            self.assertEqual(bundle.read(), other.read())
+        with open(os.path.join(self.source_dir, 'application.py'), 'a') as f:
+            f.write('# changed\n')
+        third = weatherman.SourceBundles(os.path.join(self.tmpdir, 'c'))
+        self.assertNotEqual(third.build(self.source_dir)[0], label)
+
+    def test_dry_run_names_version(self):
+        config = dict(self.config, dry_run=True)
+        self.assertEqual(weatherman.main(config, []), 0)
+        label = weatherman.get_source_bundles(config).label(self.source_dir)
+        self.assertIn('--version={}'.format(label), sys.stdout.getvalue())
+        self.assertFalse(os.path.exists(config['bundle_dir']))
+
+    def test_uploads_once_per_region(self):
+        clients = {}
+        s3_clients = {}
+
+        def client_factory(app, config):
+            return clients.setdefault(app.region, StubEBClient())
+
+        def s3_client_factory(app, config):
+            return s3_clients.setdefault(app.region, StubS3Client())
+
+        engine = weatherman.ApiEngine(
+            client_factory, poll_interval=0,
+            s3_client_factory=s3_client_factory)
+        stacks = [(dict(self.config, appname=appname, env=env, region=region),
+                   [])
+                  for appname in ('api', 'web')
+                  for env in ('dev', 'qa')
+                  for region in ('us-east-1', 'eu-west-1')]
+        results = weatherman.run_fleet(
+            stacks, 4, run=lambda config, passthrough_args:
+            weatherman.main(config, passthrough_args, engine))
+        self.assertEqual([returncode for _, returncode, _ in results],
+                         [0] * 8)
+        self.assertEqual(sorted(clients), ['eu-west-1', 'us-east-1'])
+        for region in clients:
+            self.assertEqual(len(s3_clients[region].objects), 1)
+            published = [call for call in clients[region].calls
+                         if call[0] == 'create_application_version']
+            self.assertEqual(sorted(call[1] for call in published),
+                             ['api', 'web'])
+            label = published[0][2]
+            self.assertTrue(label.startswith('weatherman-'))
+            created = [call[1] for call in clients[region].calls
+                       if call[0] == 'create_environment']
+            self.assertEqual(len(created), 4)
+            for kwargs in created:
+                self.assertEqual(kwargs['VersionLabel'], label)
+
+    def test_version_is_not_hashed(self):
+        app = weatherman.App('api', 'dev', '', 'platform')
+        self.assertEqual(
+            weatherman.get_desired_state(app, ['eb', 'create', 'api-dev']),
+            weatherman.get_desired_state(
+                app, ['eb', 'create', 'api-dev', '--version=weatherman-1']))
+
+
+class TraceTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = {
+            'appname': 'testapp',
+            'env': 'dev',
+            'stack_type': 'python34',
+            'dry_run': False,
+            'trace_path': os.path.join(self.tmpdir, 'trace.json'),
+            'registry_path': os.path.join(self.tmpdir, 'registry.json'),
+            'state_path': os.path.join(self.tmpdir, 'state.json'),
+            'platform_cache_path': os.path.join(self.tmpdir, 'platforms.json'),
+        }
+        self.stdout = sys.stdout
+        sys.stdout = weatherman.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmpdir)
+
+    def test_disabled(self):
+        tracer = weatherman.Tracer()
+        with tracer.span('eb create', 'eb', 'api-dev'):
+            pass
+        tracer.flush()
+        self.assertEqual(tracer.events, [])
+
+    def test_eb_process_span(self):
+        tracer = weatherman.Tracer(self.config['trace_path'])
+        engine = weatherman.CliEngine(
+            [sys.executable, '-c', 'import sys; sys.exit(3)'],
+            log_dir=self.tmpdir, tracer=tracer)
+        self.assertEqual(engine.execute(['create'], label='api-dev')[0], 3)
+        event, = tracer.events
+        self.assertEqual(event['name'], 'eb create')
+        self.assertEqual(event['ph'], 'X')
+        self.assertEqual(event['args']['exit_code'], 3)
+        self.assertIn('pid', event['args'])
+
+    def test_run_trace(self):
+        tracer = weatherman.get_tracer(self.config)
+        engine = weatherman.ApiEngine(
+            lambda app, config: StubEBClient(), poll_interval=0,
+            tracer=tracer)
+        self.assertEqual(weatherman.main(self.config, [], engine), 0)
+        weatherman.flush_metrics([self.config])
+        with open(self.config['trace_path']) as trace:
+            events = json.load(trace)['traceEvents']
+        tracks = dict((event['args']['name'], event['tid'])
+                      for event in events if event['ph'] == 'M')
+        spans = dict((event['name'], event) for event in events
+                     if event['ph'] == 'X')
+        for name in ('command_build', 'init', 'create', 'create_environment'):
+            self.assertEqual(spans[name]['tid'], tracks['testapp-dev'])
+        create = spans['create']
+        call = spans['create_environment']
+        self.assertTrue(create['ts'] <= call['ts'])
+        self.assertTrue(call['ts'] + call['dur'] <=
+                        create['ts'] + create['dur'])
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        status = 500 if self.path == '/broken' else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    delay = 0
+
+
+class LoadProbeTestCase(TestCase):
+
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = {
+            'appname': 'testapp',
+            'env': 'dev',
+            'stack_type': 'python34',
+            'dry_run': False,
+            'probe_url': self.url,
+            'probe_path': '/health',
+            'probe_rate': 50,
+            'probe_duration': 0.4,
+            'probe_concurrency': 4,
+            'pool_size': 1,
+            'pool_path': os.path.join(self.tmpdir, 'pool.json'),
+            'registry_path': os.path.join(self.tmpdir, 'registry.json'),
+            'state_path': os.path.join(self.tmpdir, 'state.json'),
+            'platform_cache_path': os.path.join(self.tmpdir, 'platforms.json'),
+        }
+        self.client = StubEBClient()
+        self.engine = weatherman.ApiEngine(
+            client_factory=lambda app, config: self.client, poll_interval=0)
+        self.stdout = sys.stdout
+        sys.stdout = weatherman.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(weatherman.percentile(values, 0.5), 50)
+        self.assertEqual(weatherman.percentile(values, 0.99), 99)
+        self.assertEqual(weatherman.percentile([3], 0.95), 3)
+        self.assertIsNone(weatherman.percentile([], 0.5))
+
+    def test_probe(self):
+        result = weatherman.run_load_probe(
+            self.url + '/health', 50, 0.4, 4, 5)
+        self.assertEqual(result['requests'], 20)
+        self.assertEqual(result['error_rate'], 0)
+        self.assertTrue(result['p50'] <= result['p95'] <= result['p99'])
+        self.assertEqual(weatherman.check_probe(result, {}), [])
+
+    def test_errors_fail_the_stack(self):
+        config = dict(self.config, probe_path='/broken')
+        self.assertEqual(weatherman.main(config, [], self.engine), 1)
+        self.assertIn('error rate 100.0% is over 1.0%', sys.stdout.getvalue())
+
+    def test_latency_threshold(self):
+        self.server.delay = 0.05
+        self.assertEqual(weatherman.main(self.config, [], self.engine), 0)
+        config = dict(self.config, appname='other', probe_max_p95=10)
+        self.assertEqual(weatherman.main(config, [], self.engine), 1)
+        self.assertIn('p95', sys.stdout.getvalue().splitlines()[-1])
+
+    def test_swap_refused(self):
+        weatherman.refill_pool(self.config, [], self.engine)
+        config = dict(self.config, probe_path='/broken')
+        self.assertEqual(
+            weatherman.claim_standby(config, 'testapp-dev', self.engine), 1)
+        self.assertNotIn('swap_environment_cnames',
+                         [call[0] for call in self.client.calls])
+        self.assertIn('Not swapping testapp-dev-standby1 into testapp-dev',
+                      sys.stdout.getvalue())
+        pool = weatherman.get_standby_pool(config)
+        entry = pool.load()[pool.key(weatherman.get_app(config), config)]
+        self.assertEqual((list(entry['standby']), entry['claimed']),
+                         (['-standby1'], {}))
+        self.assertEqual(
+            weatherman.claim_standby(self.config, engine=self.engine), 0)
+
+
+class ReapTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = {
+            'dry_run': False,
+            'stack_type': 'python34',
+            'registry_path': os.path.join(self.tmpdir, 'registry.json'),
+            'state_path': os.path.join(self.tmpdir, 'state.json'),
+            'platform_cache_path': os.path.join(self.tmpdir, 'platforms.json'),
+        }
+        self.client = StubEBClient()
+        self.engine = weatherman.ApiEngine(
+            client_factory=lambda app, config: self.client, poll_interval=0)
+        self.stdout = sys.stdout
+        sys.stdout = weatherman.StringIO()
+        for appname, env, version in (('api', 'dev', ''), ('api', 'dev', '2'),
+                                      ('api', 'qa', '3'), ('api', 'prod', ''),
+                                      ('web', 'dev', '')):
+            weatherman.main(dict(self.config, appname=appname, env=env,
+                                 stack_version=version), [], self.engine)
+        self.client.create_environment(
+            ApplicationName='api', EnvironmentName='api-handmade-copy')
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmpdir)
+
+    def find(self, **kwargs):
+        stale, errors = weatherman.find_stale_environments(
+            self.config, self.engine, ['us-east-1'], **kwargs)
+        self.assertEqual(errors, [])
+        return [environment['name'] for environment in stale]
+
+    def test_parse_stackname(self):
+        parse = weatherman.parse_stackname
+        self.assertEqual(parse('api', 'api-dev'), ('dev', ''))
+        self.assertEqual(parse('api', 'api-qa12'), ('qa', '12'))
+        self.assertEqual(parse('api', 'api-dev-standby3'),
+                         ('dev', '-standby3'))
+        self.assertEqual(parse('api', 'api2'), ('prod', '2'))
+        self.assertEqual(parse('api', 'api-standby1'), ('prod', '-standby1'))
+        self.assertIsNone(parse('api', 'api-handmade-copy'))
+        self.assertIsNone(parse('api', 'apiary-dev'))
+        self.assertIsNone(parse('api', 'web-dev'))
+
+    def test_durations(self):
+        self.assertEqual(weatherman.parse_duration('90'), 90)
+        self.assertEqual(weatherman.parse_duration('12h'), 12 * 60 * 60)
+        self.assertEqual(weatherman.parse_duration('1.5d'), 36 * 60 * 60)
+        self.assertRaises(ValueError, weatherman.parse_duration, '3 days')
+        self.assertEqual(weatherman.format_age(36 * 60 * 60), '1.5d')
+        self.assertEqual(weatherman.format_age(None), '?')
+
+    def test_parse_eb_list(self):
+        output = ('Region: us-east-1\n'
+                  'Application: api\n'
+                  '    Environments: 2\n'
+                  '        api-dev : [\'i-1\']\n'
+                  '      * api-qa : []\n')
+        self.assertEqual(
+            [(environment['application'], environment['name'])
+             for environment in weatherman.parse_eb_list(output)],
+            [('api', 'api-dev'), ('api', 'api-qa')])
+
+    def test_patterns(self):
+        self.assertEqual(self.find(),
+                         ['api-dev', 'api-dev2', 'api-qa3', 'web-dev'])
+        self.assertEqual(self.find(app_pattern='api', env_pattern='*'),
+                         ['api', 'api-dev', 'api-dev2', 'api-qa3'])
+        self.assertEqual(self.find(version_pattern='[0-9]*'),
+                         ['api-dev2', 'api-qa3'])
+
+    def test_age(self):
+        self.assertEqual(self.find(older_than=3600), [])
+        self.assertEqual(
+            self.find(older_than=3600, now=time.time() + 7200),
+            ['api-dev', 'api-dev2', 'api-qa3', 'web-dev'])
+
+    def test_reap(self):
+        stacks = [(dict(self.config, appname='api', env='dev',
+                        stack_version=version, region='us-east-1'), [])
+                  for version in ('', '2')]
+        results = weatherman.run_fleet(
+            stacks, 2, run=lambda config, passthrough_args:
+            weatherman.reap_environment(config, engine=self.engine))
+        self.assertEqual([returncode for _, returncode, _ in results], [0, 0])
+        self.assertEqual(sorted(call[1] for call in self.client.calls
+                                if call[0] == 'terminate_environment'),
+                         ['api-dev', 'api-dev2'])
+        self.assertIsNone(
+            weatherman.get_state_store(self.config).get('api-dev'))
+        self.assertEqual(self.find(), ['api-qa3', 'web-dev'])
@@ -2,11 +2,80 @@ try:
     from ConfigParser import ConfigParser
 except ImportError:
     from configparser import ConfigParser
-from subprocess import Popen, list2cmdline
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from collections import deque
+from itertools import chain
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from subprocess import PIPE, STDOUT, Popen, list2cmdline
 import argparse
+import calendar
+import csv
+import errno
+import fnmatch
+import hashlib
+import json
+import math
 import os
+import random
+import re
+import shlex
+import shutil
+import signal
+import stat
+import sys
+import threading
+import time
+import zipfile
 
 
+DEFAULT_REGION = 'us-east-1'
+REGISTRY_TTL = 7 * 24 * 60 * 60
+FAKE_EB_STATE = '~/.weatherman/fake-eb'
+OUTPUT_TAIL_LINES = 50
+OUTPUT_LINE_LIMIT = 64 * 1024
+# Exit codes of phases that hit their deadline or were cancelled, as used by
+# timeout(1) and shells.
+TIMEOUT_EXIT = 124
+CANCELLED_EXIT = 130
+PROCESS_KILL_GRACE = 10
+# Popen arguments that start a process in a session of its own. eb runs
+# from worker threads, where running Python between fork and exec, as
+# preexec_fn does, can deadlock; Python 2 has nothing else.
+if sys.version_info[0] >= 3:
+    NEW_SESSION = {'start_new_session': True}
+else:
+    NEW_SESSION = {'preexec_fn': getattr(os, 'setsid', None)}
+PLATFORM_CACHE_TTL = 24 * 60 * 60
+# Standby environments use these stack_version slots, e.g. api-dev-standby1.
+POOL_SLOT = '-standby{}'
+POOL_CREATE_TIMEOUT = 60 * 60
+
+# Used when the platform catalog cannot be loaded.
 STACK_TYPE_MAP = {
     'python34': '64bit Amazon Linux 2015.03 v1.3.1 running Python 3.4',
     'python34_2.0.1': '64bit Amazon Linux 2015.03 v2.0.1 running Python 3.4',
@@ -17,7 +86,96 @@ STACK_TYPE_MAP = {
 }
 
 
-def build_eb_cli_command(app, config, passthrough_args):
+# Rules for turning config into eb create flags, applied in order. Each rule
+# is (conditions, flag, value). Conditions are config keys that must be
+# present, '?key' for truthy values, '!' to negate, 'prod' for prod stacks,
+# 'database' when --database is passed through and 'settings' when there are
+# option settings to apply. The value is a config key, '@dbname' for the
+# name+env database credentials, '@saved_config' for the saved configuration
+# name, '@region' for the stack's region or None for bare flags.
+EB_CLI_RULES = [
+    (('iam_profile',), '--instance_profile', 'iam_profile'),
+    (('ec2_keyname',), '--keyname', 'ec2_keyname'),
+    (('instance_type',), '--instance_type', 'instance_type'),
+    (('?profile',), '--profile', 'profile'),
+    # Always given, since the project's default region may be another one.
+    ((), '--region', '@region'),
+
+    (('vpc_id',), '--vpc.id', 'vpc_id'),
+    (('vpc_id', '?elb_subnets'), '--vpc.elbsubnets', 'elb_subnets'),
+    (('vpc_id', '?assign_elb_public_ip'), '--vpc.elbpublic', None),
+    (('vpc_id', '?assign_elb_public_ip', 'public_subnets', 'prod'),
+     '--vpc.ec2subnets', 'public_subnets'),
+    (('vpc_id', '?assign_elb_public_ip', 'public_subnets', 'prod'),
+     '--vpc.publicip', None),
+    (('vpc_id', '?assign_elb_public_ip', 'public_subnets', '!prod',
+      'private_subnets'),
+     '--vpc.ec2subnets', 'private_subnets'),
+    (('vpc_id', '!?assign_elb_public_ip', 'private_subnets'),
+     '--vpc.ec2subnets', 'private_subnets'),
+    (('vpc_id', '?assign_public_ip'), '--vpc.publicip', None),
+
+    (('database',), '--database.username', '@dbname'),
+    (('database', '?db_instance_class'),
+     '--database.instance', 'db_instance_class'),
+    (('database', '!prod', '!?prompt_db_password'),
+     '--database.password', '@dbname'),
+    (('database', '?db_engine'), '--database.engine', 'db_engine'),
+    (('database', '?db_version'), '--database.version', 'db_version'),
+    (('database', '?db_size'), '--database.size', 'db_size'),
+
+    (('settings',), '--cfg', '@saved_config'),
+    (('?nowait',), '--nowait', None),
+    (('?version_label',), '--version', 'version_label'),
+]
+DATABASE_FLAGS = frozenset(['-db', '--database'])
+
+
+# eb create asks for the database password when it is not given one.
+def prompts_for_password(command):
+    return bool(DATABASE_FLAGS.intersection(command)) and not any(
+        argument.startswith('--database.password') for argument in command)
+
+
+def compile_eb_cli_rules(rules):
+    compiled = []
+    for conditions, flag, value in rules:
+        checks = []
+        for condition in conditions:
+            negate = condition.startswith('!')
+            condition = condition.lstrip('!')
+            if condition in ('prod', 'database', 'settings'):
+                checks.append((negate, condition, None))
+            elif condition.startswith('?'):
+                checks.append((negate, 'truthy', condition[1:]))
+            else:
+                checks.append((negate, 'present', condition))
+        prefix = flag if value is None else flag + '='
+        compiled.append((tuple(checks), prefix, value))
+    return tuple(compiled)
+
+
+COMPILED_EB_CLI_RULES = compile_eb_cli_rules(EB_CLI_RULES)
+
+
+def _match_eb_cli_rules(config, facts):
+    matched_rules = []
+    for checks, prefix, value in COMPILED_EB_CLI_RULES:
+        for negate, kind, key in checks:
+            if kind == 'present':
+                matched = key in config
+            elif kind == 'truthy':
+                matched = bool(config.get(key))
+            else:
+                matched = facts[kind]
+            if matched == negate:
+                break
+        else:
+            matched_rules.append((prefix, value))
+    return matched_rules
+
+
+def _render_eb_cli_command(app, config, passthrough_args, matched_rules):
     ebargs = [
         'eb',
         'create',
@@ -25,249 +183,4271 @@ def build_eb_cli_command(app, config, passthrough_args):
         '--platform={}'.format(app.platform),
         '--debug',
     ] + passthrough_args
-    if 'iam_profile' in config:
-        ebargs.append(
-            '--instance_profile={}'.format(config.get('iam_profile')))
-    if 'ec2_keyname' in config:
-        ebargs.append('--keyname={}'.format(config.get('ec2_keyname')))
-    if 'instance_type' in config:
-        ebargs.append('--instance_type={}'.format(config.get('instance_type')))
-    if config.get('profile'):
-        ebargs.append('--profile={}'.format(config.get('profile')))
-
-    if 'vpc_id' in config:
-        ebargs.append('--vpc.id={}'.format(config.get('vpc_id')))
-        if config.get('elb_subnets'):
-            ebargs.append(
-                '--vpc.elbsubnets={}'.format(config.get('elb_subnets')))
-        if config.get('assign_elb_public_ip'):
-            ebargs.append('--vpc.elbpublic')
-            if 'public_subnets' in config:
-                if app.env == 'prod':
-                    ebargs.append(
-                        '--vpc.ec2subnets={}'.format(config.get('public_subnets')))
-                    ebargs.append('--vpc.publicip')
-                elif 'private_subnets' in config:
-                    ebargs.append('--vpc.ec2subnets={}'.format(
-                        config.get('private_subnets')))
-        elif 'private_subnets' in config:
-            ebargs.append('--vpc.ec2subnets={}'.format(
-                config.get('private_subnets')))
-        if config.get('assign_public_ip'):
-            ebargs.append('--vpc.publicip')
-
-    if set(['-db', '--database']).intersection(set(passthrough_args)):
-        ebargs.append(
-            '--database.username={}'.format(''.join([app.name, app.env])))
-        if config.get('db_instance_class'):
-            ebargs.append(
-                '--database.instance={}'.format(
-                    config.get('db_instance_class')))
-        if app.env != 'prod' and not config.get('prompt_db_password'):
-            ebargs.append(
-                '--database.password={}'.format(''.join([app.name, app.env])))
-        if config.get('db_engine'):
-            ebargs.append(
-                '--database.engine={}'.format(
-                    config.get('db_engine')))
-        if config.get('db_version'):
-            ebargs.append(
-                '--database.version={}'.format(
-                    config.get('db_version')))
-        if config.get('db_size'):
-            ebargs.append(
-                '--database.size={}'.format(
-                    config.get('db_size')))
+    for prefix, value in matched_rules:
+        if value is None:
+            ebargs.append(prefix)
+        elif value == '@dbname':
+            ebargs.append(prefix + ''.join([app.name, app.env]))
+        elif value == '@saved_config':
+            ebargs.append(prefix + get_saved_config_name(app))
+        elif value == '@region':
+            ebargs.append(prefix + app.region)
+        else:
+            ebargs.append('{}{}'.format(prefix, config.get(value)))
     return ebargs
 
 
-def init_eb_environment(app):
-    print('Creating application {}.'.format(app.name))
-    process = Popen([
+def build_eb_cli_command(app, config, passthrough_args):
+    matched_rules = _match_eb_cli_rules(config, {
+        'prod': app.env == 'prod',
+        'database': bool(DATABASE_FLAGS.intersection(passthrough_args)),
+        'settings': bool(get_option_settings(config)),
+    })
+    return _render_eb_cli_command(
+        app, config, passthrough_args, matched_rules)
+
+
+# Matching only depends on the config and whether the stack is prod, so a
+# batch that shares config objects matches the rules once per config.
+def build_eb_cli_commands(pairs, passthrough_args=None):
+    passthrough_args = list(passthrough_args or [])
+    database = bool(DATABASE_FLAGS.intersection(passthrough_args))
+    matches = {}
+    commands = []
+    for app, config in pairs:
+        key = (id(config), app.env == 'prod')
+        if key not in matches:
+            # Keep config referenced so its id is not reused in this batch.
+            matches[key] = (config, _match_eb_cli_rules(config, {
+                'prod': key[1],
+                'database': database,
+                'settings': bool(get_option_settings(config)),
+            }))
+        commands.append(_render_eb_cli_command(
+            app, config, passthrough_args, matches[key][1]))
+    return commands
+
+
+# eb create flags that map onto Elastic Beanstalk option settings, used by
+# engines that talk to the EB API instead of running eb.
+EB_CREATE_OPTIONS = {
+    '--instance_profile': (
+        'aws:autoscaling:launchconfiguration', 'IamInstanceProfile'),
+    '--keyname': ('aws:autoscaling:launchconfiguration', 'EC2KeyName'),
+    '--instance_type': ('aws:autoscaling:launchconfiguration', 'InstanceType'),
+    '--vpc.id': ('aws:ec2:vpc', 'VPCId'),
+    '--vpc.elbsubnets': ('aws:ec2:vpc', 'ELBSubnets'),
+    '--vpc.ec2subnets': ('aws:ec2:vpc', 'Subnets'),
+    '--vpc.elbpublic': ('aws:ec2:vpc', 'ELBScheme'),
+    '--vpc.publicip': ('aws:ec2:vpc', 'AssociatePublicIpAddress'),
+    '--database.username': ('aws:rds:dbinstance', 'DBUser'),
+    '--database.password': ('aws:rds:dbinstance', 'DBPassword'),
+    '--database.instance': ('aws:rds:dbinstance', 'DBInstanceClass'),
+    '--database.engine': ('aws:rds:dbinstance', 'DBEngine'),
+    '--database.version': ('aws:rds:dbinstance', 'DBEngineVersion'),
+    '--database.size': ('aws:rds:dbinstance', 'DBAllocatedStorage'),
+}
+EB_CREATE_FLAG_VALUES = {
+    '--vpc.elbpublic': 'public',
+    '--vpc.publicip': 'true',
+}
+# Flags that only affect the eb CLI itself, or that engines read from the
+# config instead.
+EB_CLI_ONLY_FLAGS = set([
+    '--platform', '--debug', '--profile', '--database', '-db', '--nowait',
+    '--cfg', '--version', '--region',
+])
+
+
+def build_eb_init_command(app):
+    return [
         'eb', 'init',
         app.name,
         '--platform', app.platform,
         '--region', app.region,
-    ])
-    process.wait()
+    ]
 
 
-class App(object):
-    def __init__(self, name, env, stack_version, platform):
-        self.name = name
-        self.env = env
-        if env == 'prod':
-            self.stackname = '{}{}'.format(name, stack_version)
+def init_eb_environment(app):
+    return CliEngine().init(app, {})
+
+
+def build_option_settings(command):
+    settings = []
+    unused = []
+    for argument in command[3:]:
+        flag, _, value = argument.partition('=')
+        if flag in EB_CREATE_OPTIONS:
+            namespace, option = EB_CREATE_OPTIONS[flag]
+            settings.append({
+                'Namespace': namespace,
+                'OptionName': option,
+                'Value': value or EB_CREATE_FLAG_VALUES[flag],
+            })
+        elif flag not in EB_CLI_ONLY_FLAGS:
+            unused.append(argument)
+    options = set((s['Namespace'], s['OptionName']) for s in settings)
+    if (('aws:ec2:vpc', 'VPCId') in options and
+            ('aws:ec2:vpc', 'ELBScheme') not in options):
+        settings.append({
+            'Namespace': 'aws:ec2:vpc',
+            'OptionName': 'ELBScheme',
+            'Value': 'internal',
+        })
+    return settings, unused
+
+
+# Keys of [profile:name] sections in the config file and the option
+# settings they set when an environment is created.
+CAPACITY_OPTIONS = [
+    ('environment_type',
+     'aws:elasticbeanstalk:environment', 'EnvironmentType'),
+    ('load_balancer_type',
+     'aws:elasticbeanstalk:environment', 'LoadBalancerType'),
+    ('min_instances', 'aws:autoscaling:asg', 'MinSize'),
+    ('max_instances', 'aws:autoscaling:asg', 'MaxSize'),
+    ('availability_zones', 'aws:autoscaling:asg', 'Availability Zones'),
+    ('cooldown', 'aws:autoscaling:asg', 'Cooldown'),
+    ('cross_zone', 'aws:elb:loadbalancer', 'CrossZone'),
+    ('scaling_metric', 'aws:autoscaling:trigger', 'MeasureName'),
+    ('scaling_statistic', 'aws:autoscaling:trigger', 'Statistic'),
+    ('scaling_unit', 'aws:autoscaling:trigger', 'Unit'),
+    ('scaling_period', 'aws:autoscaling:trigger', 'Period'),
+    ('breach_duration', 'aws:autoscaling:trigger', 'BreachDuration'),
+    ('evaluation_periods', 'aws:autoscaling:trigger', 'EvaluationPeriods'),
+    ('upper_threshold', 'aws:autoscaling:trigger', 'UpperThreshold'),
+    ('upper_increment',
+     'aws:autoscaling:trigger', 'UpperBreachScaleIncrement'),
+    ('lower_threshold', 'aws:autoscaling:trigger', 'LowerThreshold'),
+    ('lower_increment',
+     'aws:autoscaling:trigger', 'LowerBreachScaleIncrement'),
+]
+CAPACITY_PROFILE_PREFIX = 'profile:'
+
+
+def compile_capacity_profile(name, values):
+    known = [key for key, _, _ in CAPACITY_OPTIONS]
+    unknown = sorted(set(values) - set(known))
+    if unknown:
+        raise ValueError(
+            'Unknown keys {} in capacity profile {!r}, expected some of '
+            '{}'.format(', '.join(unknown), name, ', '.join(known)))
+    profile = dict(values)
+    if 'cross_zone' in profile:
+        try:
+            cross_zone = parse_bool(profile['cross_zone'])
+        except ValueError:
+            raise ValueError(
+                'Invalid value {!r} for cross_zone in capacity profile '
+                '{!r}'.format(profile['cross_zone'], name))
+        profile['cross_zone'] = str(cross_zone).lower()
+    return profile
+
+
+def get_capacity_settings(profile):
+    return [{
+        'Namespace': namespace,
+        'OptionName': option,
+        'Value': profile[key],
+    } for key, namespace, option in CAPACITY_OPTIONS if key in profile]
+
+
+def get_option_settings(config):
+    settings = get_capacity_settings(config.get('capacity') or {})
+    if config.get('notification_email'):
+        settings.append({
+            'Namespace': 'aws:elasticbeanstalk:sns:topics',
+            'OptionName': 'Notification Endpoint',
+            'Value': config.get('notification_email'),
+        })
+    lines = (config.get('option_settings') or '').replace(';', '\n')
+    for line in lines.splitlines():
+        if not line.strip():
+            continue
+        name, _, value = line.partition('=')
+        namespace, _, option = name.strip().rpartition('/')
+        if not namespace or not option:
+            raise ValueError(
+                'Option settings must look like namespace/OptionName=value, '
+                'got {!r}'.format(line))
+        settings.append({
+            'Namespace': namespace,
+            'OptionName': option,
+            'Value': value.strip(),
+        })
+    return settings
+
+
+def get_saved_config_name(app):
+    if app.region != DEFAULT_REGION:
+        return '{}-{}-weatherman'.format(app.stackname, app.region)
+    return '{}-weatherman'.format(app.stackname)
+
+
+def render_saved_config(app, settings):
+    lines = [
+        'AWSConfigurationTemplateVersion: 1.1.0.0',
+        'EnvironmentConfigurationMetadata:',
+        '  Description: {}'.format(json.dumps(
+            'Created by weatherman for {}'.format(app.stackname))),
+        'SolutionStack: {}'.format(json.dumps(app.platform)),
+        'OptionSettings:',
+    ]
+    namespaces = []
+    for setting in settings:
+        if setting['Namespace'] not in namespaces:
+            namespaces.append(setting['Namespace'])
+    for namespace in namespaces:
+        lines.append('  {}:'.format(namespace))
+        for setting in settings:
+            if setting['Namespace'] == namespace:
+                lines.append('    {}: {}'.format(
+                    setting['OptionName'], json.dumps(setting['Value'])))
+    return '\n'.join(lines) + '\n'
+
+
+# eb create --cfg uploads a local saved configuration from this directory
+# and applies it while the environment is created.
+def write_saved_config(app, settings, directory='.elasticbeanstalk'):
+    saved_configs = os.path.join(directory, 'saved_configs')
+    if not os.path.isdir(saved_configs):
+        os.makedirs(saved_configs)
+    path = os.path.join(
+        saved_configs, '{}.cfg.yml'.format(get_saved_config_name(app)))
+    with open(path, 'w') as saved_config:
+        saved_config.write(render_saved_config(app, settings))
+    return path
+
+
+THROTTLING_ERRORS = (
+    'throttling', 'rate exceeded', 'requestlimitexceeded',
+    'toomanyrequests', 'slowdown',
+)
+TRANSIENT_ERRORS = (
+    'serviceunavailable', 'internalfailure', 'internalerror',
+    'requesttimeout', 'connection reset', 'connection aborted',
+    'timed out', 'could not connect', 'endpointconnectionerror',
+)
+
+
+def classify_failure(returncode, stderr):
+    if returncode == 0:
+        return None
+    text = stderr.lower().replace(' ', '')
+    if any(error.replace(' ', '') in text for error in THROTTLING_ERRORS):
+        return 'throttled'
+    if any(error.replace(' ', '') in text for error in TRANSIENT_ERRORS):
+        return 'transient'
+    return 'failed'
+
+
+# Token bucket shared by every eb call in the process. The refill rate
+# backs off on throttling and creeps back up to max_rate on success, so a
+# bulk run settles just under what the account allows.
+class TokenBucket(object):
+    def __init__(self, rate, burst=1, min_rate=None):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.min_rate = min_rate or self.max_rate / 16
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.max_rate:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+class Retrier(object):
+    def __init__(self, limiter=None, max_retries=0, base_delay=2,
+                 max_delay=60):
+        self.limiter = limiter or TokenBucket(0)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.random = random.Random()
+
+    def backoff(self, attempt):
+        return self.random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    # func returns (returncode, stderr); retries throttled and transient
+    # failures with full jitter exponential backoff, unless the backoff would
+    # run past deadline or retry_if, when given, returns False.
+    def call(self, func, label, deadline=None, retry_if=None):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            returncode, stderr = func()
+            failure = classify_failure(returncode, stderr)
+            if failure == 'throttled':
+                self.limiter.throttled()
+            elif failure is None:
+                self.limiter.succeeded()
+            if (failure not in ('throttled', 'transient') or
+                    attempt >= self.max_retries):
+                return returncode
+            delay = self.backoff(attempt)
+            if deadline is not None and time.time() + delay >= deadline:
+                return returncode
+            if retry_if is not None and not retry_if():
+                return returncode
+            attempt += 1
+            print('{} {}, retrying in {:.1f}s ({}/{}).'.format(
+                label, failure, delay, attempt, self.max_retries))
+            time.sleep(delay)
+
+
+_limiters = {}
+
+
+def get_retrier(config):
+    key = (float(config.get('eb_rate') or 0), int(config.get('eb_burst') or 1))
+    with _shared_lock:
+        if key not in _limiters:
+            _limiters[key] = TokenBucket(*key)
+    return Retrier(
+        _limiters[key],
+        max_retries=int(config.get('max_retries') or 0),
+        base_delay=float(config.get('retry_base_delay') or 2),
+        max_delay=float(config.get('retry_max_delay') or 60),
+    )
+
+
+class Cancelled(Exception):
+    pass
+
+
+_cancelled = threading.Event()
+_processes = set()
+_processes_lock = threading.Lock()
+_terminal_lock = threading.Lock()
+
+
+# SIGTERM, then SIGKILL for process groups that outlive the grace period.
+def terminate_processes(processes, grace=PROCESS_KILL_GRACE):
+    for sig in (signal.SIGTERM, getattr(signal, 'SIGKILL', None)):
+        running = [process for process in processes if process.poll() is None]
+        if not running or sig is None:
+            return
+        for process in running:
+            try:
+                if hasattr(os, 'killpg'):
+                    os.killpg(process.pid, sig)
+                else:
+                    process.terminate()
+            except OSError:
+                pass
+        give_up = time.time() + grace
+        while time.time() < give_up and any(
+                process.poll() is None for process in running):
+            time.sleep(0.1)
+
+
+# Stops every eb child of this process; their phases raise Cancelled and
+# no new eb command starts until reset_cancellation().
+def cancel_running():
+    _cancelled.set()
+    with _processes_lock:
+        processes = list(_processes)
+    terminate_processes(processes)
+
+
+def reset_cancellation():
+    _cancelled.clear()
+
+
+def raise_cancelled(signum, frame):
+    raise Cancelled('Received signal {}'.format(signum))
+
+
+def get_phase_deadline(config, phase):
+    deadlines = []
+    timeout = config.get('{}_timeout'.format(phase))
+    if timeout:
+        deadlines.append(time.time() + float(timeout))
+    if config.get('run_deadline'):
+        deadlines.append(float(config.get('run_deadline')))
+    return min(deadlines) if deadlines else None
+
+
+_output_lock = threading.Lock()
+_stack_outputs = {}
+
+
+# Output of the eb processes of one stack: echoed with the stack name in
+# front of every line, kept in a bounded ring for failure reports and
+# appended in full to a per-stack log file. Each pipe has its own reader
+# thread, so a child never blocks on a full pipe.
+class StackOutput(object):
+    def __init__(self, label, log_dir=None, tail_lines=OUTPUT_TAIL_LINES):
+        self.label = label
+        self.tail = deque(maxlen=tail_lines)
+        self.lock = threading.Lock()
+        self.log_dir = log_dir
+        self.log_path = None
+        if log_dir:
+            self.log_path = os.path.join(
+                os.path.expanduser(log_dir), '{}.log'.format(label))
+            directory = os.path.dirname(self.log_path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def drain(self, pipe, stream, log, captured):
+        for line in iter(lambda: pipe.readline(OUTPUT_LINE_LIMIT), ''):
+            if not line.endswith('\n'):
+                line += '\n'
+            with self.lock:
+                captured.append(line)
+                self.tail.append(line)
+                if log is not None:
+                    log.write(line)
+            with _output_lock:
+                stream.write('{} | {}'.format(self.label, line))
+                stream.flush()
+        pipe.close()
+
+    # Returns the exit code and the last lines of this process's output,
+    # or TIMEOUT_EXIT once its process group was stopped at the deadline.
+    def capture(self, process, args, deadline=None):
+        captured = deque(maxlen=self.tail.maxlen)
+        log = open(self.log_path, 'a') if self.log_path else None
+        timed_out = False
+        try:
+            if log is not None:
+                log.write('$ {}\n'.format(list2cmdline(args)))
+            readers = [
+                threading.Thread(target=self.drain, args=(
+                    process.stdout, sys.stdout, log, captured)),
+                threading.Thread(target=self.drain, args=(
+                    process.stderr, sys.stderr, log, captured)),
+            ]
+            for reader in readers:
+                reader.daemon = True
+                reader.start()
+            for reader in readers:
+                while reader.is_alive():
+                    if deadline is not None and time.time() >= deadline:
+                        timed_out = True
+                        terminate_processes([process])
+                    reader.join(0.5)
+        except BaseException:
+            terminate_processes([process])
+            raise
+        finally:
+            if log is not None:
+                log.close()
+        returncode = process.wait()
+        if _cancelled.is_set():
+            raise Cancelled('{} was cancelled'.format(self.label))
+        if timed_out:
+            message = 'ERROR: {} exceeded its deadline\n'.format(args[1])
+            with self.lock:
+                self.tail.append(message)
+            captured.append(message)
+            return TIMEOUT_EXIT, ''.join(captured)
+        return returncode, ''.join(captured)
+
+
+def get_stack_output(label, log_dir=None, tail_lines=OUTPUT_TAIL_LINES):
+    with _shared_lock:
+        output = _stack_outputs.get(label)
+        if (output is None or output.log_dir != log_dir or
+                output.tail.maxlen != tail_lines):
+            output = _stack_outputs[label] = StackOutput(
+                label, log_dir, tail_lines)
+        return output
+
+
+# eb picks the region of the project that eb init last wrote unless told,
+# so a configured region is always passed along.
+def get_eb_target_args(config):
+    args = []
+    if config.get('profile'):
+        args += ['--profile', config.get('profile')]
+    return args + ['--region', get_region(config)]
+
+
+_project_locks = {}
+
+
+def get_project_lock(directory):
+    with _shared_lock:
+        if directory not in _project_locks:
+            _project_locks[directory] = threading.RLock()
+        return _project_locks[directory]
+
+
+class CliEngine(object):
+    def __init__(self, eb='eb', retrier=None, log_dir=None,
+                 tail_lines=OUTPUT_TAIL_LINES, tracer=None):
+        self.eb = shlex.split(eb) if isinstance(eb, str) else list(eb)
+        self.retrier = retrier or Retrier()
+        self.log_dir = log_dir
+        self.tail_lines = tail_lines
+        self.tracer = tracer or Tracer()
+
+    # eb reads the application and region from .elasticbeanstalk/config.yml
+    # in its working directory, which eb init rewrites, and eb create uploads
+    # that directory. Every application, region and profile gets a project
+    # directory of its own, so stacks only wait for each other while one of
+    # them sets it up.
+    def project_dir(self, app, config):
+        return os.path.join(
+            os.path.expanduser(
+                config.get('project_dir') or '~/.weatherman/projects'),
+            app.region, config.get('profile') or 'default', app.name)
+
+    @contextmanager
+    def project(self, app, config):
+        directory = self.project_dir(app, config)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with get_project_lock(directory):
+            yield directory
+
+    # eb create reads the application and region from the project's eb
+    # config, which only eb init writes.
+    def project_initialized(self, app, config):
+        path = os.path.join(self.project_dir(app, config),
+                            '.elasticbeanstalk', 'config.yml')
+        try:
+            with open(path) as cfg:
+                project = cfg.read()
+        except IOError:
+            return False
+        return ('application_name: {}\n'.format(app.name) in project and
+                'default_region: {}\n'.format(app.region) in project)
+
+    # Initializes the project of the app if needed and runs prepare on it.
+    # Returns the exit code of eb init and the project directory.
+    def prepare_project(self, app, config, prepare=None):
+        with self.project(app, config) as cwd:
+            returncode = 0
+            if not self.project_initialized(app, config):
+                returncode = self.init(app, config)
+            if returncode == 0 and prepare is not None:
+                prepare(cwd)
+            return returncode, cwd
+
+    def run_in_project(self, app, config, args, deadline=None, prepare=None,
+                       retry_if=None):
+        returncode, cwd = self.prepare_project(app, config, prepare)
+        if returncode:
+            return returncode
+        return self.run(args, label=app.key, deadline=deadline, cwd=cwd,
+                        retry_if=retry_if)
+
+    def run(self, args, env=None, label=None, deadline=None, cwd=None,
+            retry_if=None):
+        return self.retrier.call(
+            lambda: self.execute(args, env, label, deadline, cwd),
+            'eb {}'.format(args[0]), deadline, retry_if)
+
+    # Each eb runs in its own process group, so stopping it also stops
+    # anything it started. The tail of the output is returned for
+    # classify_failure.
+    def execute(self, args, env=None, label=None, deadline=None, cwd=None):
+        if _cancelled.is_set():
+            raise Cancelled('Not starting eb {}'.format(args[0]))
+        output = get_stack_output(
+            label or args[0], self.log_dir, self.tail_lines)
+        with self.tracer.span('eb {}'.format(args[0]), 'eb',
+                              label or args[0]) as span:
+            process = Popen(self.eb + args, env=env, stdout=PIPE,
+                            stderr=PIPE, universal_newlines=True, cwd=cwd,
+                            **NEW_SESSION)
+            span.update(pid=process.pid, argv=list2cmdline(args))
+            with _processes_lock:
+                _processes.add(process)
+            try:
+                result = output.capture(process, self.eb + args, deadline)
+            except KeyboardInterrupt:
+                raise Cancelled('eb {} was interrupted'.format(args[0]))
+            finally:
+                with _processes_lock:
+                    _processes.discard(process)
+            span['exit_code'] = result[0]
+            return result
+
+    # eb prompts on the terminal, so it runs attached to it, in this process
+    # group and one at a time, with its output going straight there.
+    def execute_attached(self, args, label=None, cwd=None):
+        if _cancelled.is_set():
+            raise Cancelled('Not starting eb {}'.format(args[0]))
+        with _terminal_lock, self.tracer.span(
+                'eb {}'.format(args[0]), 'eb', label or args[0]) as span:
+            process = Popen(self.eb + args, cwd=cwd)
+            span.update(pid=process.pid, argv=list2cmdline(args))
+            with _processes_lock:
+                _processes.add(process)
+            try:
+                returncode = process.wait()
+            except KeyboardInterrupt:
+                raise Cancelled('eb {} was interrupted'.format(args[0]))
+            finally:
+                with _processes_lock:
+                    _processes.discard(process)
+            span['exit_code'] = returncode
+            return returncode, ''
+
+    def init(self, app, config):
+        print('Creating application {}.'.format(app.name))
+        with self.project(app, config) as cwd:
+            return self.run(build_eb_init_command(app)[1:], label=app.key,
+                            deadline=get_phase_deadline(config, 'init'),
+                            cwd=cwd)
+
+    def create(self, app, config, command):
+        def prepare(cwd):
+            settings = get_option_settings(config)
+            if settings:
+                write_saved_config(
+                    app, settings, os.path.join(cwd, '.elasticbeanstalk'))
+            if not config.get('version_label'):
+                copy_source(config, cwd)
+
+        if prompts_for_password(command):
+            if not sys.stdin.isatty():
+                print('eb create {} prompts for the database password, '
+                      'which needs a terminal.'.format(app.stackname))
+                return 1
+            returncode, cwd = self.prepare_project(app, config, prepare)
+            if returncode:
+                return returncode
+            return self.retrier.call(
+                lambda: self.execute_attached(command[1:], app.key, cwd),
+                'eb create')
+        return self.run_in_project(
+            app, config, command[1:], get_phase_deadline(config, 'create'),
+            prepare, lambda: self.create_is_missing(app, config))
+
+    # eb create can fail after the environment was created, and running it
+    # again would then fail or start a second create, so it is only retried
+    # once the environment is known not to exist.
+    def create_is_missing(self, app, config):
+        try:
+            status = self.status(app, config)
+        except RuntimeError as exc:
+            print('Not retrying eb create, unable to check {}: {}'.format(
+                app.stackname, exc))
+            return False
+        if status.get('Status') in ('Missing', 'Terminated'):
+            return True
+        print('Not retrying eb create, {} is {}.'.format(
+            app.stackname, status.get('Status')))
+        return False
+
+    def update(self, app, config, command):
+        settings = build_option_settings(command)[0]
+        args = ['config', app.stackname, '--cfg', get_saved_config_name(app)]
+        args += get_eb_target_args(config)
+        return self.run_in_project(
+            app, config, args, get_phase_deadline(config, 'update'),
+            lambda cwd: write_saved_config(
+                app, settings + get_option_settings(config),
+                os.path.join(cwd, '.elasticbeanstalk')))
+
+    def swap(self, app, config, destination):
+        args = ['swap', app.stackname, '--destination_name', destination]
+        args += get_eb_target_args(config)
+        return self.run_in_project(app, config, args)
+
+    def terminate(self, app, config):
+        args = ['terminate', app.stackname, '--force']
+        args += get_eb_target_args(config)
+        if config.get('nowait'):
+            args.append('--nowait')
+        return self.run_in_project(app, config, args)
+
+    # eb list does not show when environments were created.
+    def list_environments(self, region, config):
+        args = self.eb + ['list', '--all', '--verbose', '--region', region]
+        if config.get('profile'):
+            args += ['--profile', config.get('profile')]
+        self.retrier.limiter.acquire()
+        with self.tracer.span('eb list', 'eb', region):
+            process = Popen(args, stdout=PIPE, stderr=PIPE,
+                            universal_newlines=True)
+            output, errors = process.communicate()
+        if process.returncode:
+            raise RuntimeError('eb list exited with {}: {}'.format(
+                process.returncode, errors.strip()))
+        return parse_eb_list(output)
+
+    # eb can only upload a version as part of create or deploy, so bundles
+    # are published through the API. Without boto3 eb create uploads the
+    # project itself.
+    def publish_version(self, app, config, label, bundle_path):
+        if boto3 is None:
+            print('boto3 is not installed, eb create will upload the '
+                  'source of {}.'.format(app.key))
+            return None
+        return ApiEngine(
+            retrier=self.retrier, tracer=self.tracer).publish_version(
+            app, config, label, bundle_path)
+
+    def list_platforms(self, region, config):
+        args = self.eb + ['platform', 'list', '--verbose', '--region', region]
+        if config.get('profile'):
+            args += ['--profile', config.get('profile')]
+        self.retrier.limiter.acquire()
+        with self.tracer.span('eb platform', 'eb', region):
+            process = Popen(args, stdout=PIPE, stderr=PIPE,
+                            universal_newlines=True)
+            output, errors = process.communicate()
+        if process.returncode:
+            raise RuntimeError('eb platform list exited with {}: {}'.format(
+                process.returncode, errors.strip()))
+        return [line.strip() for line in output.splitlines()
+                if SOLUTION_STACK_RE.match(line.strip())]
+
+    def status(self, app, config):
+        args = self.eb + ['status', app.stackname]
+        args += get_eb_target_args(config)
+        # Stacks watched by name alone run in the current directory, since
+        # weatherman does not know their application.
+        cwd = None
+        if app.platform is not None:
+            returncode, cwd = self.prepare_project(app, config)
+            if returncode:
+                raise RuntimeError('eb init failed for {}'.format(app.key))
+        self.retrier.limiter.acquire()
+        with self.tracer.span('eb status', 'eb', app.key):
+            process = Popen(args, stdout=PIPE, stderr=PIPE, cwd=cwd,
+                            universal_newlines=True)
+            output, errors = process.communicate()
+        if classify_failure(process.returncode, errors) == 'throttled':
+            self.retrier.limiter.throttled()
+        if process.returncode and 'NotFoundError' in errors:
+            return {'Status': 'Missing'}
+        if process.returncode:
+            raise RuntimeError('eb status exited with {}: {}'.format(
+                process.returncode, errors.strip()))
+        return parse_eb_status(output)
+
+
+class InProcessEngine(CliEngine):
+    # awsebcli reads the working directory and environment globally, so only
+    # one command may run at a time per process. Commands run in this
+    # process cannot be stopped, so deadlines only limit retries.
+    lock = threading.Lock()
+
+    def __init__(self, retrier=None, tracer=None):
+        from ebcli.core.ebcore import EB
+        self.app_class = EB
+        self.eb = ['eb']
+        self.retrier = retrier or Retrier()
+        self.tracer = tracer or Tracer()
+
+    # Commands run in this process already share its terminal.
+    def execute_attached(self, args, label=None, cwd=None):
+        return self.execute(args, label=label, cwd=cwd)
+
+    def execute(self, args, env=None, label=None, deadline=None, cwd=None):
+        with self.lock, self.tracer.span(
+                'eb {}'.format(args[0]), 'eb', label or args[0]):
+            saved_env = os.environ.copy()
+            saved_cwd = os.getcwd()
+            if env is not None:
+                os.environ.clear()
+                os.environ.update(env)
+            try:
+                if cwd is not None:
+                    os.chdir(cwd)
+                ebapp = self.app_class(argv=args)
+                ebapp.setup()
+                ebapp.run()
+                ebapp.close()
+            except SystemExit as exc:
+                if exc.code is None:
+                    return 0, ''
+                if isinstance(exc.code, int):
+                    return exc.code, ''
+                return 1, str(exc.code)
+            except Exception as exc:
+                print('eb {} failed: {}'.format(args[0], exc))
+                return 1, '{}: {}'.format(type(exc).__name__, exc)
+            finally:
+                os.chdir(saved_cwd)
+                os.environ.clear()
+                os.environ.update(saved_env)
+        return 0, ''
+
+
+# client_factory(app, config) must return an object with the boto3
+# elasticbeanstalk client interface, so a local stub can stand in for AWS.
+class ApiEngine(object):
+    def __init__(self, client_factory=None, poll_interval=10, retrier=None,
+                 s3_client_factory=None, tracer=None):
+        self.client_factory = client_factory or self.boto3_client
+        self.s3_client_factory = s3_client_factory or self.boto3_s3_client
+        self.poll_interval = poll_interval
+        self.retrier = retrier or Retrier()
+        self.tracer = tracer or Tracer()
+        self.clients = {}
+
+    @staticmethod
+    def boto3_client(app, config):
+        session = boto3.session.Session(
+            profile_name=config.get('profile'), region_name=app.region)
+        return session.client('elasticbeanstalk')
+
+    @staticmethod
+    def boto3_s3_client(app, config):
+        session = boto3.session.Session(
+            profile_name=config.get('profile'), region_name=app.region)
+        return session.client('s3')
+
+    def project_initialized(self, app, config):
+        return True
+
+    def client(self, app, config, service='elasticbeanstalk'):
+        key = (service, app.region, config.get('profile'))
+        if key not in self.clients:
+            if service == 's3':
+                self.clients[key] = self.s3_client_factory(app, config)
+            else:
+                self.clients[key] = self.client_factory(app, config)
+        return self.clients[key]
+
+    def call(self, app, config, method, service='elasticbeanstalk', **kwargs):
+        outcome = {}
+
+        def attempt():
+            try:
+                with self.tracer.span(method, service, app.key):
+                    outcome['result'] = getattr(
+                        self.client(app, config, service), method)(**kwargs)
+                return 0, ''
+            except Exception as exc:
+                outcome['error'] = exc
+                return 1, '{}: {}'.format(type(exc).__name__, exc)
+
+        if self.retrier.call(attempt, method, config.get('run_deadline')):
+            raise outcome['error']
+        return outcome['result']
+
+    def init(self, app, config):
+        applications = self.call(
+            app, config, 'describe_applications',
+            ApplicationNames=[app.name])['Applications']
+        if not applications:
+            print('Creating application {}.'.format(app.name))
+            self.call(app, config, 'create_application',
+                      ApplicationName=app.name)
+        return 0
+
+    def create(self, app, config, command):
+        settings, unused = build_option_settings(command)
+        if unused:
+            print('Ignoring arguments not supported by the api engine: '
+                  '{}'.format(list2cmdline(unused)))
+        kwargs = {}
+        if config.get('version_label'):
+            kwargs['VersionLabel'] = config.get('version_label')
+        self.call(
+            app, config, 'create_environment',
+            ApplicationName=app.name,
+            EnvironmentName=app.stackname,
+            CNAMEPrefix=app.stackname,
+            SolutionStackName=app.platform,
+            OptionSettings=settings + get_option_settings(config),
+            **kwargs
+        )
+        if config.get('nowait'):
+            return 0
+        return self.wait(app, config, get_phase_deadline(config, 'create'))
+
+    def update(self, app, config, command):
+        self.call(
+            app, config, 'update_environment',
+            ApplicationName=app.name,
+            EnvironmentName=app.stackname,
+            OptionSettings=(
+                build_option_settings(command)[0] +
+                get_option_settings(config)),
+        )
+        if config.get('nowait'):
+            return 0
+        return self.wait(app, config, get_phase_deadline(config, 'update'))
+
+    def swap(self, app, config, destination):
+        self.call(
+            app, config, 'swap_environment_cnames',
+            SourceEnvironmentName=app.stackname,
+            DestinationEnvironmentName=destination,
+        )
+        return 0
+
+    def terminate(self, app, config):
+        self.call(app, config, 'terminate_environment',
+                  EnvironmentName=app.stackname)
+        return 0
+
+    def list_environments(self, region, config):
+        app = App(None, 'prod', '', None, region)
+        environments = []
+        kwargs = {'IncludeDeleted': False}
+        while True:
+            page = self.call(app, config, 'describe_environments', **kwargs)
+            environments += [{
+                'application': environment['ApplicationName'],
+                'name': environment['EnvironmentName'],
+                'status': environment.get('Status'),
+                'created': get_timestamp(environment.get('DateCreated')),
+            } for environment in page['Environments']]
+            if not page.get('NextToken'):
+                return environments
+            kwargs['NextToken'] = page['NextToken']
+
+    # Bundles are stored once per region under their content hash, so
+    # every application in the region shares the upload.
+    def publish_version(self, app, config, label, bundle_path):
+        versions = self.call(
+            app, config, 'describe_application_versions',
+            ApplicationName=app.name,
+            VersionLabels=[label])['ApplicationVersions']
+        if versions:
+            return label
+        bucket = self.call(app, config, 'create_storage_location')['S3Bucket']
+        key = 'weatherman/{}'.format(os.path.basename(bundle_path))
+        try:
+            self.client(app, config, 's3').head_object(Bucket=bucket, Key=key)
+        except Exception:
+            print('Uploading {} to {}.'.format(label, app.region))
+            self.call(app, config, 'upload_file', 's3',
+                      Filename=bundle_path, Bucket=bucket, Key=key)
+        self.call(
+            app, config, 'create_application_version',
+            ApplicationName=app.name,
+            VersionLabel=label,
+            SourceBundle={'S3Bucket': bucket, 'S3Key': key},
+        )
+        return label
+
+    def list_platforms(self, region, config):
+        app = App(None, 'prod', '', None, region)
+        return self.call(
+            app, config, 'list_available_solution_stacks')['SolutionStacks']
+
+    def status(self, app, config):
+        environments = self.call(
+            app, config, 'describe_environments',
+            ApplicationName=app.name,
+            EnvironmentNames=[app.stackname],
+            IncludeDeleted=False,
+        )['Environments']
+        if not environments:
+            return {'Status': 'Missing'}
+        return environments[0]
+
+    def wait(self, app, config, deadline=None):
+        while True:
+            if _cancelled.is_set():
+                raise Cancelled('Stopped waiting for {}'.format(app.stackname))
+            status = self.status(app, config)
+            if status.get('Status') in TERMINAL_STATUSES:
+                return int(not is_healthy(status))
+            if deadline is not None and time.time() >= deadline:
+                print('{} is still {} at its deadline.'.format(
+                    app.stackname, status.get('Status')))
+                return TIMEOUT_EXIT
+            time.sleep(self.poll_interval)
+
+
+TERMINAL_STATUSES = ('Ready', 'Terminating', 'Terminated', 'Missing')
+# Consecutive failed status checks after which a stack stops being watched.
+WATCH_MAX_ERRORS = 5
+
+
+def is_healthy(status):
+    return status.get('Status') == 'Ready' and status.get('Health') != 'Red'
+
+
+# Parses eb list --all --verbose, which lists the environments of each
+# application under an Application: line, marking the current one with *.
+def parse_eb_list(output):
+    environments = []
+    application = None
+    for line in output.splitlines():
+        key, _, value = line.strip().partition(': ')
+        if key == 'Application':
+            application = value.strip()
+        elif line.startswith(' ') and key != 'Environments' and line.strip():
+            environments.append({
+                'application': application,
+                'name': line.strip().lstrip('* ').partition(' : ')[0],
+                'status': None,
+                'created': None,
+            })
+    return environments
+
+
+def get_timestamp(value):
+    if hasattr(value, 'utctimetuple'):
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+
+def parse_eb_status(output):
+    status = {}
+    for line in output.splitlines():
+        key, _, value = line.strip().partition(': ')
+        if key in ('Status', 'Health', 'CNAME'):
+            status[key] = value.strip()
+    return status
+
+
+class EnvironmentWatcher(object):
+    def __init__(self, fetch_status, min_interval=5, max_interval=60,
+                 backoff=1.5, deadline=None, max_errors=WATCH_MAX_ERRORS):
+        self.fetch_status = fetch_status
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.deadline = deadline
+        self.max_errors = max_errors
+
+    def watch(self, stacknames):
+        # Imported here because asyncio roughly doubles weatherman's startup
+        # time and only the watcher needs it.
+        try:
+            import asyncio
+        except ImportError:
+            raise RuntimeError('Watching environments requires asyncio.')
+        results = {}
+        pending = set(stacknames)
+        if not pending:
+            return results
+        last = dict((name, {}) for name in pending)
+        intervals = dict((name, self.min_interval) for name in pending)
+        errors = dict((name, 0) for name in pending)
+        loop = asyncio.new_event_loop()
+
+        def finish(name, status):
+            results[name] = status
+            pending.discard(name)
+            if not pending:
+                loop.stop()
+
+        def poll(name):
+            if name in pending:
+                future = loop.run_in_executor(None, self.fetch_status, name)
+                future.add_done_callback(lambda f: handle(name, f))
+
+        def handle(name, future):
+            if name not in pending:
+                return
+            previous = last[name]
+            try:
+                status = future.result()
+                errors[name] = 0
+            except Exception as exc:
+                status = dict(previous, Error=str(exc))
+                errors[name] += 1
+                if status['Error'] != previous.get('Error'):
+                    print('{}: {}'.format(name, status['Error']))
+                if errors[name] >= self.max_errors:
+                    print('{}: giving up after {} failed status checks'.format(
+                        name, errors[name]))
+                    finish(name, dict(status, Status='Error'))
+                    return
+            last[name] = status
+            changed = (
+                (status.get('Status'), status.get('Health')) !=
+                (previous.get('Status'), previous.get('Health')))
+            if changed:
+                print('{}: {} ({})'.format(
+                    name, status.get('Status', 'Unknown'),
+                    status.get('Health', 'Unknown')))
+                intervals[name] = self.min_interval
+            else:
+                intervals[name] = min(
+                    self.max_interval, intervals[name] * self.backoff)
+            if status.get('Status') in TERMINAL_STATUSES:
+                finish(name, status)
+            else:
+                loop.call_later(intervals[name], poll, name)
+
+        def expire():
+            for name in list(pending):
+                print('{}: timed out'.format(name))
+                finish(name, dict(last[name], Status='Timeout'))
+
+        for name in sorted(pending):
+            loop.call_soon(poll, name)
+        if self.deadline:
+            loop.call_later(self.deadline, expire)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+        return results
+
+
+class JsonFile(object):
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as json_file:
+                return json.load(json_file)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self, entries):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as json_file:
+            json.dump(entries, json_file, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def update(self, key, value):
+        with self.lock:
+            entries = self.load()
+            if value is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = value
+            self.save(entries)
+
+
+class AppRegistry(JsonFile):
+    def __init__(self, path, ttl):
+        super(AppRegistry, self).__init__(path)
+        self.ttl = ttl
+        self.key_locks = {}
+        self.checked = set()
+
+    @staticmethod
+    def key(app, config):
+        return '{}/{}/{}'.format(
+            app.region, config.get('profile') or 'default', app.name)
+
+    def is_fresh(self, key):
+        initialized = self.load().get(key)
+        return initialized is not None and time.time() - initialized < self.ttl
+
+    def mark(self, key):
+        self.update(key, time.time())
+
+    def ensure_initialized(self, app, config, engine):
+        key = self.key(app, config)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            skip = key in self.checked or (
+                not config.get('refresh') and self.is_fresh(key))
+            if skip and engine.project_initialized(app, config):
+                return 0
+            returncode = engine.init(app, config)
+            if returncode == 0:
+                self.checked.add(key)
+                self.mark(key)
+            return returncode
+
+
+_registries = {}
+_shared_lock = threading.Lock()
+
+
+def get_registry(config):
+    path = config.get('registry_path') or '~/.weatherman/registry.json'
+    ttl = int(config.get('registry_ttl') or REGISTRY_TTL)
+    with _shared_lock:
+        if (path, ttl) not in _registries:
+            _registries[(path, ttl)] = AppRegistry(path, ttl)
+        return _registries[(path, ttl)]
+
+
+# Flags that do not change what gets created. eb config cannot deploy a new
+# application version, so the version does not count either, and the region
+# is hashed on its own.
+UNHASHED_FLAGS = frozenset(['--debug', '--nowait', '--version', '--region'])
+
+
+# Option settings are applied through a saved configuration rather than the
+# command, so they are hashed separately. Stacks without any keep the hash
+# they had before settings were hashed.
+def get_desired_state(app, command, config=None):
+    argv = [argument for argument in command
+            if argument.partition('=')[0] not in UNHASHED_FLAGS]
+    payload = [argv, app.platform, app.region]
+    settings = get_option_settings(config or {})
+    if settings:
+        payload.append(settings)
+    digest = hashlib.sha256(
+        json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+    return {
+        'hash': digest,
+        'platform': app.platform,
+        'region': app.region,
+    }
+
+
+class StateStore(JsonFile):
+    def get(self, stackname):
+        return self.load().get(stackname)
+
+    def record(self, stackname, state):
+        self.update(stackname, dict(state, applied_at=time.time()))
+
+    # Stacks whose create or update was stopped have no hash, so the next
+    # apply updates or recreates them.
+    def record_incomplete(self, stackname, phase, reason):
+        self.update(stackname, {
+            'incomplete': phase,
+            'reason': reason,
+            'stopped_at': time.time(),
+        })
+
+    def forget(self, stackname):
+        self.update(stackname, None)
+
+
+# Append-only JSON lines of runs and phase transitions, fsynced after every
+# line so a run that dies keeps everything it journaled.
+class Journal(object):
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        self.replayed = {}
+
+    def append(self, entry):
+        entry = dict(entry, time=time.time())
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path, 'a') as journal:
+                journal.write(json.dumps(entry, sort_keys=True) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+
+    # A line cut short by a crash is skipped.
+    def entries(self):
+        try:
+            with open(self.path) as journal:
+                for line in journal:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except IOError:
+            return
+
+    def start_run(self, manifest, command):
+        run = '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+        self.append({
+            'run': run,
+            'event': 'run',
+            'manifest': os.path.abspath(manifest),
+            'command': command,
+        })
+        return run
+
+    def find_run(self, manifest, command):
+        run = None
+        for entry in self.entries():
+            if (entry.get('event') == 'run' and
+                    entry.get('manifest') == os.path.abspath(manifest) and
+                    entry.get('command') == command):
+                run = entry['run']
+        return run
+
+    def record(self, run, stackname, phase, event, exit_code=None):
+        self.append({
+            'run': run,
+            'stackname': stackname,
+            'phase': phase,
+            'event': event,
+            'exit_code': exit_code,
+        })
+
+    # Maps each stackname to the last event of each of its phases in run.
+    def replay(self, run):
+        with self.lock:
+            if run not in self.replayed:
+                stacks = {}
+                for entry in self.entries():
+                    if entry.get('run') == run and entry.get('stackname'):
+                        stacks.setdefault(entry['stackname'], {})[
+                            entry['phase']] = entry['event']
+                self.replayed[run] = stacks
+            return self.replayed[run]
+
+
+_journals = {}
+
+
+def get_journal(config):
+    if not config.get('journal_path') or config.get('dry_run'):
+        return None
+    path = os.path.expanduser(config.get('journal_path'))
+    with _shared_lock:
+        if path not in _journals:
+            _journals[path] = Journal(path)
+        return _journals[path]
+
+
+def get_resume_action(events):
+    if 'succeeded' in (events.get('create'), events.get('update')):
+        return 'done'
+    # eb may have started the environment before it was stopped.
+    if events.get('create') in ('started', 'cancelled', 'timeout'):
+        return 'check'
+    return 'run'
+
+
+_state_stores = {}
+
+
+def get_state_store(config):
+    path = os.path.expanduser(
+        config.get('state_path') or '~/.weatherman/state.json')
+    with _shared_lock:
+        if path not in _state_stores:
+            _state_stores[path] = StateStore(path)
+        return _state_stores[path]
+
+
+BUNDLE_BLOCK_SIZE = 64 * 1024
+# Never part of a source bundle, like eb's own uploads.
+BUNDLE_EXCLUDES = ('.git', '.elasticbeanstalk')
+
+
+def read_ebignore(source_dir):
+    try:
+        with open(os.path.join(source_dir, '.ebignore')) as ebignore:
+            return [line.strip().strip('/') for line in ebignore
+                    if line.strip() and not line.startswith('#')]
+    except IOError:
+        return []
+
+
+def get_bundle_files(source_dir):
+    patterns = list(BUNDLE_EXCLUDES) + read_ebignore(source_dir)
+
+    def ignored(path):
+        return any(fnmatch.fnmatch(path, pattern) or
+                   fnmatch.fnmatch(os.path.basename(path), pattern)
+                   for pattern in patterns)
+
+    files = []
+    for root, dirs, names in os.walk(source_dir):
+        relroot = os.path.relpath(root, source_dir)
+        if relroot == '.':
+            relroot = ''
+        dirs[:] = [name for name in dirs
+                   if not ignored(os.path.join(relroot, name))]
+        for name in names:
+            path = os.path.join(relroot, name)
+            if not ignored(path):
+                files.append(path.replace(os.sep, '/'))
+    return sorted(files)
+
+
+# The hash covers names, sizes, executable bits and contents, which is
+# everything written to the zip, so equal hashes mean equal bundles.
+def hash_bundle(source_dir, files):
+    digest = hashlib.sha256()
+    for name in files:
+        path = os.path.join(source_dir, name)
+        mode = os.stat(path).st_mode
+        digest.update('{}\0{}\0{}\0'.format(
+            name, os.path.getsize(path),
+            bool(mode & stat.S_IXUSR)).encode('utf-8'))
+        with open(path, 'rb') as source:
+            for block in iter(lambda: source.read(BUNDLE_BLOCK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+# Fixed timestamps and modes keep the archive byte-for-byte reproducible.
+def write_bundle(source_dir, files, path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for name in files:
+            source = os.path.join(source_dir, name)
+            info = zipfile.ZipInfo(name, (1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            executable = os.stat(source).st_mode & stat.S_IXUSR
+            info.external_attr = (0o755 if executable else 0o644) << 16
+            with open(source, 'rb') as contents:
+                bundle.writestr(info, contents.read())
+    os.rename(tmp_path, path)
+    return path
+
+
+# Like eb, a source directory without an .ebignore that is part of a git
+# repository is bundled from its last commit, so untracked and uncommitted
+# files stay out. Returns the id of its tree at HEAD, or None.
+def get_git_tree(source_dir):
+    if os.path.exists(os.path.join(source_dir, '.ebignore')):
+        return None
+    try:
+        process = Popen(['git', 'rev-parse', 'HEAD:./'], cwd=source_dir,
+                        stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    except OSError:
+        return None
+    output, _ = process.communicate()
+    if process.returncode:
+        return None
+    return output.strip()
+
+
+def write_git_bundle(source_dir, tree, path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    process = Popen(['git', 'archive', '--format=zip', '-o', tmp_path, tree],
+                    cwd=source_dir, stdout=PIPE, stderr=PIPE,
+                    universal_newlines=True)
+    _, errors = process.communicate()
+    if process.returncode:
+        raise RuntimeError('git archive exited with {}: {}'.format(
+            process.returncode, errors.strip()))
+    os.rename(tmp_path, path)
+    return path
+
+
+# Builds each source directory once per process and publishes each bundle
+# once per region, application and profile. Bundles are kept in bundle_dir
+# under their hash, so later runs of unchanged code skip the zip too.
+class SourceBundles(object):
+    def __init__(self, bundle_dir):
+        self.bundle_dir = bundle_dir
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.hashes = {}
+        self.published = {}
+
+    def key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def label(self, source_dir):
+        source_dir = os.path.realpath(source_dir)
+        with self.key_lock(source_dir):
+            if source_dir not in self.hashes:
+                tree = get_git_tree(source_dir)
+                if tree:
+                    self.hashes[source_dir] = (None, tree)
+                else:
+                    files = get_bundle_files(source_dir)
+                    self.hashes[source_dir] = (
+                        files, hash_bundle(source_dir, files))
+            return 'weatherman-{}'.format(self.hashes[source_dir][1][:16])
+
+    def build(self, source_dir):
+        label = self.label(source_dir)
+        files, digest = self.hashes[os.path.realpath(source_dir)]
+        path = os.path.join(self.bundle_dir, '{}.zip'.format(digest))
+        with self.key_lock(path):
+            if not os.path.exists(path) and files is None:
+                print('Building source bundle {} from git.'.format(label))
+                write_git_bundle(source_dir, digest, path)
+            elif not os.path.exists(path):
+                print('Building source bundle {}.'.format(label))
+                write_bundle(source_dir, files, path)
+        return label, path
+
+    def publish(self, app, config, engine):
+        label, path = self.build(config.get('source_dir') or '.')
+        key = (app.region, config.get('profile'), app.name, label)
+        with self.key_lock(key):
+            if key not in self.published:
+                self.published[key] = engine.publish_version(
+                    app, config, label, path)
+            return self.published[key]
+
+
+_source_bundles = {}
+
+
+def extract_bundle(path, directory):
+    with zipfile.ZipFile(path) as bundle:
+        for info in bundle.infolist():
+            if info.filename.split('/')[0] in BUNDLE_EXCLUDES:
+                continue
+            target = bundle.extract(info, directory)
+            mode = info.external_attr >> 16
+            if mode and not info.filename.endswith('/'):
+                os.chmod(target, mode & 0o777)
+
+
+# eb create uploads its project, so without an application version to
+# deploy the project gets the files of the source bundle. They are only
+# replaced when the source changes.
+def copy_source(config, directory):
+    label, path = get_source_bundles(config).build(
+        config.get('source_dir') or '.')
+    marker = os.path.join(directory, '.elasticbeanstalk', 'weatherman-source')
+    try:
+        with open(marker) as copied:
+            if copied.read() == label:
+                return
+    except IOError:
+        pass
+    for name in os.listdir(directory):
+        if name in BUNDLE_EXCLUDES:
+            continue
+        old = os.path.join(directory, name)
+        if os.path.isdir(old) and not os.path.islink(old):
+            shutil.rmtree(old)
         else:
-            self.stackname = '{}-{}{}'.format(name, env, stack_version)
-        self.platform = platform
+            os.remove(old)
+    extract_bundle(path, directory)
+    with open(marker, 'w') as copied:
+        copied.write(label)
 
-        # TODO: parse arg
-        self.region='us-east-1'
 
+def get_source_bundles(config):
+    path = os.path.expanduser(
+        config.get('bundle_dir') or '~/.weatherman/bundles')
+    with _shared_lock:
+        if path not in _source_bundles:
+            _source_bundles[path] = SourceBundles(path)
+        return _source_bundles[path]
 
-def main(config, passthrough_args=None):
-    app = App(
-        config.get('appname'),
-        config.get('env', 'dev'),
-        config.get('stack_version', ''),
-        STACK_TYPE_MAP[config.get('stack_type')]
+
+GONE_STATUSES = ('Missing', 'Terminating', 'Terminated')
+POOL_STATES = ('standby', 'creating', 'claimed')
+
+
+# Pool entries map the stack_version slots of each app and env to when they
+# entered their state. The file is shared with background refills, so
+# changes hold an flock where the platform has one.
+class StandbyPool(JsonFile):
+    @staticmethod
+    def key(app, config):
+        return '{}/{}/{}/{}'.format(
+            app.region, config.get('profile') or 'default', app.name, app.env)
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+
+    @staticmethod
+    def entry(entries, key):
+        entry = entries.setdefault(key, {})
+        for state in POOL_STATES:
+            entry.setdefault(state, {})
+        return entry
+
+    def reserve(self, key, size, dry_run=False):
+        with self.locked():
+            entries = self.load()
+            entry = self.entry(entries, key)
+            now = time.time()
+            # claim checks health, so an abandoned create is only handed out
+            # if it came up anyway.
+            for version, started in list(entry['creating'].items()):
+                if now - started > POOL_CREATE_TIMEOUT:
+                    entry['standby'][version] = entry['creating'].pop(version)
+            used = set()
+            for state in POOL_STATES:
+                used.update(entry[state])
+            versions = []
+            slot = 0
+            while len(entry['standby']) + len(entry['creating']) < size:
+                slot += 1
+                version = POOL_SLOT.format(slot)
+                if version not in used:
+                    entry['creating'][version] = now
+                    versions.append(version)
+            if not dry_run:
+                self.save(entries)
+            return versions
+
+    def finish(self, key, version, created):
+        with self.locked():
+            entries = self.load()
+            entry = self.entry(entries, key)
+            entry['creating'].pop(version, None)
+            if created:
+                entry['standby'][version] = time.time()
+            self.save(entries)
+
+    # is_ready returns True, False, or None for environments that are gone.
+    def claim(self, key, is_ready, dry_run=False):
+        with self.locked():
+            entries = self.load()
+            entry = self.entry(entries, key)
+            claimed = None
+            for version in sorted(entry['standby'], key=entry['standby'].get):
+                ready = is_ready(version)
+                if ready is None:
+                    del entry['standby'][version]
+                elif ready:
+                    entry['claimed'][version] = time.time()
+                    del entry['standby'][version]
+                    claimed = version
+                    break
+            if not dry_run:
+                self.save(entries)
+            return claimed
+
+    # Puts a claimed standby back, behind the others since it was refused.
+    def release(self, key, version):
+        with self.locked():
+            entries = self.load()
+            entry = self.entry(entries, key)
+            if entry['claimed'].pop(version, None) is not None:
+                entry['standby'][version] = time.time()
+            self.save(entries)
+
+
+_standby_pools = {}
+
+
+def get_standby_pool(config):
+    path = os.path.expanduser(
+        config.get('pool_path') or '~/.weatherman/pool.json')
+    with _shared_lock:
+        if path not in _standby_pools:
+            _standby_pools[path] = StandbyPool(path)
+        return _standby_pools[path]
+
+
+def get_standby_app(app, version):
+    return App(app.name, app.env, version, app.platform, app.region)
+
+
+def plan_apply(desired, recorded, live):
+    if live is None:
+        exists = recorded is not None
+    else:
+        exists = live.get('Status') not in GONE_STATUSES
+    if not exists:
+        return 'create'
+    if recorded is not None and recorded.get('hash') == desired['hash']:
+        return 'unchanged'
+    return 'update'
+
+
+def prometheus_labels(labels):
+    return ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items()))
+
+
+# Records spans as Chrome trace events, one track per stack, so a run can
+# be opened in Perfetto or chrome://tracing. Without a path nothing is kept.
+class Tracer(object):
+    def __init__(self, path=None):
+        self.path = path
+        self.events = []
+        self.tracks = {}
+        self.lock = threading.Lock()
+
+    def track(self, name):
+        if name not in self.tracks:
+            self.tracks[name] = len(self.tracks) + 1
+        return self.tracks[name]
+
+    def add(self, name, category, track, start, seconds, args=None):
+        if not self.path:
+            return
+        with self.lock:
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int(start * 1e6),
+                'dur': int((start + seconds) * 1e6) - int(start * 1e6),
+                'pid': os.getpid(),
+                'tid': self.track(track),
+                'args': args or {},
+            })
+
+    @contextmanager
+    def span(self, name, category, track, args=None):
+        args = dict(args or {})
+        start = time.time()
+        try:
+            yield args
+        finally:
+            self.add(name, category, track, start, time.time() - start, args)
+
+    def render(self):
+        with self.lock:
+            names = [{
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': {'name': track},
+            } for track, tid in sorted(self.tracks.items())]
+            events = sorted(self.events, key=lambda event: event['ts'])
+        return {'traceEvents': names + events, 'displayTimeUnit': 'ms'}
+
+    def flush(self):
+        if not self.path:
+            return
+        path = os.path.expanduser(self.path)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as trace:
+            json.dump(self.render(), trace)
+        os.rename(tmp_path, path)
+
+
+_tracers = {}
+
+
+def get_tracer(config):
+    path = config.get('trace_path')
+    with _shared_lock:
+        if path not in _tracers:
+            _tracers[path] = Tracer(path)
+        return _tracers[path]
+
+
+class Metrics(object):
+    buckets = (1, 5, 15, 30, 60, 120, 300, 600, 900, 1800)
+
+    def __init__(self, path=None, textfile=None, tracer=None):
+        self.path = path
+        self.textfile = textfile
+        self.tracer = tracer or Tracer()
+        self.records = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, app, start=None):
+        record = {
+            'phase': name,
+            'app': app.name,
+            'env': app.env,
+            'stack_version': app.stack_version,
+            'stackname': app.stackname,
+            'region': app.region,
+            'exit_code': 0,
+            'start': start or time.time(),
+        }
+        try:
+            yield record
+        except Exception as exc:
+            record['exit_code'] = None
+            record['error'] = str(exc)
+            raise
+        finally:
+            record['seconds'] = time.time() - record['start']
+            self.add(record)
+            self.tracer.add(
+                name, 'phase', app.key, record['start'], record['seconds'],
+                {'exit_code': record['exit_code']})
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+            if not self.path:
+                return
+            line = json.dumps(record, sort_keys=True) + '\n'
+            if self.path == '-':
+                sys.stderr.write(line)
+            else:
+                with open(os.path.expanduser(self.path), 'a') as output:
+                    output.write(line)
+
+    def render_prometheus(self):
+        lines = [
+            '# HELP weatherman_phase_duration_seconds Duration of the last '
+            'run of each weatherman phase.',
+            '# TYPE weatherman_phase_duration_seconds gauge',
+        ]
+        histograms = {}
+        for record in self.records:
+            labels = dict(
+                (key, record[key]) for key in
+                ('phase', 'app', 'env', 'stack_version', 'region'))
+            labels['exit_code'] = record['exit_code']
+            lines.append('weatherman_phase_duration_seconds{{{}}} {}'.format(
+                prometheus_labels(labels), record['seconds']))
+            histograms.setdefault(record['phase'], []).append(
+                record['seconds'])
+        lines += [
+            '# HELP weatherman_phase_seconds Distribution of weatherman '
+            'phase durations in this run.',
+            '# TYPE weatherman_phase_seconds histogram',
+        ]
+        for phase, durations in sorted(histograms.items()):
+            for bucket in self.buckets + ('+Inf',):
+                labels = prometheus_labels({'phase': phase, 'le': bucket})
+                count = len([
+                    d for d in durations if bucket == '+Inf' or d <= bucket])
+                lines.append('weatherman_phase_seconds_bucket{{{}}} {}'.format(
+                    labels, count))
+            labels = prometheus_labels({'phase': phase})
+            lines.append('weatherman_phase_seconds_sum{{{}}} {}'.format(
+                labels, sum(durations)))
+            lines.append('weatherman_phase_seconds_count{{{}}} {}'.format(
+                labels, len(durations)))
+        return '\n'.join(lines) + '\n'
+
+    # node-exporter may read the textfile at any time, so replace it
+    # atomically.
+    def flush(self):
+        self.tracer.flush()
+        if not self.textfile:
+            return
+        path = os.path.expanduser(self.textfile)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with self.lock:
+            with open(tmp_path, 'w') as textfile:
+                textfile.write(self.render_prometheus())
+        os.rename(tmp_path, path)
+
+
+_metrics = {}
+
+
+def get_metrics(config):
+    tracer = get_tracer(config)
+    key = (config.get('metrics_path'), config.get('prometheus_textfile'),
+           tracer)
+    with _shared_lock:
+        if key not in _metrics:
+            _metrics[key] = Metrics(*key)
+        return _metrics[key]
+
+
+def get_engine(config):
+    engine = config.get('engine') or 'cli'
+    retrier = get_retrier(config)
+    tracer = get_tracer(config)
+    if engine == 'inprocess':
+        try:
+            return InProcessEngine(retrier, tracer)
+        except ImportError:
+            print('awsebcli is not importable, falling back to eb CLI.')
+    elif engine == 'api':
+        if boto3 is not None:
+            return ApiEngine(retrier=retrier, tracer=tracer)
+        print('boto3 is not installed, falling back to eb CLI.')
+    return CliEngine(
+        config.get('eb_path') or 'eb', retrier, config.get('log_dir'),
+        int(config.get('output_tail_lines') or OUTPUT_TAIL_LINES), tracer)
+
+
+class App(object):
+    def __init__(self, name, env, stack_version, platform,
+                 region=DEFAULT_REGION):
+        self.name = name
+        self.env = env
+        if env == 'prod':
+            self.stackname = '{}{}'.format(name, stack_version)
+        else:
+            self.stackname = '{}-{}{}'.format(name, env, stack_version)
+        self.stack_version = stack_version
+        self.platform = platform
+        self.region = region
+        # Environment names are only unique within a region, so local state
+        # for other regions is keyed by region too.
+        if region == DEFAULT_REGION:
+            self.key = self.stackname
+        else:
+            self.key = '{}/{}'.format(region, self.stackname)
+
+
+SOLUTION_STACK_RE = re.compile(
+    r'^(?:64|32)bit (?P<os>.+?) v(?P<version>[\d.]+) '
+    r'running (?P<language>.+)$')
+
+
+def version_key(version):
+    return tuple(int(part) for part in re.findall(r'\d+', version))
+
+
+def get_platform_keys(solution_stack):
+    match = SOLUTION_STACK_RE.match(solution_stack)
+    if not match:
+        return None
+    language = match.group('language')
+    slug = re.sub(r'[^a-z0-9]', '', language.lower().replace(
+        '(preconfigured - docker)', 'docker'))
+    family = None
+    if '(' not in language:
+        family = re.sub(r'[^a-z]', '', language.split()[0].lower())
+    return {
+        'slug': slug,
+        'family': family,
+        'version': match.group('version'),
+        'rank': (version_key(language), version_key(match.group('version')),
+                 match.group('os')),
+    }
+
+
+# Maps short keys to solution stacks: python34 and python34_latest give the
+# newest Python 3.4 platform, python34_2.0.6 a specific platform version and
+# python the newest Python of any version.
+def index_platforms(solution_stacks):
+    index = {}
+    ranks = {}
+    for solution_stack in solution_stacks:
+        index[solution_stack.lower()] = solution_stack
+        keys = get_platform_keys(solution_stack)
+        if keys is None:
+            continue
+        index['{}_{}'.format(keys['slug'], keys['version'])] = solution_stack
+        for alias in (keys['slug'], keys['slug'] + '_latest', keys['family']):
+            if alias and keys['rank'] > ranks.get(alias, ()):
+                ranks[alias] = keys['rank']
+                index[alias] = solution_stack
+    return index
+
+
+class PlatformCatalog(JsonFile):
+    def __init__(self, path, ttl):
+        super(PlatformCatalog, self).__init__(path)
+        self.ttl = ttl
+        self.indexes = {}
+        self.failed = set()
+        self.region_locks = {}
+
+    # Without a loader only the cache is used, however old it is. Regions
+    # are listed in parallel; only the cache file is shared.
+    def index(self, region, loader=None):
+        with self.lock:
+            region_lock = self.region_locks.setdefault(
+                region, threading.Lock())
+        with region_lock:
+            cached = self.indexes.get(region)
+            if cached and time.time() - cached[0] < self.ttl:
+                return cached[1]
+            with self.lock:
+                entry = self.load().get(region)
+            stale = entry is None or time.time() - entry['fetched'] >= self.ttl
+            if stale and loader and region not in self.failed:
+                try:
+                    entry = {
+                        'fetched': time.time(),
+                        'platforms': loader(region),
+                    }
+                except Exception as exc:
+                    sys.stderr.write(
+                        'Unable to list platforms in {}: {}\n'.format(
+                            region, exc))
+                    self.failed.add(region)
+                else:
+                    self.update(region, entry)
+            if entry is None:
+                return {}
+            self.indexes[region] = (
+                entry['fetched'], index_platforms(entry['platforms']))
+            return self.indexes[region][1]
+
+    def resolve(self, stack_type, region, loader=None):
+        if SOLUTION_STACK_RE.match(stack_type):
+            return stack_type
+        index = self.index(region, loader)
+        if stack_type.lower() in index:
+            return index[stack_type.lower()]
+        return STACK_TYPE_MAP[stack_type]
+
+
+_platform_catalogs = {}
+
+
+def get_platform_catalog(config):
+    path = os.path.expanduser(
+        config.get('platform_cache_path') or '~/.weatherman/platforms.json')
+    ttl = float(config.get('platform_cache_ttl') or PLATFORM_CACHE_TTL)
+    with _shared_lock:
+        if (path, ttl) not in _platform_catalogs:
+            _platform_catalogs[(path, ttl)] = PlatformCatalog(path, ttl)
+        return _platform_catalogs[(path, ttl)]
+
+
+# Dry runs must not run eb, so they resolve from the cache or
+# STACK_TYPE_MAP.
+def get_platform(config, region, engine=None):
+    def loader(region):
+        return (engine or get_engine(config)).list_platforms(region, config)
+    return get_platform_catalog(config).resolve(
+        config.get('stack_type'), region,
+        None if config.get('dry_run') else loader)
+
+
+def get_region(config):
+    return config.get('region') or DEFAULT_REGION
+
+
+def get_app(config, engine=None):
+    return App(
+        config.get('appname'),
+        config.get('env', 'dev'),
+        config.get('stack_version', ''),
+        get_platform(config, get_region(config), engine),
+        get_region(config),
+    )
+
+
+# An App for naming and labels only, without looking up its platform.
+def get_unresolved_app(config):
+    return App(
+        config.get('appname'),
+        config.get('env', 'dev'),
+        config.get('stack_version', ''),
+        None,
+        get_region(config),
+    )
+
+
+def get_stackname(config):
+    return get_unresolved_app(config).key
+
+
+# Journals a metrics phase, and records creates and updates that timed out
+# or were cancelled as incomplete in the state file.
+@contextmanager
+def tracking_phase(config, app, phase):
+    journal = get_journal(config)
+    run = config.get('journal_run')
+
+    def finish(event, reason=None):
+        if journal is not None:
+            journal.record(
+                run, app.key, phase['phase'], event, phase['exit_code'])
+        if reason and phase['phase'] in ('create', 'update'):
+            get_state_store(config).record_incomplete(
+                app.key, phase['phase'], reason)
+
+    if journal is not None:
+        journal.record(run, app.key, phase['phase'], 'started')
+    try:
+        yield
+    except Cancelled:
+        phase['exit_code'] = CANCELLED_EXIT
+        finish('cancelled', 'cancelled')
+        raise
+    except Exception:
+        phase['exit_code'] = None
+        finish('failed')
+        raise
+    if phase['exit_code'] == TIMEOUT_EXIT:
+        finish('timeout', 'timeout')
+    else:
+        finish('failed' if phase['exit_code'] else 'succeeded')
+
+
+def main(config, passthrough_args=None, engine=None):
+    app = get_app(config, engine)
+    metrics = get_metrics(config)
+    if config.get('bundle') and config['dry_run']:
+        config['version_label'] = get_source_bundles(config).label(
+            config.get('source_dir') or '.')
+    elif config.get('bundle'):
+        engine = engine or get_engine(config)
+        with metrics.phase('bundle', app):
+            config['version_label'] = get_source_bundles(config).publish(
+                app, config, engine)
+    with metrics.phase('command_build', app):
+        command = build_eb_cli_command(app, config, passthrough_args)
+    if config['dry_run']:
+        print(list2cmdline(command))
+        return 0
+    if engine is None:
+        engine = get_engine(config)
+    with metrics.phase('init', app) as phase:
+        with tracking_phase(config, app, phase):
+            phase['exit_code'] = get_registry(config).ensure_initialized(
+                app, config, engine)
+    if phase['exit_code']:
+        return phase['exit_code']
+    with metrics.phase('create', app) as phase:
+        with tracking_phase(config, app, phase):
+            phase['exit_code'] = engine.create(app, config, command)
+    if phase['exit_code'] == 0:
+        get_state_store(config).record(
+            app.key, get_desired_state(app, command, config))
+    if phase['exit_code'] == 0 and config.get('probe_path'):
+        if config.get('nowait'):
+            print('Not probing {} because of --nowait.'.format(app.key))
+            return 0
+        with metrics.phase('probe', app) as phase:
+            with tracking_phase(config, app, phase):
+                phase['exit_code'] = probe_stack(app, config, engine, phase)
+    return phase['exit_code']
+
+
+def apply_stack(config, passthrough_args=None, engine=None):
+    passthrough_args = passthrough_args or []
+    app = get_app(config, engine)
+    command = build_eb_cli_command(app, config, passthrough_args)
+    desired = get_desired_state(app, command, config)
+    store = get_state_store(config)
+    if engine is None:
+        engine = get_engine(config)
+    live = None
+    if not config.get('skip_live_check'):
+        live = engine.status(app, config)
+    action = plan_apply(desired, store.get(app.key), live)
+    print('{}: {}'.format(app.key, action))
+    if action == 'unchanged' or config['dry_run']:
+        return 0
+    if action == 'create':
+        return main(config, passthrough_args, engine)
+    with get_metrics(config).phase('update', app) as phase:
+        with tracking_phase(config, app, phase):
+            phase['exit_code'] = engine.update(app, config, command)
+    if phase['exit_code'] == 0:
+        store.record(app.key, desired)
+    return phase['exit_code']
+
+
+# Continues a journaled run: stacks whose create or update succeeded are
+# skipped, and a create that was running when the run died is waited for
+# instead of started again.
+def resume_stack(config, passthrough_args=None, engine=None, run=None):
+    run = run or main
+    app = get_app(config, engine)
+    journal = get_journal(config)
+    events = {}
+    if journal is not None:
+        events = journal.replay(config.get('journal_run')).get(app.key, {})
+    action = get_resume_action(events)
+    if action == 'done':
+        print('{}: finished in the resumed run'.format(app.key))
+        return 0
+    if action == 'check':
+        engine = engine or get_engine(config)
+        status = engine.status(app, config)
+        if status.get('Status') not in GONE_STATUSES:
+            print('{}: waiting for the interrupted create'.format(app.key))
+            with get_metrics(config).phase('create', app) as phase:
+                with tracking_phase(config, app, phase):
+                    phase['exit_code'] = wait_for_stack(app, config, engine)
+            if phase['exit_code'] == 0:
+                command = build_eb_cli_command(
+                    app, config, passthrough_args or [])
+                get_state_store(config).record(
+                    app.key, get_desired_state(app, command, config))
+            return phase['exit_code']
+    return run(config, passthrough_args=passthrough_args, engine=engine)
+
+
+def wait_for_stack(app, config, engine):
+    statuses = get_watcher(
+        config, lambda stackname: engine.status(app, config)).watch(
+            [app.key])
+    status = statuses[app.key]
+    if status.get('Status') == 'Timeout':
+        return TIMEOUT_EXIT
+    return int(not is_healthy(status))
+
+
+PROBE_DEFAULTS = {
+    'probe_rate': 10,
+    'probe_duration': 30,
+    'probe_concurrency': 10,
+    'probe_timeout': 5,
+    'probe_max_error_rate': 0.01,
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+def fetch_url(url, timeout):
+    try:
+        response = urlopen(url, timeout=timeout)
+        try:
+            response.read()
+        finally:
+            response.close()
+        return True
+    except Exception:
+        return False
+
+
+# Requests are sent at a fixed rate whether or not earlier ones have
+# answered, and latency counts from when each request was due, so a stack
+# that falls behind shows up as latency instead of as a lower rate.
+def run_load_probe(url, rate, duration, concurrency, timeout):
+    samples = []
+    lock = threading.Lock()
+
+    def fetch(due):
+        ok = fetch_url(url, timeout)
+        with lock:
+            samples.append((time.time() - due, ok))
+
+    pool = ThreadPool(max(1, concurrency))
+    start = time.time()
+    try:
+        for index in range(max(1, int(rate * duration))):
+            due = start + index / float(rate)
+            time.sleep(max(0, due - time.time()))
+            if _cancelled.is_set():
+                raise Cancelled('Stopped probing {}'.format(url))
+            pool.apply_async(fetch, (due,))
+    finally:
+        pool.close()
+        pool.join()
+    latencies = [latency for latency, _ in samples]
+    errors = len([ok for _, ok in samples if not ok])
+    return {
+        'url': url,
+        'requests': len(samples),
+        'seconds': time.time() - start,
+        'error_rate': errors / float(len(samples) or 1),
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def check_probe(result, config):
+    failures = []
+    for key in ('p50', 'p95', 'p99'):
+        limit = config.get('probe_max_{}'.format(key))
+        if limit and result[key] * 1000 > limit:
+            failures.append('{} {:.0f}ms is over {}ms'.format(
+                key, result[key] * 1000, limit))
+    limit = config.get('probe_max_error_rate')
+    if limit is None:
+        limit = PROBE_DEFAULTS['probe_max_error_rate']
+    if result['error_rate'] > limit:
+        failures.append('error rate {:.1%} is over {:.1%}'.format(
+            result['error_rate'], limit))
+    return failures
+
+
+def format_probe(result):
+    latencies = ' '.join(
+        '{} {:.0f}ms'.format(key, result[key] * 1000)
+        for key in ('p50', 'p95', 'p99') if result[key] is not None)
+    return '{} requests to {} in {:.1f}s, {}, {:.1%} errors'.format(
+        result['requests'], result['url'], result['seconds'], latencies,
+        result['error_rate'])
+
+
+def get_probe_url(app, config, engine):
+    base = config.get('probe_url')
+    if not base:
+        base = 'http://{}'.format(engine.status(app, config)['CNAME'])
+    return base.rstrip('/') + '/' + config.get('probe_path').lstrip('/')
+
+
+# Load tests a created environment. Latencies and the error rate go into
+# the metrics record, and the stack fails if any threshold is exceeded.
+def probe_stack(app, config, engine, record=None):
+    def setting(key):
+        value = config.get(key)
+        return PROBE_DEFAULTS[key] if value is None else value
+
+    url = get_probe_url(app, config, engine)
+    result = run_load_probe(
+        url, float(setting('probe_rate')), float(setting('probe_duration')),
+        int(setting('probe_concurrency')), float(setting('probe_timeout')))
+    if record is not None:
+        record.update(('probe_{}'.format(key), result[key]) for key in
+                      ('requests', 'error_rate', 'p50', 'p95', 'p99'))
+    print('{}: {}'.format(app.key, format_probe(result)))
+    failures = check_probe(result, config)
+    for failure in failures:
+        print('{}: probe failed, {}'.format(app.key, failure))
+    return int(bool(failures))
+
+
+def refill_pool(config, passthrough_args=None, engine=None):
+    app = get_app(config, engine)
+    pool = get_standby_pool(config)
+    key = pool.key(app, config)
+    versions = pool.reserve(
+        key, int(config.get('pool_size') or 0), config['dry_run'])
+    if not versions:
+        print('The standby pool of {} is full.'.format(app.stackname))
+        return 0
+
+    def create(config, passthrough_args):
+        returncode = 1
+        try:
+            returncode = main(config, passthrough_args, engine)
+        finally:
+            if not config['dry_run']:
+                pool.finish(key, config['stack_version'], returncode == 0)
+        return returncode
+
+    stacks = [(Config(config, stack_version=version), passthrough_args or [])
+              for version in versions]
+    results = run_fleet(
+        stacks, int(config.get('pool_concurrency') or 1), run=create)
+    print_fleet_summary(results)
+    return int(any(returncode for _, returncode, _ in results))
+
+
+def claim_standby(config, swap_with=None, engine=None):
+    engine = engine or get_engine(config)
+    app = get_app(config, engine)
+
+    def is_ready(version):
+        try:
+            status = engine.status(get_standby_app(app, version), config)
+        except RuntimeError as exc:
+            print('Unable to check {}: {}'.format(
+                get_standby_app(app, version).stackname, exc))
+            return False
+        if status.get('Status') in GONE_STATUSES:
+            return None
+        return is_healthy(status)
+
+    pool = get_standby_pool(config)
+    version = pool.claim(pool.key(app, config), is_ready, config['dry_run'])
+    if version is None:
+        print('No standby environment of {} is ready.'.format(app.stackname))
+        return 1
+    standby = get_standby_app(app, version)
+    print('Claimed {}.'.format(standby.stackname))
+    if not swap_with or config['dry_run']:
+        return 0
+    if config.get('probe_path') and probe_stack(standby, config, engine):
+        print('Not swapping {} into {}, returning it to the pool.'.format(
+            standby.stackname, swap_with))
+        pool.release(pool.key(app, config), version)
+        return 1
+    print('Swapping CNAMEs of {} and {}.'.format(standby.stackname, swap_with))
+    return engine.swap(standby, config, swap_with)
+
+
+# Refills run detached so claim returns as soon as it has a standby.
+def start_refill(config, argv):
+    log_path = get_standby_pool(config).path + '.log'
+    with open(log_path, 'a') as log:
+        Popen([sys.executable, os.path.abspath(__file__), 'pool'] + argv,
+              stdin=open(os.devnull), stdout=log, stderr=STDOUT,
+              close_fds=True, **NEW_SESSION)
+    print('Refilling the standby pool in the background, see {}.'.format(
+        log_path))
+
+
+# Stacks that App could have named: apps, envs and stack versions of digits
+# or standby slots. Anything else in an application is left alone.
+STACK_VERSION_RE = r'(?:\d*|{}\d+)'.format(re.escape(POOL_SLOT.format('')))
+
+
+def parse_stackname(application, stackname):
+    if not application or not stackname.startswith(application):
+        return None
+    rest = stackname[len(application):]
+    if re.match(r'^{}$'.format(STACK_VERSION_RE), rest):
+        return 'prod', rest
+    match = re.match(
+        r'^-(?P<env>[A-Za-z]+)(?P<version>{})$'.format(STACK_VERSION_RE), rest)
+    if match is None or match.group('env') == 'prod':
+        return None
+    return match.group('env'), match.group('version')
+
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60,
+                  'w': 7 * 24 * 60 * 60}
+
+
+def parse_duration(value):
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$', value)
+    if not match:
+        raise ValueError('Invalid duration {!r}'.format(value))
+    return float(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+
+def format_age(seconds):
+    if seconds is None:
+        return '?'
+    for unit in ('w', 'd', 'h', 'm'):
+        if seconds >= DURATION_UNITS[unit]:
+            return '{:.1f}{}'.format(seconds / DURATION_UNITS[unit], unit)
+    return '{:.0f}s'.format(seconds)
+
+
+# Lists every region at once and keeps the environments whose app, env and
+# stack version match the patterns and that are older than older_than.
+# Prod only matches if env_pattern asks for it. Without a creation time
+# from the engine, the time weatherman recorded for the stack is used.
+def find_stale_environments(config, engine, regions, app_pattern='*',
+                            env_pattern=None, version_pattern='*',
+                            older_than=None, now=None):
+    now = now or time.time()
+    recorded = get_state_store(config).load()
+    errors = []
+
+    def list_region(region):
+        try:
+            return region, engine.list_environments(region, config)
+        except Exception as exc:
+            print('Unable to list environments in {}: {}'.format(region, exc))
+            errors.append(region)
+            return region, []
+
+    pool = ThreadPool(max(1, len(regions)))
+    try:
+        listings = pool.map(list_region, regions)
+    finally:
+        pool.close()
+    stale = []
+    for region, environments in listings:
+        for environment in environments:
+            parsed = parse_stackname(
+                environment['application'], environment['name'])
+            if parsed is None or environment['status'] in GONE_STATUSES:
+                continue
+            env, version = parsed
+            if not fnmatch.fnmatchcase(environment['application'],
+                                       app_pattern):
+                continue
+            if env_pattern is None and env == 'prod':
+                continue
+            if not fnmatch.fnmatchcase(env, env_pattern or '*'):
+                continue
+            if not fnmatch.fnmatchcase(version, version_pattern):
+                continue
+            app = App(environment['application'], env, version, None, region)
+            created = environment['created']
+            if created is None:
+                state = recorded.get(app.key) or {}
+                created = state.get('applied_at') or state.get('stopped_at')
+            age = None if created is None else now - created
+            if older_than and (age is None or age < older_than):
+                continue
+            stale.append(dict(environment, region=region, env=env,
+                              stack_version=version, age=age, key=app.key))
+    stale.sort(key=lambda environment: (environment['region'],
+                                        environment['name']))
+    return stale, errors
+
+
+def print_reap_plan(stale):
+    print('{:<40} {:<16} {:>8}  {}'.format('Stack', 'Region', 'Age', 'Status'))
+    for environment in stale:
+        print('{:<40} {:<16} {:>8}  {}'.format(
+            environment['name'], environment['region'],
+            format_age(environment['age']), environment['status'] or '-'))
+    print('{} environments to terminate.'.format(len(stale)))
+
+
+def reap_environment(config, passthrough_args=None, engine=None):
+    # The platform only becomes the default of the eb project terminate runs
+    # in, so any known one will do.
+    platform = STACK_TYPE_MAP.get(config.get('stack_type'),
+                                  STACK_TYPE_MAP['python34'])
+    app = App(config.get('appname'), config.get('env'),
+              config.get('stack_version'), platform, get_region(config))
+    engine = engine or get_engine(config)
+    with get_metrics(config).phase('terminate', app) as phase:
+        phase['exit_code'] = engine.terminate(app, config)
+    if phase['exit_code'] == 0:
+        get_state_store(config).forget(app.key)
+    return phase['exit_code']
+
+
+def split_list(value):
+    if not value:
+        return []
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+# default_regions are used for entries that set neither regions nor region.
+def expand_manifest_entry(section, entry, default_regions=None):
+    entry = dict(entry)
+    appname = entry.pop('appname', section)
+    if not appname:
+        raise ValueError('Manifest entry {} has no appname'.format(section))
+    envs = split_list(entry.pop('envs', entry.pop('env', 'dev')))
+    stack_versions = split_list(entry.pop('stack_versions', '')) or ['']
+    passthrough_args = shlex.split(entry.pop('passthrough', ''))
+    regions = split_list(entry.pop('regions', ''))
+    if not regions:
+        if entry.get('region'):
+            regions = [entry['region']]
+        else:
+            regions = default_regions or [None]
+    for env in envs:
+        for stack_version in stack_versions:
+            for region in regions:
+                overrides = dict(entry)
+                overrides['env'] = env
+                overrides['stack_version'] = stack_version
+                overrides['manifest_section'] = section
+                if region:
+                    overrides['region'] = region
+                yield appname, overrides, passthrough_args
+
+
+def expand_manifest(manifest_path, default_regions=None):
+    manifest = ConfigParser()
+    if not manifest.read(os.path.expanduser(manifest_path)):
+        raise IOError('Unable to read manifest {}'.format(manifest_path))
+    for section in manifest.sections():
+        for stack in expand_manifest_entry(
+                section, dict(manifest.items(section)), default_regions):
+            yield stack
+
+
+# The streaming readers below yield (section, entry) pairs while reading, so
+# a manifest never has to fit in memory.
+def parse_ini_chunk(defaults, chunk):
+    if chunk[0].strip() == '[DEFAULT]':
+        defaults[:] = chunk
+        return []
+    parser = ConfigParser()
+    read = getattr(parser, 'read_file', None) or parser.readfp
+    read(StringIO(''.join(defaults + chunk)))
+    return [(section, dict(parser.items(section)))
+            for section in parser.sections()]
+
+
+# [DEFAULT] only applies to the sections that follow it.
+def read_ini_manifest(lines):
+    defaults = []
+    chunk = []
+    for line in lines:
+        if line.startswith('[') and chunk:
+            for entry in parse_ini_chunk(defaults, chunk):
+                yield entry
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        for entry in parse_ini_chunk(defaults, chunk):
+            yield entry
+
+
+# One stack per row, with config keys as columns; empty cells are unset.
+def read_csv_manifest(lines):
+    for row in csv.DictReader(lines):
+        entry = dict((key.strip(), value) for key, value in row.items()
+                     if key and value not in (None, ''))
+        yield entry.pop('section', entry.get('appname')), entry
+
+
+def get_manifest_value(key, value):
+    if isinstance(value, list) and key == 'passthrough':
+        return ' '.join(quote(str(item)) for item in value)
+    if isinstance(value, list):
+        return ','.join(str(item) for item in value)
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def read_jsonl_manifest(lines):
+    for number, line in enumerate(lines, 1):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError as exc:
+            raise ValueError('Line {}: {}'.format(number, exc))
+        entry = dict((key, get_manifest_value(key, value))
+                     for key, value in entry.items() if value is not None)
+        yield entry.pop('section', entry.get('appname')), entry
+
+
+MANIFEST_READERS = {
+    'ini': read_ini_manifest,
+    'csv': read_csv_manifest,
+    'jsonl': read_jsonl_manifest,
+}
+
+
+def get_manifest_format(path, first_line):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.csv', '.jsonl'):
+        return extension[1:]
+    if extension in ('.ini', '.cfg', '.conf'):
+        return 'ini'
+    if first_line.lstrip().startswith('{'):
+        return 'jsonl'
+    if first_line.lstrip().startswith(('[', '#', ';')):
+        return 'ini'
+    return 'csv'
+
+
+def stream_manifest(lines, path='-', manifest_format=None):
+    lines = iter(lines)
+    first_line = next(lines, '')
+    if manifest_format is None:
+        manifest_format = get_manifest_format(path, first_line)
+    lines = chain([first_line], lines)
+    for section, entry in MANIFEST_READERS[manifest_format](lines):
+        for stack in expand_manifest_entry(section, entry):
+            yield stack
+
+
+# Stacks depend on every stack of the sections named in depends_on that is
+# created in the same env and region.
+def get_fleet_dependencies(configs):
+    sections = {}
+    for index, config in enumerate(configs):
+        key = (config.get('manifest_section'), config.get('env'),
+               get_region(config))
+        sections.setdefault(key, []).append(index)
+    dependencies = {}
+    for index, config in enumerate(configs):
+        for section in split_list(config.get('depends_on')):
+            key = (section, config.get('env'), get_region(config))
+            if key not in sections:
+                raise ValueError(
+                    '{} depends on {}, which has no {} stack in {}.'.format(
+                        config.get('manifest_section'), section, key[1],
+                        key[2]))
+            dependencies.setdefault(index, set()).update(sections[key])
+    return dependencies
+
+
+def get_fleet_waves(count, dependencies):
+    levels = {}
+    remaining = set(range(count))
+    waves = []
+    while remaining:
+        wave = sorted(
+            index for index in remaining
+            if all(dep in levels for dep in dependencies.get(index, ())))
+        if not wave:
+            raise ValueError('Stack dependencies contain a cycle.')
+        for index in wave:
+            levels[index] = len(waves)
+        remaining.difference_update(wave)
+        waves.append(wave)
+    return waves
+
+
+def get_critical_path(waves, dependencies):
+    if not waves:
+        return []
+    levels = dict(
+        (index, level) for level, wave in enumerate(waves) for index in wave)
+    path = [waves[-1][0]]
+    while dependencies.get(path[0]):
+        path.insert(0, max(dependencies[path[0]], key=levels.get))
+    return path
+
+
+def print_fleet_plan(stacks, dependencies, max_parallel):
+    names = [get_stackname(config) for config, _ in stacks]
+    waves = get_fleet_waves(len(stacks), dependencies)
+    for number, wave in enumerate(waves, 1):
+        print('Wave {}: {}'.format(
+            number, ', '.join(names[index] for index in wave)))
+    path = get_critical_path(waves, dependencies)
+    print('Critical path ({} stacks): {}'.format(
+        len(path), ' -> '.join(names[index] for index in path)))
+    if waves:
+        print('Expected parallelism: {:.1f} ({} stacks in {} waves, at most '
+              '{} at once)'.format(
+                  float(len(stacks)) / len(waves), len(stacks), len(waves),
+                  max_parallel))
+
+
+SKIPPED = None
+
+
+# Each stack starts as soon as all of its dependencies have succeeded; the
+# dependents of a failed stack are skipped.
+# With group, at most group_limit stacks of each group(config) run at once,
+# on top of max_parallel overall.
+def run_fleet(stacks, max_parallel=4, dependencies=None, run=None,
+              group=None, group_limit=None):
+    run = run or main
+
+    def run_stack(stack):
+        config, passthrough_args = stack
+        start = time.time()
+        try:
+            returncode = run(config, passthrough_args=list(passthrough_args))
+        except Cancelled as exc:
+            print('{} cancelled: {}'.format(config.get('appname'), exc))
+            returncode = CANCELLED_EXIT
+        except Exception as exc:
+            print('{} failed: {}'.format(config.get('appname'), exc))
+            returncode = 1
+        return config, returncode, time.time() - start
+
+    dependencies = dependencies or {}
+    get_fleet_waves(len(stacks), dependencies)
+    waiting = dict(
+        (index, set(dependencies.get(index, ())))
+        for index in range(len(stacks)))
+    dependents = dict((index, []) for index in range(len(stacks)))
+    for index, deps in dependencies.items():
+        for dep in deps:
+            dependents[dep].append(index)
+    results = [None] * len(stacks)
+    pending = [len(stacks)]
+    finished = Queue()
+    pool = ThreadPool(max(1, max_parallel))
+
+    # Report from the worker itself so a stack that raises can never leave
+    # the scheduler waiting.
+    def run_indexed(index):
+        result = (stacks[index][0], 1, 0.0)
+        try:
+            result = run_stack(stacks[index])
+        finally:
+            finished.put((index, result))
+
+    ready = []
+    running = {}
+
+    def group_of(index):
+        return group(stacks[index][0]) if group else None
+
+    def launch():
+        for index in list(ready):
+            key = group_of(index)
+            if group_limit and running.get(key, 0) >= group_limit:
+                continue
+            ready.remove(index)
+            running[key] = running.get(key, 0) + 1
+            pool.apply_async(run_indexed, (index,))
+
+    def start(index):
+        ready.append(index)
+        launch()
+
+    def skip(index):
+        for dependent in dependents[index]:
+            if results[dependent] is None:
+                print('Skipping {} because {} failed.'.format(
+                    get_stackname(stacks[dependent][0]),
+                    get_stackname(stacks[index][0])))
+                results[dependent] = (stacks[dependent][0], SKIPPED, 0.0)
+                pending[0] -= 1
+                skip(dependent)
+
+    try:
+        for index, deps in waiting.items():
+            if not deps:
+                start(index)
+        while pending[0]:
+            index, result = finished.get()
+            results[index] = result
+            pending[0] -= 1
+            running[group_of(index)] -= 1
+            launch()
+            if result[1]:
+                skip(index)
+                continue
+            for dependent in dependents[index]:
+                waiting[dependent].discard(index)
+                if not waiting[dependent] and results[dependent] is None:
+                    start(dependent)
+    except (KeyboardInterrupt, Cancelled):
+        cancel_running()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def get_watcher(args, fetch_status=None):
+    return EnvironmentWatcher(
+        fetch_status,
+        min_interval=args.get('min_interval') or 5,
+        max_interval=args.get('max_interval') or 60,
+        deadline=args.get('deadline'),
+    )
+
+
+def watch_fleet(results, args):
+    stacks = {}
+    for config, returncode, _ in results:
+        if returncode == 0:
+            app = get_app(config)
+            stacks[app.key] = (get_engine(config), app, config)
+
+    def fetch_status(stackname):
+        engine, app, config = stacks[stackname]
+        return engine.status(app, config)
+
+    start = time.time()
+    statuses = get_watcher(args, fetch_status).watch(stacks)
+    watched = []
+    for config, returncode, elapsed in results:
+        status = statuses.get(get_stackname(config))
+        if status is not None:
+            returncode = int(not is_healthy(status))
+            elapsed += time.time() - start
+        watched.append((config, returncode, elapsed))
+    return watched
+
+
+# With --nowait a stack is done as soon as eb create returns, so stacks that
+# others depend on are watched until they are ready before their dependents
+# start.
+def wait_for_prerequisites(run, stacks, dependencies):
+    prerequisites = set(id(stacks[dep][0])
+                        for deps in dependencies.values() for dep in deps)
+
+    def run_stack(config, passthrough_args=None):
+        returncode = run(config, passthrough_args=passthrough_args)
+        if (returncode == 0 and id(config) in prerequisites and
+                config.get('nowait') and not config['dry_run']):
+            engine = get_engine(config)
+            returncode = wait_for_stack(
+                get_app(config, engine), config, engine)
+        return returncode
+    return run_stack
+
+
+def print_fleet_summary(results):
+    print('')
+    print('{:<40} {:<8} {:>8}'.format('Stack', 'Result', 'Seconds'))
+    for config, returncode, elapsed in results:
+        if returncode is SKIPPED:
+            result = 'skipped'
+        elif returncode:
+            result = 'failed({})'.format(returncode)
+        else:
+            result = 'ok'
+        print('{:<40} {:<8} {:>8.1f}'.format(
+            get_stackname(config), result, elapsed))
+    for config, returncode, elapsed in results:
+        output = _stack_outputs.get(get_stackname(config))
+        if returncode is SKIPPED or not returncode or output is None:
+            continue
+        print('')
+        print('Last {} lines of {}{}:'.format(
+            len(output.tail), output.label,
+            ' (full log in {})'.format(output.log_path)
+            if output.log_path else ''))
+        sys.stdout.write(''.join(output.tail))
+
+
+def print_region_summary(results):
+    regions = {}
+    for config, returncode, elapsed in results:
+        regions.setdefault(get_region(config), []).append(
+            (returncode, elapsed))
+    if len(regions) < 2:
+        return
+    print('')
+    print('{:<20} {:>6} {:>6} {:>8}'.format(
+        'Region', 'Stacks', 'Failed', 'Slowest'))
+    for region, stacks in sorted(regions.items()):
+        print('{:<20} {:>6} {:>6} {:>8.1f}'.format(
+            region, len(stacks),
+            sum(1 for returncode, _ in stacks if returncode),
+            max(elapsed for _, elapsed in stacks)))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='weatherman',
+        description='Create an Elastic Beanstalk Environment. Options will be '
+        'read from your config_path (default ~/.weathermanrc). Additional '
+        'options will be passed through to eb create. See eb create --help '
+        'for more information.'
+    )
+    parser.add_argument('appname', help='Application name')
+    parser.add_argument(
+        '--config-path',
+        default='~/.weathermanrc',
+        help='Custom config file path (default is ~/.weathermanrc)',
+    )
+    parser.add_argument('--env',
+                        default='dev',
+                        help='Environment to create (dev, qa, pt, prod)')
+    parser.add_argument('--stack-version',
+                        default='',
+                        help='Version identifier (e.g. 2 for dev2)')
+    parser.add_argument(
+        '--region',
+        help='AWS region to create the stack in (default {}, or the region '
+        'of the eb project for eb create)'.format(DEFAULT_REGION),
+    )
+    parser.add_argument(
+        '--stack-type',
+        default='python34_2.0.6',
+        help='Type of stack to create: a short key such as python34, '
+        'python34docker or nodejs for the newest matching platform, a '
+        'versioned key such as python34_2.0.6, a language such as python, or '
+        'a full solution stack name. Keys are looked up in a cached copy of '
+        'eb platform list.',
+    )
+    parser.add_argument(
+        '--probe-path',
+        help='Load test this path of each environment after it is created '
+        '(and of a standby before claim --swap-with), failing the stack if '
+        'the thresholds below are exceeded',
+    )
+    parser.add_argument(
+        '--probe-url',
+        help='Base URL to probe instead of the environment CNAME',
+    )
+    parser.add_argument(
+        '--probe-rate',
+        type=float,
+        default=PROBE_DEFAULTS['probe_rate'],
+        help='Probe requests per second (default {})'.format(
+            PROBE_DEFAULTS['probe_rate']),
+    )
+    parser.add_argument(
+        '--probe-duration',
+        type=float,
+        default=PROBE_DEFAULTS['probe_duration'],
+        help='Seconds to probe for (default {})'.format(
+            PROBE_DEFAULTS['probe_duration']),
+    )
+    parser.add_argument(
+        '--probe-concurrency',
+        type=int,
+        default=PROBE_DEFAULTS['probe_concurrency'],
+        help='Most probe requests in flight at once (default {})'.format(
+            PROBE_DEFAULTS['probe_concurrency']),
+    )
+    parser.add_argument(
+        '--probe-timeout',
+        type=float,
+        default=PROBE_DEFAULTS['probe_timeout'],
+        help='Seconds before a probe request counts as an error '
+        '(default {})'.format(PROBE_DEFAULTS['probe_timeout']),
+    )
+    parser.add_argument('--probe-max-p50', type=float,
+                        help='Highest acceptable median latency in ms')
+    parser.add_argument('--probe-max-p95', type=float,
+                        help='Highest acceptable 95th percentile latency '
+                        'in ms')
+    parser.add_argument('--probe-max-p99', type=float,
+                        help='Highest acceptable 99th percentile latency '
+                        'in ms')
+    parser.add_argument(
+        '--probe-max-error-rate',
+        type=float,
+        default=PROBE_DEFAULTS['probe_max_error_rate'],
+        help='Highest acceptable share of failed probe requests '
+        '(default {})'.format(PROBE_DEFAULTS['probe_max_error_rate']),
+    )
+    parser.add_argument(
+        '--capacity-profile',
+        help='Name of a [profile:NAME] section of your config_path whose '
+        'instance counts, scaling triggers and load balancer settings are '
+        'applied when the environment is created',
+    )
+    parser.add_argument(
+        '--init-timeout',
+        type=float,
+        help='Seconds before eb init is stopped',
+    )
+    parser.add_argument(
+        '--create-timeout',
+        type=float,
+        help='Seconds before eb create (or the wait for the environment) is '
+        'stopped',
+    )
+    parser.add_argument(
+        '--update-timeout',
+        type=float,
+        help='Seconds before eb config (or the wait for the environment) is '
+        'stopped',
+    )
+    parser.add_argument(
+        '--run-timeout',
+        type=float,
+        help='Seconds the whole run may take; phases still running then are '
+        'stopped',
+    )
+    parser.add_argument(
+        '--journal-path',
+        default='~/.weatherman/journal.jsonl',
+        help='Journal of the phases of each run '
+        '(default ~/.weatherman/journal.jsonl)',
+    )
+    parser.add_argument(
+        '--log-dir',
+        default='~/.weatherman/logs',
+        help='Directory for the full eb output of each stack '
+        '(default ~/.weatherman/logs)',
+    )
+    parser.add_argument(
+        '--output-tail-lines',
+        type=int,
+        default=OUTPUT_TAIL_LINES,
+        help='Lines of eb output kept per stack for failure reports '
+        '(default {})'.format(OUTPUT_TAIL_LINES),
+    )
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        default=2,
+        help='Standby environments kept ready by weatherman pool (default 2)',
+    )
+    parser.add_argument(
+        '--pool-concurrency',
+        type=int,
+        default=2,
+        help='Standby environments created at once by weatherman pool '
+        '(default 2)',
+    )
+    parser.add_argument(
+        '--pool-path',
+        default='~/.weatherman/pool.json',
+        help='Where standby environments are tracked '
+        '(default ~/.weatherman/pool.json)',
+    )
+    parser.add_argument(
+        '--bundle',
+        action='store_true',
+        help='Zip the source once, upload it once per region as an '
+        'application version named by its content hash, and create every '
+        'environment from that version (needs boto3)',
+    )
+    parser.add_argument(
+        '--source-dir',
+        default='.',
+        help='Directory whose source is deployed (default .)',
+    )
+    parser.add_argument(
+        '--bundle-dir',
+        default='~/.weatherman/bundles',
+        help='Where built source bundles are kept '
+        '(default ~/.weatherman/bundles)',
+    )
+    parser.add_argument(
+        '--platform-cache-path',
+        default='~/.weatherman/platforms.json',
+        help='Where the platform list is cached '
+        '(default ~/.weatherman/platforms.json)',
+    )
+    parser.add_argument(
+        '--platform-cache-ttl',
+        type=float,
+        default=PLATFORM_CACHE_TTL,
+        help='Seconds before the cached platform list of a region is '
+        'refreshed (default one day)',
+    )
+    parser.add_argument(
+        '--private-subnets',
+        help='Comma-separated list of subnet ids for private instances',
+    )
+    parser.add_argument(
+        '--public-subnets',
+        help='Comma-separated list of subnet ids for public instances',
+    )
+    parser.add_argument(
+        '--elb-subnets',
+        help='Comma-separated list of subnet ids for Elastic Load Balancers',
+    )
+    parser.add_argument(
+        '--vpc-id',
+        help='VPC id for instances',
+    )
+    parser.add_argument(
+        '--instance-type',
+        default='t2.micro',
+        help='Instance type (t2.micro, m3.medium, etc.)',
+    )
+    parser.add_argument(
+        '--iam-profile',
+        help='IAM profile name for EC2 instances',
+    )
+    parser.add_argument(
+        '--ec2-keyname',
+        help='SSH key name to associate with instances',
+    )
+    parser.add_argument(
+        '--assign-public-ip',
+        action='store_true',
+        help='Assign public IP to EC2 instances. Default is False.'
+             'Default "false"',
+    )
+    parser.add_argument(
+        '--assign-elb-public-ip',
+        action='store_true',
+        help='Assign public IP to ELB. Default is False.'
+    )
+    parser.add_argument(
+        '--profile',
+        help='Name of AWS config profile to use for AWS commands',
+    )
+    parser.add_argument(
+        '--notification-email',
+        help='Email address to send stack updates to. Applied when the '
+        'environment is created.',
+    )
+    parser.add_argument(
+        '--option-settings',
+        help='Extra Elastic Beanstalk option settings to apply when the '
+        'environment is created, one namespace/OptionName=value per line or '
+        'separated by semicolons.',
+    )
+    parser.add_argument(
+        '--prompt-db-password',
+        action='store_true',
+        help='Prompt for DB password rather than building it from environment '
+             'details. Defaults True for prod and false for other envs. eb '
+             'create then runs attached to the terminal, one at a time.'
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Dry run mode. Won\'t run external commands.'
+    )
+    parser.add_argument(
+        '--engine',
+        choices=['cli', 'inprocess', 'api'],
+        default='cli',
+        help='How to talk to Elastic Beanstalk: run the eb CLI (default), '
+        'run awsebcli inside this process, or call the EB API with boto3. '
+        'Falls back to the eb CLI if the library is missing. awsebcli runs '
+        'one command at a time, so fleets using it start every create with '
+        '--nowait.',
+    )
+    parser.add_argument(
+        '--eb-path',
+        default='eb',
+        help='eb command used by the cli engine (default eb). May include '
+        'arguments, e.g. "weatherman fake-eb" to use the local simulator.',
+    )
+    parser.add_argument(
+        '--nowait',
+        action='store_true',
+        help='Return as soon as eb create has started the environment.',
+    )
+    parser.add_argument(
+        '--metrics-path',
+        help='Append per-phase timings to this file as JSON lines '
+        '(- for stderr)',
+    )
+    parser.add_argument(
+        '--prometheus-textfile',
+        help='Write per-phase timings to this node-exporter textfile',
+    )
+    parser.add_argument(
+        '--trace-path',
+        help='Write phases, eb processes and API calls to this file as '
+        'Chrome trace events, for Perfetto or chrome://tracing',
+    )
+    parser.add_argument(
+        '--state-path',
+        help='Where applied stacks are recorded '
+        '(default ~/.weatherman/state.json)',
+    )
+    parser.add_argument(
+        '--eb-rate',
+        type=float,
+        default=2,
+        help='Most eb calls to start per second across all stacks, 0 for '
+        'no limit (default 2). Lowered automatically while AWS throttles.',
+    )
+    parser.add_argument(
+        '--eb-burst',
+        type=int,
+        default=5,
+        help='eb calls that may start at once before --eb-rate applies '
+        '(default 5)',
+    )
+    parser.add_argument(
+        '--max-retries',
+        type=int,
+        default=4,
+        help='Retries for throttled or transient eb failures (default 4)',
     )
-    command = build_eb_cli_command(app, config, passthrough_args)
-    if config['dry_run']:
-        print(list2cmdline(command))
-    else:
-        init_eb_environment(app)
-        process = Popen(command)
-        process.wait()
-        editor_env = os.environ.copy()
-        editor_env['EDITOR'] = (
-            'python -c "'
-            'import sys; '
-            'file = open(sys.argv[-1], \'r\'); '
-            'yaml = file.read(); '
-            'file.close(); '
-            'updated = yaml.replace(\'Notification Endpoint: null\', '
-            '\'Notification Endpoint: {}\'); '
-            'file = open(sys.argv[-1], \'w\'); '
-            'file.write(updated); '
-            'file.close();"'.format(config.get('notification_email')))
-
-        pargs = ['eb', 'config', app.stackname]
-        if config.get('profile'):
-            pargs += ['--profile', config.get('profile')]
-        process = Popen(pargs, env=editor_env)
-        process.wait()
+    parser.add_argument(
+        '--retry-base-delay',
+        type=float,
+        default=2,
+        help='Backoff before the first retry, doubled for each later one '
+        '(default 2 seconds)',
+    )
+    parser.add_argument(
+        '--retry-max-delay',
+        type=float,
+        default=60,
+        help='Longest backoff between retries (default 60 seconds)',
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='Run eb init even if the application registry says the '
+        'application was initialized recently.',
+    )
+    parser.add_argument(
+        '--registry-path',
+        default='~/.weatherman/registry.json',
+        help='Where initialized applications are recorded '
+        '(default ~/.weatherman/registry.json)',
+    )
+    parser.add_argument(
+        '--project-dir',
+        default='~/.weatherman/projects',
+        help='Where eb projects for each application and region are kept '
+        '(default ~/.weatherman/projects)',
+    )
+    parser.add_argument(
+        '--registry-ttl',
+        type=int,
+        default=REGISTRY_TTL,
+        help='Seconds before an initialized application is checked again '
+        '(default one week)',
+    )
+    parser.add_argument(
+        '--db-instance-class',
+        help='Passed through to eb as --database.instance if --database is '
+        'set.',
+    )
+    parser.add_argument(
+        '--db-engine',
+        help='Passed through to eb as --database.engine if --database is set.'
+    )
+    parser.add_argument(
+        '--db-size',
+        help='Passed through to eb as --database.size if --database is set.'
+    )
+    parser.add_argument(
+        '--db-version',
+        help='Passed through to eb as --database.version if --database is set.'
+    )
+    return parser
 
 
-def get_parser():
+def get_fleet_parser():
     parser = argparse.ArgumentParser(
-        prog='weatherman',
-        description='Create an Elastic Beanstalk Environment. Options will be '
-        'read from your config_path (default ~/.weathermanrc). Additional '
-        'options will be passed through to eb create. See eb create --help '
-        'for more information.'
+        prog='weatherman fleet',
+        description='Create many Elastic Beanstalk Environments from a '
+        'manifest. Each manifest section describes an application; envs and '
+        'stack_versions are comma-separated lists that are expanded into one '
+        'stack per combination. depends_on lists sections whose stacks in '
+        'the same env must be created first. Other keys override your '
+        'config_path.'
     )
-    parser.add_argument('appname', help='Application name')
+    parser.add_argument('manifest', help='Path to the fleet manifest')
     parser.add_argument(
         '--config-path',
         default='~/.weathermanrc',
         help='Custom config file path (default is ~/.weathermanrc)',
     )
-    parser.add_argument('--env',
-                        default='dev',
-                        help='Environment to create (dev, qa, pt, prod)')
-    parser.add_argument('--stack-version',
-                        default='',
-                        help='Version identifier (e.g. 2 for dev2)')
     parser.add_argument(
-        '--stack-type',
-        default='python34_2.0.6',
-        help='Type of stack to create (currently python34, python34docker, '
-        'or nodejs)',
+        '--max-parallel',
+        type=int,
+        help='Maximum number of stacks to create at once (default 4, or '
+        '--region-max-parallel times the number of regions)',
     )
     parser.add_argument(
-        '--private-subnets',
-        help='Comma-separated list of subnet ids for private instances',
+        '--regions',
+        help='Comma-separated regions to create every stack in, for '
+        'sections that set neither regions nor region',
     )
     parser.add_argument(
-        '--public-subnets',
-        help='Comma-separated list of subnet ids for public instances',
+        '--region-max-parallel',
+        type=int,
+        help='Maximum number of stacks to create at once in each region',
     )
     parser.add_argument(
-        '--elb-subnets',
-        help='Comma-separated list of subnet ids for Elastic Load Balancers',
+        '--dry-run',
+        action='store_true',
+        help='Dry run mode. Won\'t run external commands.'
     )
     parser.add_argument(
-        '--vpc-id',
-        help='VPC id for instances',
+        '--refresh',
+        action='store_true',
+        help='Run eb init once per application even if it is registered.',
     )
     parser.add_argument(
-        '--instance-type',
-        default='t2.micro',
-        help='Instance type (t2.micro, m3.medium, etc.)',
+        '--nowait',
+        action='store_true',
+        help='Start every eb create without waiting, then watch all '
+        'environments until they are ready. Stacks that others depend on '
+        'are still waited for before their dependents start.',
     )
     parser.add_argument(
-        '--iam-profile',
-        help='IAM profile name for EC2 instances',
+        '--bundle',
+        action='store_true',
+        help='Upload the source once per region and create every stack '
+        'from that application version',
     )
     parser.add_argument(
-        '--ec2-keyname',
-        help='SSH key name to associate with instances',
+        '--metrics-path',
+        help='Append per-phase timings to this file as JSON lines '
+        '(- for stderr)',
     )
     parser.add_argument(
-        '--assign-public-ip',
+        '--prometheus-textfile',
+        help='Write per-phase timings to this node-exporter textfile',
+    )
+    parser.add_argument(
+        '--trace-path',
+        help='Write phases, eb processes and API calls to this file as '
+        'Chrome trace events, for Perfetto or chrome://tracing',
+    )
+    parser.add_argument(
+        '--state-path',
+        help='Where applied stacks are recorded '
+        '(default ~/.weatherman/state.json)',
+    )
+    parser.add_argument(
+        '--deadline',
+        type=float,
+        help='Stop watching environments after this many seconds',
+    )
+    parser.add_argument(
+        '--min-interval',
+        type=float,
+        default=5,
+        help='Initial seconds between status checks (default 5)',
+    )
+    parser.add_argument(
+        '--max-interval',
+        type=float,
+        default=60,
+        help='Longest seconds between status checks of an unchanged '
+        'environment (default 60)',
+    )
+    parser.add_argument(
+        '--run-timeout',
+        type=float,
+        help='Seconds the whole fleet may take; stacks still running then '
+        'are stopped and recorded as incomplete',
+    )
+    parser.add_argument(
+        '--journal-path',
+        default='~/.weatherman/journal.jsonl',
+        help='Journal of the phases of each run '
+        '(default ~/.weatherman/journal.jsonl)',
+    )
+    parser.add_argument(
+        '--resume',
         action='store_true',
-        help='Assign public IP to EC2 instances. Default is False.'
-             'Default "false"',
+        help='Continue the last journaled run of this manifest, skipping '
+        'stacks that finished and waiting for interrupted creates',
     )
+    return parser
+
+
+def get_apply_parser():
+    parser = get_fleet_parser()
+    parser.prog = 'weatherman apply'
+    parser.description = (
+        'Bring the stacks in a manifest to the desired state. Stacks whose '
+        'eb create arguments, platform and region match the state file and '
+        'that still exist are left alone; missing stacks are created and '
+        'changed ones are updated with eb config.')
     parser.add_argument(
-        '--assign-elb-public-ip',
+        '--skip-live-check',
         action='store_true',
-        help='Assign public IP to ELB. Default is False.'
+        help='Trust the state file instead of checking that each stack '
+        'still exists',
     )
+    return parser
+
+
+def get_watch_parser():
+    parser = argparse.ArgumentParser(
+        prog='weatherman watch',
+        description='Watch Elastic Beanstalk Environments until each one is '
+        'ready or terminated.'
+    )
+    parser.add_argument('stacknames', nargs='+', help='Environment names')
     parser.add_argument(
         '--profile',
         help='Name of AWS config profile to use for AWS commands',
     )
     parser.add_argument(
-        '--notification-email',
-        help='Email address to send stack updates to (Note: This will fail '
-        'if you Ctrl-C out. Use eb config to edit it manually.)',
+        '--eb-path',
+        default='eb',
+        help='eb executable used to check status (default eb)',
     )
     parser.add_argument(
-        '--prompt-db-password',
-        action='store_true',
-        help='Prompt for DB password rather than building it from environment '
-             'details. Defaults True for prod and false for other envs.'
+        '--deadline',
+        type=float,
+        help='Stop watching environments after this many seconds',
     )
     parser.add_argument(
-        '--dry-run',
+        '--min-interval',
+        type=float,
+        default=5,
+        help='Initial seconds between status checks (default 5)',
+    )
+    parser.add_argument(
+        '--max-interval',
+        type=float,
+        default=60,
+        help='Longest seconds between status checks of an unchanged '
+        'environment (default 60)',
+    )
+    return parser
+
+
+def get_plan_parser():
+    parser = argparse.ArgumentParser(
+        prog='weatherman plan',
+        description='Write the eb commands for every stack in a manifest '
+        'without running them. The manifest is read and the plan written one '
+        'stack at a time, so memory use does not grow with the manifest. '
+        'Manifests can be INI files like the fleet manifest, CSV files with '
+        'one stack per row and config keys as columns, or JSON lines with '
+        'one object per stack.'
+    )
+    parser.add_argument(
+        'manifest', help='Path to the manifest, or - to read stdin')
+    parser.add_argument(
+        '--manifest-format',
+        choices=sorted(MANIFEST_READERS),
+        help='Manifest format (default from the extension, or guessed from '
+        'the first line)',
+    )
+    parser.add_argument(
+        '--config-path',
+        default='~/.weathermanrc',
+        help='Custom config file path (default is ~/.weathermanrc)',
+    )
+    parser.add_argument(
+        '--format',
+        choices=sorted(PLAN_RENDERERS),
+        default='jsonl',
+        help='jsonl writes one JSON object per stack; sh writes a shell '
+        'script that runs eb init and eb create (default jsonl)',
+    )
+    parser.add_argument(
+        '--output',
+        default='-',
+        help='Where to write the plan (default - for stdout)',
+    )
+    return parser
+
+
+def get_claim_parser():
+    parser = argparse.ArgumentParser(
+        prog='weatherman claim',
+        description='Hand out a ready standby environment kept by weatherman '
+        'pool and refill the pool in the background. Takes the same '
+        'arguments as weatherman, plus:',
+    )
+    parser.add_argument(
+        '--swap-with',
+        metavar='STACKNAME',
+        help='Swap the CNAMEs of the claimed environment and this one',
+    )
+    parser.add_argument(
+        '--no-refill',
         action='store_true',
-        help='Dry run mode. Won\'t run external commands.'
+        help='Do not start a background refill of the pool',
+    )
+    return parser
+
+
+def get_reap_parser():
+    parser = argparse.ArgumentParser(
+        prog='weatherman reap',
+        description='Terminate stale environments that follow weatherman\'s '
+        'app-envVERSION naming, several at once. Patterns are shell-style '
+        'globs. Takes the same arguments as weatherman (without appname), '
+        'plus:',
     )
     parser.add_argument(
-        '--db-instance-class',
-        help='Passed through to eb as --database.instance if --database is '
-        'set.',
+        '--app',
+        default='*',
+        help='Applications to reap (default all)',
     )
     parser.add_argument(
-        '--db-engine',
-        help='Passed through to eb as --database.engine if --database is set.'
+        '--env',
+        help='Envs to reap (default every env but prod, which must be asked '
+        'for by a pattern)',
     )
     parser.add_argument(
-        '--db-size',
-        help='Passed through to eb as --database.size if --database is set.'
+        '--stack-version',
+        default='*',
+        help='Stack versions to reap, e.g. "[0-9]*" to keep unversioned '
+        'stacks (default all)',
     )
     parser.add_argument(
-        '--db-version',
-        help='Passed through to eb as --database.version if --database is set.'
+        '--older-than',
+        type=parse_duration,
+        help='Only reap environments at least this old, in seconds or with '
+        'a unit such as 12h or 7d. Environments of unknown age are kept.',
+    )
+    parser.add_argument(
+        '--regions',
+        help='Comma-separated regions to reap in (default --region)',
+    )
+    parser.add_argument(
+        '--max-parallel',
+        type=int,
+        default=8,
+        help='Most environments terminated at once (default 8); --eb-rate '
+        'limits how fast calls start',
+    )
+    parser.add_argument(
+        '--region-max-parallel',
+        type=int,
+        help='Most environments terminated at once in each region',
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only show what would be terminated',
+    )
+    parser.add_argument(
+        '--yes',
+        action='store_true',
+        help='Terminate without asking; needed when not running from a '
+        'terminal',
     )
     return parser
 
 
-def dispatch():
-    parser = get_parser()
-    argsns, passthrough_args = parser.parse_known_args()
-    args = vars(argsns)
-    config_path = os.path.expanduser(args.get('config_path'))
-    config = ConfigParser()
-    config.read(config_path)
+class Config(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def parse_bool(value):
+    if value.strip().lower() in ('1', 'yes', 'true', 'on'):
+        return True
+    if value.strip().lower() in ('0', 'no', 'false', 'off', ''):
+        return False
+    raise ValueError('not a boolean')
+
+
+class ConfigSchema(object):
+    def __init__(self, parser):
+        self.defaults = {}
+        self.types = {}
+        self.choices = {}
+        for action in parser._actions:
+            if action.dest == 'help':
+                continue
+            self.defaults[action.dest] = action.default
+            if action.nargs == 0 and action.const is True:
+                self.types[action.dest] = parse_bool
+            elif action.type is not None:
+                self.types[action.dest] = action.type
+            if action.choices:
+                self.choices[action.dest] = action.choices
+        # A second parser that only reports flags given on the command line.
+        self.explicit_parser = get_parser()
+        for action in self.explicit_parser._actions:
+            action.default = argparse.SUPPRESS
+
+    def coerce(self, key, value):
+        if not isinstance(value, str):
+            return value
+        try:
+            if key in self.types:
+                value = self.types[key](value)
+        except ValueError:
+            raise ValueError('Invalid value {!r} for {}'.format(value, key))
+        if key in self.choices and value not in self.choices[key]:
+            raise ValueError('Invalid value {!r} for {}, expected one of '
+                             '{}'.format(value, key, self.choices[key]))
+        return value
+
+    def coerce_all(self, values):
+        return dict(
+            (key, self.coerce(key, value)) for key, value in values.items())
+
+
+_schema = []
+_config_files = {}
+_config_lock = threading.Lock()
+
+
+def get_config_schema():
+    with _config_lock:
+        if not _schema:
+            _schema.append(ConfigSchema(get_parser()))
+        return _schema[0]
+
+
+# Parsed and typed config files, keyed by path and mtime so repeated loads
+# of an unchanged file skip ConfigParser entirely.
+def compile_config_file(path):
+    path = os.path.expanduser(path)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    with _config_lock:
+        if (path, mtime) in _config_files:
+            return _config_files[(path, mtime)]
+    schema = get_config_schema()
+    parser = ConfigParser()
+    if mtime is not None:
+        parser.read(path)
+    defaults = parser.defaults()
+
+    def own_items(section):
+        return dict(
+            (key, value) for key, value in parser.items(section)
+            if key not in defaults or defaults[key] != value)
+
+    compiled = {
+        'defaults': schema.coerce_all(defaults),
+        'sections': dict(
+            (section, schema.coerce_all(own_items(section)))
+            for section in parser.sections()
+            if not section.startswith(CAPACITY_PROFILE_PREFIX)),
+        'profiles': dict(
+            (section[len(CAPACITY_PROFILE_PREFIX):],
+             compile_capacity_profile(
+                 section[len(CAPACITY_PROFILE_PREFIX):], own_items(section)))
+            for section in parser.sections()
+            if section.startswith(CAPACITY_PROFILE_PREFIX)),
+    }
+    with _config_lock:
+        for key in [key for key in _config_files if key[0] == path]:
+            del _config_files[key]
+        _config_files[(path, mtime)] = compiled
+    return compiled
+
+
+def load_config(argv, overrides=None):
+    schema = get_config_schema()
+    explicit, passthrough_args = schema.explicit_parser.parse_known_args(argv)
+    explicit = vars(explicit)
+    config_path = explicit.get('config_path', schema.defaults['config_path'])
+    compiled = compile_config_file(config_path)
+
+    config = Config(
+        (key, value) for key, value in schema.defaults.items()
+        if value is not None)
+    config.update(compiled['defaults'])
+    env = explicit.get('env', config['env'])
+    config.update(compiled['sections'].get(env, {}))
+    if overrides:
+        config.update(schema.coerce_all(overrides))
+    config.update(explicit)
+    profile = config.get('capacity_profile')
+    if profile:
+        if profile not in compiled['profiles']:
+            raise ValueError(
+                'Unknown capacity profile {!r}, expected one of {}'.format(
+                    profile, sorted(compiled['profiles'])))
+        config['capacity'] = compiled['profiles'][profile]
+    if config.get('run_timeout') and not config.get('run_deadline'):
+        config['run_deadline'] = time.time() + config['run_timeout']
+    return config, passthrough_args
+
+
+def load_config_timed(argv, overrides=None):
+    start = time.time()
+    config, passthrough_args = load_config(argv, overrides)
+    with get_metrics(config).phase('config_load', get_unresolved_app(config),
+                                   start):
+        pass
+    return config, passthrough_args
+
+
+def flush_metrics(configs):
+    for metrics in set(get_metrics(config) for config in configs):
+        metrics.flush()
+
+
+# Fleet flags that apply to every stack in the manifest.
+FLEET_OVERRIDES = (
+    'dry_run', 'refresh', 'nowait', 'metrics_path', 'prometheus_textfile',
+    'state_path', 'skip_live_check', 'journal_path', 'bundle', 'trace_path',
+)
+
+
+# Journals a new run of the manifest, or with --resume finds the last one.
+def get_journal_run(args, command):
+    journal = get_journal(vars(args))
+    if journal is None:
+        return None
+    if getattr(args, 'resume', False):
+        run = journal.find_run(args.manifest, command)
+        if run is not None:
+            print('Resuming run {}.'.format(run))
+            return run
+        print('No run of {} to resume, starting a new one.'.format(
+            args.manifest))
+    return journal.start_run(args.manifest, command)
+
+
+def load_fleet(args, command='fleet'):
+    stacks = []
+    journal_run = get_journal_run(args, command)
+    run_deadline = None
+    if getattr(args, 'run_timeout', None):
+        run_deadline = time.time() + args.run_timeout
+    manifest = expand_manifest(
+        args.manifest, split_list(getattr(args, 'regions', None)))
+    for appname, overrides, passthrough_args in manifest:
+        for key in FLEET_OVERRIDES:
+            if getattr(args, key, None):
+                overrides[key] = getattr(args, key)
+        if run_deadline:
+            overrides['run_deadline'] = run_deadline
+        if journal_run:
+            overrides['journal_run'] = journal_run
+        config, extra_args = load_config_timed(
+            [appname, '--config-path', args.config_path,
+             '--env', overrides['env']], overrides)
+        stacks.append((config, passthrough_args + extra_args))
+    return stacks
+
+
+# awsebcli runs one command at a time in this process, so stacks that wait
+# for their eb create run one after another however many run in parallel.
+def serializes_eb(configs, parallel):
+    return parallel > 1 and any(
+        config.get('engine') == 'inprocess' for config in configs)
+
 
-    args.update(dict(config.items(args['env'])))
-    cli_args = []
-    for key, value in args.items():
-        if value in (False, None):
+INPROCESS_WARNING = (
+    'The inprocess engine runs one eb command at a time, so stacks run one '
+    'after another; use --engine cli or api to run them in parallel.\n')
+
+
+# Regions run side by side, so a region cap raises the default overall
+# parallelism to one full share per region.
+def get_max_parallel(args, stacks):
+    if args.max_parallel:
+        return args.max_parallel
+    if args.region_max_parallel:
+        regions = set(get_region(config) for config, _ in stacks)
+        return args.region_max_parallel * len(regions)
+    return 4
+
+
+def dispatch_fleet(argv):
+    args = get_fleet_parser().parse_args(argv)
+    stacks = load_fleet(args)
+    dependencies = get_fleet_dependencies([config for config, _ in stacks])
+    if (not args.nowait and not args.dry_run and serializes_eb(
+            [config for config, _ in stacks], get_max_parallel(args, stacks))):
+        print('The inprocess engine runs one eb command at a time, so every '
+              'eb create starts with --nowait and the environments are '
+              'watched together.')
+        args.nowait = True
+        for config, _ in stacks:
+            config['nowait'] = True
+    if args.dry_run:
+        print_fleet_plan(stacks, dependencies, get_max_parallel(args, stacks))
+    run = main
+    if args.resume:
+        run = resume_stack
+    if dependencies:
+        run = wait_for_prerequisites(run, stacks, dependencies)
+    results = run_fleet(stacks, get_max_parallel(args, stacks), dependencies,
+                        run, get_region, args.region_max_parallel)
+    if args.nowait and not args.dry_run:
+        results = watch_fleet(results, vars(args))
+    print_fleet_summary(results)
+    print_region_summary(results)
+    flush_metrics(config for config, _ in stacks)
+    return int(any(returncode != 0 for _, returncode, _ in results))
+
+
+def dispatch_apply(argv):
+    args = get_apply_parser().parse_args(argv)
+    stacks = load_fleet(args, 'apply')
+    dependencies = get_fleet_dependencies([config for config, _ in stacks])
+    if serializes_eb([config for config, _ in stacks],
+                     get_max_parallel(args, stacks)):
+        sys.stderr.write(INPROCESS_WARNING)
+    run = apply_stack
+    if args.resume:
+        run = partial(resume_stack, run=apply_stack)
+    if dependencies:
+        run = wait_for_prerequisites(run, stacks, dependencies)
+    results = run_fleet(stacks, get_max_parallel(args, stacks), dependencies,
+                        run, get_region, args.region_max_parallel)
+    print_fleet_summary(results)
+    print_region_summary(results)
+    flush_metrics(config for config, _ in stacks)
+    return int(any(returncode != 0 for _, returncode, _ in results))
+
+
+# Planning never runs eb, so platforms come from the cache or
+# STACK_TYPE_MAP like in a dry run.
+def plan_stacks(manifest, config_path, errors):
+    for appname, overrides, passthrough_args in manifest:
+        try:
+            config, extra_args = load_config(
+                [appname, '--config-path', config_path,
+                 '--env', overrides['env']], dict(overrides, dry_run=True))
+            app = get_app(config)
+            command = build_eb_cli_command(
+                app, config, passthrough_args + extra_args)
+        except (KeyError, ValueError) as exc:
+            errors.append(overrides['manifest_section'])
+            sys.stderr.write('Skipping {} ({}): {}\n'.format(
+                appname, overrides['env'], exc))
             continue
-        elif key == 'appname':
-            cli_args.append(value)
-        else:
-            cli_args.append('--{}'.format(key.replace('_', '-')))
-            if value is not True:
-                cli_args.append(value)
-    main_args = vars(parser.parse_known_args(cli_args)[0])
-    main(main_args, passthrough_args=passthrough_args)
+        yield config, app, command
+
+
+def render_jsonl_plan(stacks):
+    for config, app, command in stacks:
+        yield json.dumps({
+            'section': config.get('manifest_section'),
+            'app': app.name,
+            'env': app.env,
+            'stackname': app.stackname,
+            'platform': app.platform,
+            'region': app.region,
+            'depends_on': split_list(config.get('depends_on')),
+            'option_settings': get_option_settings(config),
+            'command': command,
+        }, sort_keys=True) + '\n'
+
+
+# eb create only sees the application that eb init last wrote to the
+# project, so the script re-runs eb init whenever the application changes.
+def render_shell_plan(stacks):
+    yield '#!/bin/sh\nset -e\n'
+    project = None
+    for config, app, command in stacks:
+        lines = ['']
+        if (app.name, app.region) != project:
+            project = (app.name, app.region)
+            lines.append(' '.join(
+                quote(arg) for arg in build_eb_init_command(app)))
+        settings = get_option_settings(config)
+        if settings:
+            lines.append('mkdir -p .elasticbeanstalk/saved_configs')
+            lines.append(
+                "cat > .elasticbeanstalk/saved_configs/{}.cfg.yml <<'EOF'\n"
+                "{}EOF".format(get_saved_config_name(app),
+                               render_saved_config(app, settings)))
+        lines.append(' '.join(quote(arg) for arg in command))
+        yield '\n'.join(lines) + '\n'
+
+
+PLAN_RENDERERS = {
+    'jsonl': render_jsonl_plan,
+    'sh': render_shell_plan,
+}
+
+
+def dispatch_plan(argv):
+    args = get_plan_parser().parse_args(argv)
+    if args.manifest == '-':
+        source = sys.stdin
+    else:
+        source = open(os.path.expanduser(args.manifest))
+    if args.output == '-':
+        output = sys.stdout
+    else:
+        output = open(args.output, 'w')
+    errors = []
+    manifest = stream_manifest(source, args.manifest, args.manifest_format)
+    stacks = plan_stacks(manifest, args.config_path, errors)
+    try:
+        for chunk in PLAN_RENDERERS[args.format](stacks):
+            output.write(chunk)
+            output.flush()
+    except IOError as exc:
+        # The reading end of the pipe went away, as with | head.
+        if exc.errno != errno.EPIPE:
+            raise
+        os.dup2(os.open(os.devnull, os.O_WRONLY), output.fileno())
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+            if args.format == 'sh' and os.path.isfile(args.output):
+                os.chmod(args.output, 0o755)
+    return int(bool(errors))
+
+
+def dispatch_pool(argv):
+    config, passthrough_args = load_config(argv)
+    if serializes_eb([config], int(config.get('pool_concurrency') or 1)):
+        sys.stderr.write(INPROCESS_WARNING)
+    try:
+        return refill_pool(config, passthrough_args)
+    finally:
+        flush_metrics([config])
+
+
+def confirm(question):
+    if not sys.stdin.isatty():
+        return False
+    sys.stdout.write('{} [y/N] '.format(question))
+    sys.stdout.flush()
+    return sys.stdin.readline().strip().lower() in ('y', 'yes')
+
+
+def dispatch_reap(argv):
+    args, argv = get_reap_parser().parse_known_args(argv)
+    # The app pattern stands in for the appname weatherman's options need.
+    config, _ = load_config([args.app] + argv)
+    if serializes_eb([config], args.max_parallel):
+        sys.stderr.write(INPROCESS_WARNING)
+    engine = get_engine(config)
+    regions = split_list(args.regions) or [get_region(config)]
+    stale, errors = find_stale_environments(
+        config, engine, regions, args.app, args.env, args.stack_version,
+        args.older_than)
+    print_reap_plan(stale)
+    if args.dry_run or not stale:
+        return int(bool(errors))
+    if not args.yes and not confirm('Terminate {} environments?'.format(
+            len(stale))):
+        print('Not terminating anything; pass --yes to skip this question.')
+        return 1
+    stacks = [(dict(config, appname=environment['application'],
+                    env=environment['env'],
+                    stack_version=environment['stack_version'],
+                    region=environment['region']), [])
+              for environment in stale]
+    results = run_fleet(
+        stacks, args.max_parallel,
+        run=lambda config, passthrough_args: reap_environment(
+            config, passthrough_args, engine),
+        group=get_region, group_limit=args.region_max_parallel)
+    print_fleet_summary(results)
+    print_region_summary(results)
+    flush_metrics([config])
+    reclaimed = [get_stackname(config) for config, returncode, _ in results
+                 if returncode == 0]
+    print('Reclaimed {} of {} environments: {}'.format(
+        len(reclaimed), len(stale), ', '.join(reclaimed) or '-'))
+    return int(bool(errors) or len(reclaimed) < len(stale))
+
+
+def dispatch_claim(argv):
+    args, argv = get_claim_parser().parse_known_args(argv)
+    config, _ = load_config(argv)
+    returncode = claim_standby(config, args.swap_with)
+    if not args.no_refill and not config['dry_run']:
+        start_refill(config, argv)
+    return returncode
+
+
+def dispatch_watch(argv):
+    args = vars(get_watch_parser().parse_args(argv))
+    engine = CliEngine(args['eb_path'])
+
+    # A prod App is named exactly like its stack.
+    def fetch_status(stackname):
+        return engine.status(App(stackname, 'prod', '', None), args)
+
+    statuses = get_watcher(args, fetch_status).watch(args['stacknames'])
+    return int(not all(is_healthy(status) for status in statuses.values()))
+
+
+def dispatch(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    reset_cancellation()
+    handler = None
+    if threading.current_thread().name == 'MainThread':
+        handler = signal.signal(signal.SIGTERM, raise_cancelled)
+    try:
+        if argv and argv[0] in SUBCOMMANDS:
+            return SUBCOMMANDS[argv[0]](argv[1:])
+        config, passthrough_args = load_config_timed(argv)
+        try:
+            return main(config, passthrough_args=passthrough_args)
+        finally:
+            flush_metrics([config])
+    except (KeyboardInterrupt, Cancelled) as exc:
+        cancel_running()
+        sys.stderr.write('Cancelled: {}\n'.format(str(exc) or 'interrupted'))
+        return CANCELLED_EXIT
+    finally:
+        if handler is not None:
+            signal.signal(signal.SIGTERM, handler)
+
+
+class FakeEBError(Exception):
+    def __init__(self, returncode, message):
+        super(FakeEBError, self).__init__(message)
+        self.returncode = returncode
+
+
+# A stand-in for the eb CLI that keeps environments as JSON files under
+# state_dir. The profile is an INI file whose sections are eb commands (with
+# [DEFAULT] for all of them) and whose keys are latency, jitter,
+# throttle_rate, failure_rate and ready_after, all in seconds or fractions.
+class FakeEB(object):
+    def __init__(self, state_dir, profile=None, seed=None):
+        self.state_dir = os.path.expanduser(state_dir)
+        self.profile = ConfigParser()
+        if profile:
+            self.profile.read(os.path.expanduser(profile))
+        self.random = random.Random(seed)
+
+    def setting(self, command, key, default=0.0):
+        if self.profile.has_section(command):
+            if self.profile.has_option(command, key):
+                return float(self.profile.get(command, key))
+        elif key in self.profile.defaults():
+            return float(self.profile.defaults()[key])
+        return default
+
+    def simulate(self, command):
+        delay = self.setting(command, 'latency')
+        delay += self.random.uniform(0, self.setting(command, 'jitter'))
+        if delay:
+            time.sleep(delay)
+        if self.random.random() < self.setting(command, 'throttle_rate'):
+            raise FakeEBError(4, 'Throttling: Rate exceeded')
+        return self.random.random() < self.setting(command, 'failure_rate')
+
+    def path(self, *parts):
+        return os.path.join(self.state_dir, *parts)
+
+    # Environments of an explicit region live in their own directory.
+    def env_path(self, name, region=None):
+        if region and region != DEFAULT_REGION:
+            return self.path('environments', region, name + '.json')
+        return self.path('environments', name + '.json')
+
+    def load(self, name, region=None):
+        try:
+            with open(self.env_path(name, region)) as env:
+                return json.load(env)
+        except IOError:
+            raise FakeEBError(
+                4, 'NotFoundError - Environment "{}" not Found.'.format(name))
+
+    def save(self, env):
+        path = self.env_path(env['name'], env.get('region'))
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as tmp:
+            json.dump(env, tmp, sort_keys=True)
+        os.rename(tmp_path, path)
+
+    def current(self, env):
+        if env['status'] == 'Launching' and time.time() >= env['ready_at']:
+            env['status'] = 'Ready'
+            env['health'] = env.pop('final_health', 'Green')
+            self.save(env)
+        return env
+
+    def command_init(self, args):
+        failed = self.simulate('init')
+        if failed:
+            raise FakeEBError(1, 'Simulated init failure')
+        directory = self.path('applications')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        open(os.path.join(directory, args.name), 'a').close()
+        if not os.path.isdir('.elasticbeanstalk'):
+            os.makedirs('.elasticbeanstalk')
+        with open(os.path.join('.elasticbeanstalk', 'config.yml'), 'w') as cfg:
+            cfg.write('global:\n  application_name: {}\n'
+                      '  default_platform: {}\n  default_region: {}\n'.format(
+                          args.name, args.platform, args.region))
+        print('Application {} has been created.'.format(args.name))
+
+    def command_create(self, args):
+        try:
+            with open(os.path.join('.elasticbeanstalk', 'config.yml')) as cfg:
+                application = cfg.read().split('application_name: ')[1]
+        except (IOError, IndexError):
+            raise FakeEBError(
+                4, 'This directory has not been set up with the EB CLI')
+        failed = self.simulate('create')
+        path = self.env_path(args.name, args.region)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            raise FakeEBError(
+                4, 'InvalidParameterValueError - Environment {} already '
+                'exists.'.format(args.name))
+        now = time.time()
+        env = {
+            'name': args.name,
+            'application': application.splitlines()[0].strip(),
+            'platform': args.platform,
+            'region': args.region,
+            'cfg': args.cfg,
+            'version': args.version,
+            'status': 'Launching',
+            'health': 'Grey',
+            'final_health': 'Red' if failed else 'Green',
+            'created': now,
+            'ready_at': now + self.setting('create', 'ready_after'),
+        }
+        self.save(env)
+        print('Creating environment {}.'.format(args.name))
+        if args.nowait:
+            return 0
+        time.sleep(max(0, env['ready_at'] - time.time()))
+        env = self.current(env)
+        if env['health'] == 'Red':
+            raise FakeEBError(1, 'Simulated create failure')
+
+    def command_status(self, args):
+        if self.simulate('status'):
+            raise FakeEBError(1, 'Simulated status failure')
+        env = self.current(self.load(args.name, args.region))
+        print('Environment details for: {}'.format(env['name']))
+        print('  Application name: {}'.format(env['application']))
+        print('  Platform: {}'.format(env['platform']))
+        print('  CNAME: {}.elasticbeanstalk.com'.format(
+            env.get('cname', env['name'])))
+        print('  Status: {}'.format(env['status']))
+        print('  Health: {}'.format(env['health']))
+
+    def command_config(self, args):
+        env = self.current(self.load(args.name, args.region))
+        if self.simulate('config'):
+            raise FakeEBError(1, 'Simulated config failure')
+        print('Configuration of {} is up to date.'.format(env['name']))
+
+    def command_platform(self, args):
+        if self.simulate('platform'):
+            raise FakeEBError(1, 'Simulated platform list failure')
+        for solution_stack in sorted(STACK_TYPE_MAP.values()):
+            print(solution_stack)
+
+    def command_swap(self, args):
+        source = self.current(self.load(args.name, args.region))
+        destination = self.current(
+            self.load(args.destination_name, args.region))
+        if self.simulate('swap'):
+            raise FakeEBError(1, 'Simulated swap failure')
+        source['cname'], destination['cname'] = (
+            destination.get('cname', destination['name']),
+            source.get('cname', source['name']))
+        self.save(source)
+        self.save(destination)
+        print('Swapped CNAMEs of {} and {}.'.format(
+            source['name'], destination['name']))
+
+    def command_list(self, args):
+        directory = os.path.dirname(self.env_path('', args.region))
+        names = []
+        if os.path.isdir(directory):
+            names = sorted(name[:-len('.json')]
+                           for name in os.listdir(directory)
+                           if name.endswith('.json'))
+        envs = [self.current(self.load(name, args.region)) for name in names]
+        envs = [env for env in envs if env['status'] != 'Terminated']
+        if self.simulate('list'):
+            raise FakeEBError(1, 'Simulated list failure')
+        print('Region: {}'.format(args.region or DEFAULT_REGION))
+        for application in sorted(set(env['application'] for env in envs)):
+            names = [env['name'] for env in envs
+                     if env['application'] == application]
+            print('Application: {}'.format(application))
+            print('    Environments: {}'.format(len(names)))
+            for name in names:
+                print('        {} : []'.format(name))
+
+    def command_terminate(self, args):
+        env = self.current(self.load(args.name, args.region))
+        if self.simulate('terminate'):
+            raise FakeEBError(1, 'Simulated terminate failure')
+        env['status'] = 'Terminated'
+        env['health'] = 'Grey'
+        self.save(env)
+        print('Environment {} terminated.'.format(env['name']))
+
+
+def get_fake_eb_parser():
+    parser = argparse.ArgumentParser(
+        prog='weatherman fake-eb',
+        description='Local simulator for the eb commands weatherman runs. '
+        'State is kept in $WEATHERMAN_FAKE_EB_STATE (default '
+        '~/.weatherman/fake-eb); latencies, throttling and failures come '
+        'from the INI profile in $WEATHERMAN_FAKE_EB_PROFILE.'
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    init = subparsers.add_parser('init')
+    init.add_argument('name')
+    init.add_argument('--platform')
+    init.add_argument('--region')
+    create = subparsers.add_parser('create')
+    create.add_argument('name')
+    create.add_argument('--platform')
+    create.add_argument('--cfg')
+    create.add_argument('--region')
+    create.add_argument('--version')
+    create.add_argument('--nowait', action='store_true')
+    for command in ('status', 'config', 'terminate'):
+        command = subparsers.add_parser(command)
+        command.add_argument('name')
+        command.add_argument('--region')
+    listing = subparsers.add_parser('list')
+    listing.add_argument('--all', action='store_true')
+    listing.add_argument('--verbose', action='store_true')
+    listing.add_argument('--region')
+    swap = subparsers.add_parser('swap')
+    swap.add_argument('name')
+    swap.add_argument('--destination_name', required=True)
+    swap.add_argument('--region')
+    platform = subparsers.add_parser('platform')
+    platform.add_argument('name', choices=['list'])
+    platform.add_argument('--verbose', action='store_true')
+    platform.add_argument('--region')
+    return parser
+
+
+def fake_eb(argv=None):
+    args = get_fake_eb_parser().parse_known_args(argv)[0]
+    seed = os.environ.get('WEATHERMAN_FAKE_EB_SEED')
+    eb = FakeEB(
+        os.environ.get('WEATHERMAN_FAKE_EB_STATE', FAKE_EB_STATE),
+        os.environ.get('WEATHERMAN_FAKE_EB_PROFILE'),
+        int(seed) if seed else None,
+    )
+    try:
+        return getattr(eb, 'command_' + args.command)(args) or 0
+    except FakeEBError as exc:
+        sys.stderr.write('ERROR: {}\n'.format(exc))
+        return exc.returncode
+
+
+SUBCOMMANDS = {
+    'fleet': dispatch_fleet,
+    'apply': dispatch_apply,
+    'plan': dispatch_plan,
+    'pool': dispatch_pool,
+    'claim': dispatch_claim,
+    'reap': dispatch_reap,
+    'watch': dispatch_watch,
+    'fake-eb': fake_eb,
+}
 
 
 if __name__ == '__main__':
-    dispatch()
+    sys.exit(dispatch())